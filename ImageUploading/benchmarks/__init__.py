@@ -0,0 +1,7 @@
+"""Offline throughput benchmarks for the Flywheel uploader.
+
+The package provides a synthetic NACC-style DICOM archive generator
+(`synthetic`), a local HTTP stand-in for the Flywheel endpoints used by the
+uploader (`standin`), and a runner that measures
+`UploadImageData.uploadImages` end to end against both (`bench_upload`).
+"""
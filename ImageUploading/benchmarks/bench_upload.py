@@ -0,0 +1,280 @@
+"""Measure `UploadImageData.uploadImages` against a local Flywheel stand-in.
+
+Run from the ImageUploading directory::
+
+    python -m benchmarks.bench_upload --subjects 4 --series 8 --instances 64
+
+A synthetic archive is generated in a temporary directory, a stand-in
+server is started in a separate process, and the archive is uploaded with
+the real packaging and upload pipeline. Containers are created and files
+uploaded over the uploader's `Transport` by `StandInConnector`, which takes
+the place of `FlywheelConnector`. The result is printed as JSON.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from os import path
+from typing import Any, Dict, Optional, Tuple
+
+import fwImageUpload
+
+from . import standin, synthetic
+
+
+class StandInContainer:
+    """Flywheel container created on the stand-in."""
+
+    def __init__(self, id: str, label: str):  # noqa: A002
+        self.id = id
+        self.label = label
+
+
+class StandInConnector:
+    """
+    StandInConnector.
+
+    Duck-typed `FlywheelConnector` resolving containers on the stand-in.
+    Like the real connector it caches containers by parent and label, so
+    each one is created with a single request, and it sends uploads through
+    the uploader's `Transport`.
+
+    Parameters
+    ----------
+    url : str
+        Base URL of the stand-in server.
+    concurrency : int, optional
+        Maximum number of requests in flight (default 4).
+    metrics : RunMetrics, optional
+        Collector of the API calls and retries of the connector.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        concurrency: int = 4,
+        metrics: Optional[fwImageUpload.RunMetrics] = None,
+    ):
+        self.metrics = metrics
+        self.transport = fwImageUpload.Transport(
+            url, concurrency=concurrency, metrics=metrics
+        )
+        self.lock = threading.Lock()
+        self.containers: Dict[Tuple[str, str, str], StandInContainer] = {}
+
+    def container(self, kind: str, parent: str, label: str) -> StandInContainer:
+        """Return the container of `kind` under `parent`, creating it once."""
+        key = (kind, parent, label)
+        with self.lock:
+            found = self.containers.get(key)
+            if found is None:
+                if self.metrics is not None:
+                    # Named like FlywheelConnector's, e.g. api.addSubject.
+                    self.metrics.count(f"api.add{kind[:-1].capitalize()}")
+                created = self.transport.json(
+                    "POST", f"/api/{kind}", {"parent": parent, "label": label}
+                )
+                found = self.containers[key] = StandInContainer(created["_id"], label)
+            return found
+
+    def getSubject(self, label: str) -> StandInContainer:
+        """Return the subject with `label`."""
+        return self.container("subjects", "project", label)
+
+    def getSession(self, subject: StandInContainer, label: str) -> StandInContainer:
+        """Return the session of `subject` with `label`."""
+        return self.container("sessions", subject.id, label)
+
+    def getAcquisition(self, session: StandInContainer, label: str) -> StandInContainer:
+        """Return the acquisition of `session` with `label`."""
+        return self.container("acquisitions", session.id, label)
+
+    def uploadFile(
+        self, acquisition: StandInContainer, spec: Any, metadata: Optional[Dict] = None
+    ) -> None:
+        """Upload a `flywheel.FileSpec` to an acquisition on the stand-in."""
+        self.transport.upload(
+            f"/api/acquisitions/{acquisition.id}/files",
+            spec.name,
+            spec.contents,
+            spec.size,
+            metadata,
+            spec.content_type,
+        )
+
+
+def peakRSS(who: int) -> float:
+    """Return the peak resident set size of `who` in MiB (Linux units)."""
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def runBenchmark(
+    subjects: int = 2,
+    series: int = 4,
+    instances: int = 32,
+    payloadBytes: int = 16384,
+    workers: int = 4,
+    uploaders: Optional[int] = None,
+    processes: int = 1,
+    latency: float = 0.0,
+    bandwidth: Optional[float] = None,
+    errorRate: float = 0.0,
+    traceMemory: bool = False,
+    workdir: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Generate an archive, upload it to a stand-in, and measure the run.
+
+    Parameters
+    ----------
+    subjects, series, instances : int
+        Shape of the synthetic archive.
+    payloadBytes : int
+        Pixel payload size of each instance.
+    workers, uploaders, processes : int
+        Uploader concurrency settings (see `UploadImageData`).
+    latency : float
+        Seconds the stand-in adds to every response.
+    bandwidth : float, optional
+        Stand-in upload throughput limit in bytes per second.
+    errorRate : float
+        Probability of the stand-in answering an upload with 503.
+    traceMemory : bool
+        Also report the peak of Python allocations via tracemalloc, at some
+        cost in throughput.
+    workdir : str, optional
+        Directory for the archive. A temporary one is used when omitted.
+
+    Returns
+    -------
+    Dict[str, Any]
+        Throughput, memory and stage figures of the run.
+    """
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        archive = path.join(tmp, "bench.zip")
+        start = time.perf_counter()
+        files, nbytes = synthetic.writeArchive(
+            archive, subjects, series, instances, payloadBytes
+        )
+        generateSeconds = time.perf_counter() - start
+
+        context = multiprocessing.get_context("spawn")
+        ready = context.Queue()
+        server = context.Process(
+            target=standin.serve,
+            args=(ready, latency, bandwidth, errorRate),
+            daemon=True,
+        )
+        server.start()
+        try:
+            fc = StandInConnector(ready.get(timeout=30), uploaders or workers)
+            fc.transport.metrics = metrics = fwImageUpload.RunMetrics()
+            uploader = fwImageUpload.UploadImageData(
+                fc,
+                archive,
+                workers=workers,
+                uploaders=uploaders,
+                processes=processes,
+                metrics=metrics,
+            )
+
+            if traceMemory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            uploader.uploadImages(segIndex=1)
+            seconds = time.perf_counter() - start
+            traced = tracemalloc.get_traced_memory()[1] if traceMemory else None
+            if traceMemory:
+                tracemalloc.stop()
+
+            stats = fc.transport.json("GET", "/api/stats")
+            childRSS = peakRSS(resource.RUSAGE_CHILDREN)
+        finally:
+            server.terminate()
+            server.join()
+
+    return {
+        "archive": {
+            "subjects": subjects,
+            "series": subjects * series,
+            "files": files,
+            "bytes": nbytes,
+            "generateSeconds": round(generateSeconds, 3),
+        },
+        "settings": {
+            "workers": uploader.workers,
+            "uploaders": uploader.uploaders,
+            "processes": uploader.processes,
+            "latency": latency,
+            "bandwidth": bandwidth,
+            "errorRate": errorRate,
+        },
+        "seconds": round(seconds, 3),
+        "filesPerSecond": round(files / seconds, 1),
+        "bytesPerSecond": round(nbytes / seconds),
+        "peakRSSMB": round(peakRSS(resource.RUSAGE_SELF), 1),
+        "childPeakRSSMB": round(childRSS, 1),
+        "tracedPeakMB": None if traced is None else round(traced / (1 << 20), 1),
+        "failedSeries": len(uploader.failedSeries),
+        "retries": uploader.metrics.report()["retries"],
+        "server": stats,
+        "stages": uploader.metrics.report()["stages"],
+    }
+
+
+def main() -> None:
+    """Parse options, run one benchmark and print its result as JSON."""
+    parser = argparse.ArgumentParser(description="Uploader throughput benchmark")
+    parser.add_argument("--subjects", type=int, default=2)
+    parser.add_argument("--series", type=int, default=4, help="Series per subject")
+    parser.add_argument(
+        "--instances", type=int, default=32, help="Instances per series"
+    )
+    parser.add_argument(
+        "--payload-kb", type=int, default=16, help="Pixel payload per instance"
+    )
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument("-u", "--uploaders", type=int)
+    parser.add_argument("-p", "--processes", type=int, default=1)
+    parser.add_argument(
+        "--latency-ms", type=float, default=0.0, help="Stand-in response latency"
+    )
+    parser.add_argument(
+        "--bandwidth-mbps", type=float, help="Stand-in upload limit in MB/s"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Stand-in upload 503 rate"
+    )
+    parser.add_argument(
+        "--trace-memory", action="store_true", help="Report tracemalloc peak"
+    )
+    parser.add_argument("--verbose", action="store_true", help="Keep uploader logs")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        fwImageUpload.logger.setLevel(logging.WARNING)
+
+    result = runBenchmark(
+        subjects=args.subjects,
+        series=args.series,
+        instances=args.instances,
+        payloadBytes=args.payload_kb << 10,
+        workers=args.workers,
+        uploaders=args.uploaders,
+        processes=args.processes,
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_mbps * 1e6 if args.bandwidth_mbps else None,
+        errorRate=args.error_rate,
+        traceMemory=args.trace_memory,
+    )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
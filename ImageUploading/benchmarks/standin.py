@@ -0,0 +1,297 @@
+"""Local HTTP stand-in for the Flywheel endpoints used by the uploader.
+
+The server emulates just enough of the Flywheel API to exercise the upload
+path offline: container creation, multipart file upload and a version
+probe. Every response can be delayed by a fixed latency, and upload bodies
+can be throttled to a bandwidth, so benchmarks see realistic round trips.
+Faults (error statuses, dropped connections and stalls) can be scripted per
+route or injected at random to exercise retry and backoff behaviour.
+Bodies are drained in chunks and discarded, keeping the server's memory
+flat however much is uploaded.
+"""
+
+import json
+import random
+import re
+import socket
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, Optional, Tuple, Union
+
+UPLOAD_ROUTE = re.compile(r"^/api/acquisitions/(?P<id>[^/]+)/files$")
+CONTAINER_ROUTE = re.compile(r"^/api/(?P<kind>subjects|sessions|acquisitions)$")
+DRAIN_CHUNK_SIZE = 1 << 20
+
+# A scripted fault: an HTTP status to answer with, "reset" to drop the
+# connection without a response, or a float number of seconds to stall
+# before dropping it.
+Fault = Union[int, str, float]
+
+
+def routeName(route: str) -> str:
+    """Return the counter and fault name of a request path."""
+    if UPLOAD_ROUTE.match(route):
+        return "upload"
+    match = CONTAINER_ROUTE.match(route)
+    return match["kind"] if match else route.rsplit("/", 1)[-1]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Request handler dispatching to the owning `StandInServer`."""
+
+    protocol_version = "HTTP/1.1"
+    server: "StandInServer"
+
+    def setup(self) -> None:
+        """Count each new client connection."""
+        super().setup()
+        self.server.count("connections")
+
+    def do_GET(self) -> None:
+        """Serve a GET request."""
+        self.server.dispatch(self)
+
+    def do_POST(self) -> None:
+        """Serve a POST request."""
+        self.server.dispatch(self)
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        """Keep the benchmark output free of access logs."""
+
+    def readBody(self) -> bytes:
+        """Read the whole request body."""
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def drainBody(self) -> int:
+        """Read and discard the request body, returning its size."""
+        remaining = int(self.headers.get("Content-Length") or 0)
+        size = remaining
+        while remaining:
+            chunk = self.rfile.read(min(remaining, DRAIN_CHUNK_SIZE))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            self.server.throttle(len(chunk))
+        return size - remaining
+
+    def sendJSON(self, status: int, payload: Any) -> None:
+        """Send a JSON response on the keep-alive connection."""
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    StandInServer.
+
+    Threaded HTTP server emulating the Flywheel upload endpoints.
+
+    Routes
+    ------
+    GET  /api/version
+        Version probe.
+    GET  /api/stats
+        Request, container and upload counters of the server.
+    POST /api/subjects, /api/sessions, /api/acquisitions
+        Create a container and return its ``_id``.
+    POST /api/acquisitions/<id>/files
+        Accept a multipart upload; the body is drained and discarded.
+
+    Parameters
+    ----------
+    address : Tuple[str, int], optional
+        Bind address (default 127.0.0.1 on a free port).
+    latency : float, optional
+        Seconds added to every response (default 0).
+    bandwidth : float, optional
+        Upload throughput limit in bytes per second (default unlimited).
+    errorRate : float, optional
+        Probability of answering an upload with 503 (default 0).
+    seed : int, optional
+        Seed of the random error generator (default 0).
+
+    Attributes
+    ----------
+    stats : Dict[str, Any]
+        Counters reported by ``GET /api/stats``.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        errorRate: float = 0.0,
+        seed: int = 0,
+    ):
+        super().__init__(address, StandInHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.faults: Dict[str, Deque[Fault]] = {}
+        self.lock = threading.Lock()
+        self.stats: Dict[str, Any] = {
+            "requests": {},
+            "containers": {"subjects": 0, "sessions": 0, "acquisitions": 0},
+            "uploads": 0,
+            "uploadedBytes": 0,
+            "faults": 0,
+        }
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """Base URL of the server."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "StandInServer":
+        """Start serving for the duration of a ``with`` block."""
+        self.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        """Stop serving."""
+        self.stop()
+
+    def start(self) -> None:
+        """Serve requests on a background thread."""
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop serving and close the listening socket."""
+        self.shutdown()
+        self.server_close()
+
+    def throttle(self, nbytes: int) -> None:
+        """Sleep long enough to hold uploads to `bandwidth`."""
+        if self.bandwidth:
+            time.sleep(nbytes / self.bandwidth)
+
+    def inject(self, route: str, *faults: Fault) -> None:
+        """
+        Script faults for the next requests to a route.
+
+        Parameters
+        ----------
+        route : str
+            "upload", "subjects", "sessions", "acquisitions" or "version".
+        *faults : Fault
+            Applied in order, one per request: an HTTP status, "reset" to
+            drop the connection, or seconds to stall before dropping it.
+        """
+        with self.lock:
+            self.faults.setdefault(route, deque()).extend(faults)
+
+    def nextFault(self, route: str) -> Optional[Fault]:
+        """Return the fault to apply to this request of `route`, if any."""
+        with self.lock:
+            queued = self.faults.get(route)
+            if queued:
+                return queued.popleft()
+            if route == "upload" and self.random.random() < self.errorRate:
+                return 503
+        return None
+
+    def applyFault(self, handler: StandInHandler, fault: Fault) -> None:
+        """Answer a request with a fault instead of serving it."""
+        with self.lock:
+            self.stats["faults"] += 1
+
+        if isinstance(fault, float):
+            # A stalled server: nothing is read or answered before it hangs up.
+            time.sleep(fault)
+            fault = "reset"
+        else:
+            handler.drainBody()
+
+        if fault == "reset":
+            handler.close_connection = True
+            handler.connection.shutdown(socket.SHUT_RDWR)
+        else:
+            handler.sendJSON(fault, {"message": "injected fault"})
+
+    def count(self, route: str) -> None:
+        """Count one request to `route`."""
+        with self.lock:
+            requests = self.stats["requests"]
+            requests[route] = requests.get(route, 0) + 1
+
+    def dispatch(self, handler: StandInHandler) -> None:
+        """Serve one request after the configured latency."""
+        route = handler.path.split("?", 1)[0]
+        method = handler.command
+
+        name = routeName(route)
+        fault = self.nextFault(name)
+        if fault is not None:
+            self.count(name)
+            self.applyFault(handler, fault)
+            return
+
+        if method == "POST" and (match := UPLOAD_ROUTE.match(route)):
+            self.count("upload")
+            size = handler.drainBody()
+            with self.lock:
+                self.stats["uploads"] += 1
+                self.stats["uploadedBytes"] += size
+            status, payload = 200, [{"acquisition": match["id"], "size": size}]
+        elif method == "POST" and (match := CONTAINER_ROUTE.match(route)):
+            kind = match["kind"]
+            self.count(kind)
+            label = json.loads(handler.readBody() or b"{}").get("label")
+            with self.lock:
+                self.stats["containers"][kind] += 1
+                cid = f"{kind[:-1]}-{self.stats['containers'][kind]}"
+            status, payload = 200, {"_id": cid, "label": label}
+        elif method == "GET" and route == "/api/version":
+            self.count("version")
+            status, payload = 200, {"release": "stand-in"}
+        elif method == "GET" and route == "/api/stats":
+            with self.lock:
+                status, payload = 200, json.loads(json.dumps(self.stats))
+        else:
+            handler.drainBody()
+            status, payload = 404, {"message": f"No route for {method} {route}"}
+
+        if self.latency:
+            time.sleep(self.latency)
+        handler.sendJSON(status, payload)
+
+
+def serve(
+    ready: Any,
+    latency: float = 0.0,
+    bandwidth: Optional[float] = None,
+    errorRate: float = 0.0,
+):
+    """
+    Run a stand-in server until the process is terminated.
+
+    Intended as a `multiprocessing` target so the server does not share an
+    interpreter with the code being measured.
+
+    Parameters
+    ----------
+    ready : multiprocessing.Queue
+        Receives the server URL once it is listening.
+    latency : float, optional
+        Seconds added to every response.
+    bandwidth : float, optional
+        Upload throughput limit in bytes per second.
+    errorRate : float, optional
+        Probability of answering an upload with 503.
+    """
+    server = StandInServer(latency=latency, bandwidth=bandwidth, errorRate=errorRate)
+    ready.put(server.url)
+    server.serve_forever()
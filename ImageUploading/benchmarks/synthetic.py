@@ -0,0 +1,124 @@
+"""Synthetic NACC-style DICOM archives for benchmarking the uploader."""
+
+import io
+import random
+import zipfile
+from typing import Tuple
+
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+
+
+def instanceBytes(
+    seriesUID: str,
+    seriesNumber: int,
+    instanceNumber: int,
+    pixels: bytes,
+    studyDate: str = "20240101",
+) -> bytes:
+    """
+    Serialize one MR instance carrying the tags the uploader groups on.
+
+    Parameters
+    ----------
+    seriesUID : str
+        SeriesInstanceUID of the instance.
+    seriesNumber : int
+        SeriesNumber of the instance.
+    instanceNumber : int
+        InstanceNumber of the instance.
+    pixels : bytes
+        Opaque pixel payload stored as PixelData.
+    studyDate : str, optional
+        StudyDate of the instance (default "20240101").
+
+    Returns
+    -------
+    bytes
+        Part 10 encoded DICOM file.
+    """
+    ds = Dataset()
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = generate_uid()
+    ds.SeriesInstanceUID = seriesUID
+    ds.SeriesNumber = seriesNumber
+    ds.InstanceNumber = instanceNumber
+    ds.StudyDate = studyDate
+    ds.Modality = "MR"
+    ds.PixelData = pixels
+    ds["PixelData"].VR = "OB"
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+    buf = io.BytesIO()
+    pydicom.dcmwrite(buf, ds, enforce_file_format=True)
+    return buf.getvalue()
+
+
+def writeArchive(
+    fileSpec: str,
+    subjects: int,
+    series: int,
+    instances: int,
+    payloadBytes: int = 16384,
+    compression: int = zipfile.ZIP_DEFLATED,
+    seed: int = 0,
+) -> Tuple[int, int]:
+    """
+    Write a LONI-style ZIP of NACC subjects, series and instances.
+
+    Members are named ``root/NACC<id>/<series>/<id>_MR_<series>_br_raw_<n>.dcm``
+    so the uploader's default segment index resolves the subject and
+    acquisition labels. Pixel payloads are seeded pseudo-random bytes,
+    which compress about as poorly as real image data.
+
+    Parameters
+    ----------
+    fileSpec : str
+        Path of the archive to write.
+    subjects : int
+        Number of subjects.
+    series : int
+        Number of series per subject.
+    instances : int
+        Number of instances per series.
+    payloadBytes : int, optional
+        Size of each instance's pixel payload (default 16 KiB).
+    compression : int, optional
+        ZIP compression method of the members (default ZIP_DEFLATED).
+    seed : int, optional
+        Seed of the pixel payload generator (default 0).
+
+    Returns
+    -------
+    Tuple[int, int]
+        Number of instances written and total uncompressed member bytes.
+    """
+    rng = random.Random(seed)
+    count = 0
+    total = 0
+
+    with zipfile.ZipFile(fileSpec, "w", compression) as zf:
+        for subject in range(1, subjects + 1):
+            subjectID = f"NACC{subject:06d}"
+            for number in range(1, series + 1):
+                label = f"Series{number:03d}"
+                seriesUID = generate_uid()
+                for instance in range(1, instances + 1):
+                    data = instanceBytes(
+                        seriesUID, number, instance, rng.randbytes(payloadBytes)
+                    )
+                    zf.writestr(
+                        f"root/{subjectID}/{label}/"
+                        f"{subjectID}_MR_{label}_br_raw_{instance:05d}.dcm",
+                        data,
+                    )
+                    count += 1
+                    total += len(data)
+
+    return count, total
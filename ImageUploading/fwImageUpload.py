@@ -7,18 +7,55 @@ with consistent subject/session/acquisition organization.
 """
 
 import argparse
+import asyncio
+import hashlib
+import http.client
 import json
 import logging
 import os
+import queue
+import random
+import re
+import shutil
+import signal
+import sqlite3
+import struct
 import sys
 import tempfile
+import threading
+import time
+import uuid
 import zipfile
+from array import array
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import contextmanager, nullcontext, suppress
+from datetime import datetime, timedelta, timezone
+from functools import partial
 from os import path
-from typing import Dict, List, Optional
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+from urllib.parse import urlsplit
 
 import flywheel
 import pydicom
-from fw_client import FWClient
+from fw_client import ClientError, FWClient
 
 ###############################################################################
 # Logging Setup
@@ -31,126 +68,3473 @@ handler = logging.StreamHandler(sys.stdout)
 handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
 logger.addHandler(handler)
 
+# Header tags decoded per instance when grouping an archive into series. Only
+# these elements are parsed; pixel data is never read during the scan.
+SERIES_UID_TAG = (0x0020, 0x000E)
+STUDY_DATE_TAG = (0x0008, 0x0020)
+SERIES_NUMBER_TAG = (0x0020, 0x0011)
+SOP_INSTANCE_UID_TAG = (0x0008, 0x0018)
+SERIES_HEADER_TAGS = [
+    SOP_INSTANCE_UID_TAG,
+    SERIES_UID_TAG,
+    STUDY_DATE_TAG,
+    SERIES_NUMBER_TAG,
+]
+
+
+###############################################################################
+# Helpers
+###############################################################################
+
+
+def iterConcurrent(
+    items: Iterable[Any], fn: Callable[[Any], Any], workers: int
+) -> Iterator[Any]:
+    """
+    Map `fn` over `items` on a thread pool, yielding results as they finish.
+
+    At most ``2 * workers`` calls are in flight, so a slow consumer or a
+    very long `items` iterable never builds up an unbounded backlog of
+    results. With a single worker the map runs lazily on the calling thread
+    and results keep the input order.
+
+    Parameters
+    ----------
+    items : Iterable[Any]
+        Inputs, consumed incrementally.
+    fn : Callable[[Any], Any]
+        Function applied to each input.
+    workers : int
+        Number of threads.
+
+    Yields
+    ------
+    Any
+        Results of `fn`, in completion order when ``workers > 1``.
+    """
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = set()
+        for item in items:
+            pending.add(pool.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        for future in as_completed(pending):
+            yield future.result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def inventoryParent(level: str, container, projectID: str) -> Optional[str]:
+    """Return the parent container ID of a subject, session or acquisition."""
+    if level == "subject":
+        return projectID
+    return getattr(container.parents, "subject" if level == "session" else "session")
+
+
+def inventoryTimestamp(value) -> Optional[str]:
+    """Return an SDK timestamp as an ISO 8601 string."""
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+###############################################################################
+# Run Metrics
+###############################################################################
+
+
+class StageStats:
+    """
+    StageStats.
+
+    Counters of one pipeline stage. A stage may run on many threads at
+    once, so busy time (summed over threads) and wall time (first start to
+    last finish) are tracked separately.
+    """
+
+    __slots__ = ("busy", "bytes", "calls", "files", "first", "last")
+
+    def __init__(self):
+        self.calls = 0
+        self.busy = 0.0
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.files = 0
+        self.bytes = 0
+
+    @property
+    def wall(self) -> float:
+        """Seconds between the first start and the last finish."""
+        return 0.0 if self.first is None else self.last - self.first
+
+    def report(self) -> Dict[str, Any]:
+        """Return the stage counters and derived rates."""
+        wall = self.wall
+        return {
+            "calls": self.calls,
+            "busySeconds": round(self.busy, 3),
+            "wallSeconds": round(wall, 3),
+            "files": self.files,
+            "bytes": self.bytes,
+            "filesPerSecond": round(self.files / wall, 2) if wall else None,
+            "bytesPerSecond": round(self.bytes / wall) if wall else None,
+        }
+
+
+class RunMetrics:
+    """
+    RunMetrics.
+
+    Thread-safe instrumentation of an upload run: per-stage wall time, busy
+    time, file and byte volumes, plus named counters such as API calls and
+    retries. Counters named ``api.<call>`` are summed into the report's
+    ``apiCalls`` total.
+
+    Attributes
+    ----------
+    stages : Dict[str, StageStats]
+        Stage counters keyed by stage name, in first-use order.
+    counters : Dict[str, int]
+        Named event counters.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.clockStart = time.monotonic()
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Dict[str, int] = {"retries": 0}
+        self.progressStop: Optional[threading.Event] = None
+
+    @staticmethod
+    def pathFor(archiveSpec: str) -> str:
+        """Return the run report path kept next to an input archive."""
+        return f"{archiveSpec}.report.json"
+
+    @contextmanager
+    def stage(self, name: str, files: int = 0, nbytes: int = 0) -> Iterator[None]:
+        """Time one call of a stage and add its volume once it succeeds."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            with self.lock:
+                stats = self.stages.setdefault(name, StageStats())
+                stats.calls += 1
+                stats.busy += end - start
+                stats.first = start if stats.first is None else min(stats.first, start)
+                stats.last = end if stats.last is None else max(stats.last, end)
+        self.addVolume(name, files, nbytes)
+
+    def addVolume(self, name: str, files: int = 0, nbytes: int = 0) -> None:
+        """Add processed files and bytes to a stage."""
+        if not files and not nbytes:
+            return
+        with self.lock:
+            stats = self.stages.setdefault(name, StageStats())
+            stats.files += files
+            stats.bytes += nbytes
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Increment a named counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, **extra: Any) -> Dict[str, Any]:
+        """
+        Build the machine-readable run report.
+
+        Parameters
+        ----------
+        **extra : Any
+            Additional top-level entries, e.g. settings and series totals.
+
+        Returns
+        -------
+        Dict[str, Any]
+            JSON-serialisable report.
+        """
+        with self.lock:
+            counters = dict(sorted(self.counters.items()))
+            stages = {name: stats.report() for name, stats in self.stages.items()}
+
+        return {
+            "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            "elapsedSeconds": round(time.monotonic() - self.clockStart, 3),
+            "stages": stages,
+            "apiCalls": sum(v for k, v in counters.items() if k.startswith("api.")),
+            "retries": counters["retries"],
+            "counters": counters,
+            **extra,
+        }
+
+    def writeReport(self, fileSpec: str, **extra: Any) -> None:
+        """Write `report` as JSON to `fileSpec`."""
+        with open(fileSpec, "w") as fp:
+            json.dump(self.report(**extra), fp, indent=2)
+        logger.info(f"Run report written to {fileSpec}")
+
+    def summary(self) -> str:
+        """Return a one-line progress summary of every stage."""
+        with self.lock:
+            parts = [
+                f"{name} {stats.files} files/{stats.bytes / 1e6:.1f} MB"
+                + (
+                    f" ({stats.bytes / 1e6 / stats.wall:.1f} MB/s)"
+                    if stats.wall
+                    else ""
+                )
+                for name, stats in self.stages.items()
+            ]
+        return " | ".join(parts) or "starting"
+
+    def startProgress(self, interval: float) -> None:
+        """Log `summary` every `interval` seconds until `stopProgress`."""
+        self.progressStop = threading.Event()
+
+        def run(stop: threading.Event) -> None:
+            while not stop.wait(interval):
+                logger.info(f"Progress: {self.summary()}")
+
+        threading.Thread(target=run, args=(self.progressStop,), daemon=True).start()
+
+    def stopProgress(self) -> None:
+        """Stop the progress logger, if running."""
+        if self.progressStop is not None:
+            self.progressStop.set()
+            self.progressStop = None
+
+
+###############################################################################
+# HTTP Transport
+###############################################################################
+
+# Responses retried with backoff: throttling and transient server errors.
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Request body chunk size for streamed uploads.
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+class TransportError(OSError):
+    """
+    TransportError.
+
+    An HTTP request that failed permanently or ran out of retries.
+
+    Parameters
+    ----------
+    message : str
+        Description of the failure.
+    status : int, optional
+        HTTP status of the last response, if one was received.
+    """
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class ConnectionPool:
+    """
+    ConnectionPool.
+
+    Keep-alive HTTP(S) connections to one host, reused across threads.
+
+    Idle connections are kept on a stack, so the most recently used (and
+    least likely to have been closed by the server) is handed out first.
+    A connection is checked out for the length of one request and returned
+    only after its response has been read completely.
+
+    Parameters
+    ----------
+    baseURL : str
+        Scheme, host and optional port of the server.
+    connectTimeout : float
+        Seconds allowed for establishing a connection.
+    readTimeout : float
+        Seconds allowed for each send or receive on an open connection.
+    maxIdle : int
+        Maximum number of idle connections kept open.
+    """
+
+    def __init__(
+        self, baseURL: str, connectTimeout: float, readTimeout: float, maxIdle: int
+    ):
+        parts = urlsplit(baseURL)
+        self.secure = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.maxIdle = maxIdle
+        self.idle: List[http.client.HTTPConnection] = []
+        self.lock = threading.Lock()
+
+    def get(self) -> http.client.HTTPConnection:
+        """Check out an idle connection, or open a new one."""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+
+        connectionClass = (
+            http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+        )
+        conn = connectionClass(self.host, self.port, timeout=self.connectTimeout)
+        conn.connect()
+        conn.sock.settimeout(self.readTimeout)
+        return conn
+
+    def put(self, conn: http.client.HTTPConnection) -> None:
+        """Return a connection whose response has been fully read."""
+        with self.lock:
+            if len(self.idle) < self.maxIdle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self) -> None:
+        """Close every idle connection."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class AdaptiveLimiter:
+    """
+    AdaptiveLimiter.
+
+    Additive-increase/multiplicative-decrease limit on concurrent requests.
+
+    Every successful request whose normalised latency stays within
+    `tolerance` times the best smoothed latency seen so far raises the limit
+    by ``1 / limit``, i.e. by about one per round of requests. A failure or
+    a latency above that bound multiplies the limit by `decrease`, at most
+    once per `cooldown` seconds so one burst of errors counts as a single
+    congestion signal.
+
+    Parameters
+    ----------
+    maxLimit : int
+        Upper bound and starting value of the limit.
+    minLimit : int, optional
+        Lower bound of the limit (default 1).
+    tolerance : float, optional
+        Allowed ratio of smoothed to baseline latency (default 2.0).
+    decrease : float, optional
+        Factor applied to the limit on congestion (default 0.5).
+    cooldown : float, optional
+        Minimum seconds between two decreases (default 1.0).
+
+    Attributes
+    ----------
+    limit : float
+        Current concurrency limit; ``int(limit)`` requests may be in flight.
+    """
+
+    def __init__(
+        self,
+        maxLimit: int,
+        minLimit: int = 1,
+        tolerance: float = 2.0,
+        decrease: float = 0.5,
+        cooldown: float = 1.0,
+    ):
+        self.maxLimit = max(1, maxLimit)
+        self.minLimit = max(1, min(minLimit, self.maxLimit))
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(self.maxLimit)
+        self.inFlight = 0
+        self.smoothed: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self.lastDecrease = float("-inf")
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold one of the `limit` request slots for the ``with`` block."""
+        with self.condition:
+            while self.inFlight >= int(self.limit):
+                self.condition.wait()
+            self.inFlight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.inFlight -= 1
+                self.condition.notify_all()
+
+    def record(self, seconds: float, ok: bool, cost: float = 1.0) -> None:
+        """
+        Adjust the limit after a request.
+
+        Parameters
+        ----------
+        seconds : float
+            Duration of the request.
+        ok : bool
+            Whether the request succeeded.
+        cost : float, optional
+            Size of the request in arbitrary units (e.g. MiB), used to
+            normalise its latency (default 1).
+        """
+        with self.condition:
+            congested = not ok
+            if ok:
+                latency = seconds / max(cost, 1.0)
+                self.smoothed = (
+                    latency
+                    if self.smoothed is None
+                    else 0.8 * self.smoothed + 0.2 * latency
+                )
+                if self.baseline is None or self.smoothed < self.baseline:
+                    self.baseline = self.smoothed
+                congested = self.smoothed > self.tolerance * self.baseline
+
+            now = time.monotonic()
+            if congested:
+                if now - self.lastDecrease >= self.cooldown:
+                    self.limit = max(self.minLimit, self.limit * self.decrease)
+                    self.lastDecrease = now
+            else:
+                self.limit = min(self.maxLimit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class Transport:
+    """
+    Transport.
+
+    Retrying HTTP transport for bulk uploads to Flywheel.
+
+    Requests run on pooled keep-alive connections with connect and read
+    timeouts. Connection errors, timeouts and `RETRYABLE_STATUSES` are
+    retried up to `retries` times with exponential backoff and full jitter
+    (a ``Retry-After`` header sets the minimum wait). An `AdaptiveLimiter`
+    bounds the number of requests in flight and backs off when errors or
+    latency rise.
+
+    Parameters
+    ----------
+    baseURL : str
+        Server URL, e.g. ``https://example.flywheel.io``.
+    headers : Dict[str, str], optional
+        Headers sent with every request, typically authorization.
+    concurrency : int, optional
+        Maximum number of requests in flight (default 4).
+    connectTimeout : float, optional
+        Seconds allowed to open a connection (default 10).
+    readTimeout : float, optional
+        Seconds allowed for each socket send or receive (default 300).
+    retries : int, optional
+        Retries after the first attempt (default 4).
+    backoff : float, optional
+        Base delay in seconds of the exponential backoff (default 0.5).
+    maxBackoff : float, optional
+        Upper bound of a single backoff delay (default 30).
+    metrics : RunMetrics, optional
+        Collector counting retries.
+
+    Attributes
+    ----------
+    pool : ConnectionPool
+        Keep-alive connections to the server.
+    limiter : AdaptiveLimiter
+        Concurrency controller of the transport.
+    """
+
+    def __init__(
+        self,
+        baseURL: str,
+        headers: Optional[Dict[str, str]] = None,
+        concurrency: int = 4,
+        connectTimeout: float = 10.0,
+        readTimeout: float = 300.0,
+        retries: int = 4,
+        backoff: float = 0.5,
+        maxBackoff: float = 30.0,
+        metrics: Optional[RunMetrics] = None,
+    ):
+        self.headers = dict(headers or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.metrics = metrics
+        self.pool = ConnectionPool(baseURL, connectTimeout, readTimeout, concurrency)
+        self.limiter = AdaptiveLimiter(concurrency)
+
+    @classmethod
+    def forClient(cls, client: FWClient, **kwargs: Any) -> "Transport":
+        """Build a transport using the URL and credentials of a REST client."""
+        return cls(
+            str(client.base_url),
+            {"Authorization": client.headers["authorization"]},
+            **kwargs,
+        )
+
+    def backoffDelay(self, attempt: int, retryAfter: Optional[str] = None) -> float:
+        """Return the full-jitter delay before retry number `attempt` + 1."""
+        delay = random.uniform(0, min(self.maxBackoff, self.backoff * 2**attempt))
+        if retryAfter and retryAfter.isdigit():
+            delay = max(delay, min(self.maxBackoff, float(retryAfter)))
+        return delay
+
+    def send(
+        self,
+        method: str,
+        target: str,
+        headers: Dict[str, str],
+        body: Callable[[http.client.HTTPConnection], None],
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        """Send one request on a pooled connection and read its response."""
+        conn = self.pool.get()
+        try:
+            conn.putrequest(method, target, skip_accept_encoding=True)
+            for key, value in {**self.headers, **headers}.items():
+                conn.putheader(key, value)
+            conn.endheaders()
+            body(conn)
+            resp = conn.getresponse()
+            data = resp.read()
+        except BaseException:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self.pool.put(conn)
+        return resp.status, dict(resp.headers), data
+
+    def request(
+        self,
+        method: str,
+        target: str,
+        headers: Optional[Dict[str, str]] = None,
+        body: Optional[Callable[[http.client.HTTPConnection], None]] = None,
+        cost: float = 1.0,
+    ) -> bytes:
+        """
+        Send a request, retrying transient failures.
+
+        Parameters
+        ----------
+        method : str
+            HTTP method.
+        target : str
+            Request path, relative to the base URL.
+        headers : Dict[str, str], optional
+            Extra request headers.
+        body : Callable[[http.client.HTTPConnection], None], optional
+            Writes the request body to the connection. It is called again on
+            every attempt, so it must be able to resend the body from the
+            start.
+        cost : float, optional
+            Relative size of the request for the adaptive limiter.
+
+        Returns
+        -------
+        bytes
+            Body of the successful response.
+
+        Raises
+        ------
+        TransportError
+            On a non-retryable error status, or when retries run out.
+        """
+        headers = headers or {}
+        body = body or (lambda conn: None)
+
+        for attempt in range(self.retries + 1):
+            status = None
+            retryAfter = None
+            with self.limiter.slot():
+                start = time.monotonic()
+                try:
+                    status, respHeaders, data = self.send(method, target, headers, body)
+                except (OSError, http.client.HTTPException) as e:
+                    error = f"{type(e).__name__}: {e}"
+                else:
+                    retryAfter = respHeaders.get("Retry-After")
+                    error = f"HTTP {status}: {data[:200]!r}"
+                ok = status is not None and status < 400
+                congested = status is None or status in RETRYABLE_STATUSES
+                self.limiter.record(time.monotonic() - start, not congested, cost)
+
+            if ok:
+                return data
+            if status is not None and status not in RETRYABLE_STATUSES:
+                raise TransportError(f"{method} {target} failed: {error}", status)
+            if attempt == self.retries:
+                break
+
+            if self.metrics is not None:
+                self.metrics.count("retries")
+            delay = self.backoffDelay(attempt, retryAfter)
+            logger.warning(
+                f"{method} {target} failed ({error}); retry {attempt + 1} of "
+                f"{self.retries} in {delay:.1f}s"
+            )
+            time.sleep(delay)
+
+        raise TransportError(
+            f"{method} {target} failed after {self.retries + 1} attempts: {error}",
+            status,
+        )
+
+    def json(self, method: str, target: str, payload: Any = None) -> Any:
+        """Send a JSON request and decode the JSON response."""
+        data = b"" if payload is None else json.dumps(payload).encode()
+        headers = {"Content-Length": str(len(data))}
+        if payload is not None:
+            headers["Content-Type"] = "application/json"
+        return json.loads(
+            self.request(method, target, headers, lambda conn: conn.send(data))
+        )
+
+    def upload(
+        self,
+        target: str,
+        name: str,
+        fp: BinaryIO,
+        size: int,
+        metadata: Optional[Dict[str, Any]] = None,
+        contentType: str = "application/octet-stream",
+    ) -> Any:
+        """
+        Stream a file as a multipart form upload.
+
+        The form carries a ``metadata`` JSON field and the ``file`` itself,
+        as expected by Flywheel's container file upload endpoints. The file
+        is read from `fp` in chunks and rewound before every attempt.
+
+        Parameters
+        ----------
+        target : str
+            Upload path, e.g. ``/api/acquisitions/<id>/files``.
+        name : str
+            File name stored in Flywheel.
+        fp : BinaryIO
+            Seekable file object positioned at the start of the content.
+        size : int
+            Content size in bytes.
+        metadata : Dict[str, Any], optional
+            File metadata sent in the form.
+        contentType : str, optional
+            MIME type of the file.
+
+        Returns
+        -------
+        Any
+            Decoded JSON response.
+        """
+        boundary = uuid.uuid4().hex
+        head = (
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="metadata"\r\n\r\n'
+            f"{json.dumps(metadata or {})}\r\n"
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            f"Content-Type: {contentType}\r\n\r\n"
+        ).encode()
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        start = fp.tell()
+
+        def body(conn: http.client.HTTPConnection) -> None:
+            fp.seek(start)
+            conn.send(head)
+            while chunk := fp.read(UPLOAD_CHUNK_SIZE):
+                conn.send(chunk)
+            conn.send(tail)
+
+        headers = {
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(len(head) + size + len(tail)),
+        }
+        return json.loads(
+            self.request("POST", target, headers, body, cost=size / (1 << 20))
+        )
+
+    def close(self) -> None:
+        """Close pooled connections."""
+        self.pool.close()
+
 
 ###############################################################################
 # Flywheel Connector
 ###############################################################################
 
 
-class FlywheelConnector:
-    """
-    FlywheelConnector.
+class FlywheelConnector:
+    """
+    FlywheelConnector.
+
+    Provides a convenience wrapper around:
+
+      • The Flywheel REST API client (FWClient)
+      • The official Flywheel Python SDK (flywheel.Client)
+
+    It centralizes retrieval and iteration over projects, subjects, sessions,
+    acquisitions, and file objects.
+
+    Parameters
+    ----------
+    api_key : str
+        A valid Flywheel API key used for authentication.
+    metrics : RunMetrics, optional
+        Collector counting the API calls issued by the connector.
+
+    Attributes
+    ----------
+    APIKey : str
+        Stored Flywheel API token.
+    RestClient : FWClient
+        Wrapper around Flywheel REST API.
+    SDKClient : flywheel.Client
+        Official Flywheel SDK client.
+    project : flywheel.Project or None
+        Selected project object after calling `setProject`.
+    imageList : List
+        Collected list of file objects from acquisitions, or of cached file
+        rows when collected through an `InventoryCache`.
+    sessionList : List
+        Collected list of session objects, or of cached session rows when
+        collected through an `InventoryCache`.
+    subjectIndex : Dict[str, flywheel.Subject]
+        Project subjects keyed by label.
+    sessionIndex : Dict[Tuple[str, str], flywheel.Session]
+        Project sessions keyed by (subject ID, label).
+    acquisitionIndex : Dict[Tuple[str, str], flywheel.Acquisition]
+        Project acquisitions keyed by (session ID, label).
+    indexLoaded : bool
+        Whether the hierarchy index has been loaded for the current project.
+    metrics : RunMetrics or None
+        Collector of API call counts, if any.
+    transport : Transport or None
+        Retrying transport used for file uploads. Uploads go through the
+        SDK when it is not set.
+    uploadSlots : threading.BoundedSemaphore or None
+        Bound on concurrent SDK uploads, if set by `limitUploads`.
+    """
+
+    metrics: Optional[RunMetrics] = None
+    transport: Optional[Transport] = None
+    uploadSlots: Optional[threading.BoundedSemaphore] = None
+
+    def __init__(self, api_key: str, metrics: Optional[RunMetrics] = None):
+        self.APIKey: str = api_key
+        self.project = None
+        self.metrics = metrics
+        self.transport: Optional[Transport] = None
+        self.uploadSlots: Optional[threading.BoundedSemaphore] = None
+
+        self.RestClient: FWClient = FWClient(api_key=self.APIKey)
+        self.SDKClient = flywheel.Client(self.APIKey)
+
+        self.imageList: List = []
+        self.sessionList: List = []
+
+        self.subjectIndex: Dict[str, Any] = {}
+        self.sessionIndex: Dict[Tuple[str, str], Any] = {}
+        self.acquisitionIndex: Dict[Tuple[str, str], Any] = {}
+        self.indexLoaded = False
+        self.indexLock = threading.RLock()
+
+    def countCall(self, name: str) -> None:
+        """Count one API call in `metrics`, if collecting."""
+        if self.metrics is not None:
+            self.metrics.count(f"api.{name}")
+
+    def enableTransport(self, **kwargs: Any) -> Transport:
+        """
+        Send file uploads through a pooled, retrying `Transport`.
+
+        Parameters
+        ----------
+        **kwargs : Any
+            Options of `Transport`, e.g. ``concurrency`` or ``retries``.
+
+        Returns
+        -------
+        Transport
+            The transport now used by `uploadFile`.
+        """
+        kwargs.setdefault("metrics", self.metrics)
+        self.transport = Transport.forClient(self.RestClient, **kwargs)
+        return self.transport
+
+    def limitUploads(self, limit: int) -> None:
+        """Allow at most `limit` SDK uploads at a time, across all threads."""
+        self.uploadSlots = threading.BoundedSemaphore(max(1, limit))
+
+    def uploadFile(
+        self, acquisition, spec: flywheel.FileSpec, metadata: Optional[Dict] = None
+    ) -> None:
+        """
+        Upload a file to an acquisition.
+
+        Parameters
+        ----------
+        acquisition : flywheel.Acquisition
+            Destination acquisition.
+        spec : flywheel.FileSpec
+            File name, seekable contents, content type and size.
+        metadata : Dict, optional
+            File metadata stored with the upload.
+        """
+        if self.transport is None:
+            with self.uploadSlots or nullcontext():
+                acquisition.upload_file(spec, metadata=metadata)
+            return
+
+        self.transport.upload(
+            f"/api/acquisitions/{acquisition.id}/files",
+            spec.name,
+            spec.contents,
+            spec.size,
+            metadata,
+            spec.content_type or "application/octet-stream",
+        )
+
+    def setProject(
+        self,
+        project_name: str,
+        cache: Optional["ProjectCache"] = None,
+        ttl: Optional[timedelta] = None,
+    ) -> None:
+        """
+        Locate and set the Flywheel project matching a prefix string.
+
+        A fresh entry of `cache` for this API host and prefix is used without
+        listing projects. Otherwise the projects are listed with a server-side
+        label filter, falling back to the full list if the server rejects it,
+        and the match is stored in `cache`.
+
+        Parameters
+        ----------
+        project_name : str
+            Prefix of the Flywheel project label. The first matching project
+            returned by the REST API list will be selected.
+        cache : ProjectCache, optional
+            Persistent cache of resolved projects.
+        ttl : timedelta, optional
+            Age after which a cached entry is looked up again (default
+            `PROJECT_CACHE_TTL`).
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        Exception
+            If project listing or retrieval fails.
+        ValueError
+            If no project label begins with the provided prefix.
+        """
+        host = self.apiHost()
+        projectID = None
+        if cache:
+            projectID = cache.lookup(host, project_name, ttl or PROJECT_CACHE_TTL)
+
+        if projectID:
+            try:
+                self.countCall("getProject")
+                self.project = self.SDKClient.get_project(projectID)
+            except flywheel.ApiException as e:
+                logger.info(f"Cached project {projectID} is stale ({e.status})")
+                cache.forget(host, project_name)
+                projectID = None
+
+        if not projectID:
+            projectID = self.findProjectID(project_name)
+            try:
+                self.countCall("getProject")
+                self.project = self.SDKClient.get_project(projectID)
+            except Exception as e:
+                logger.error(f"Cannot fetch project '{project_name}' via SDK: {e}")
+                raise
+            if cache:
+                cache.store(host, project_name, projectID, self.project.label)
+
+        logger.info(f"Project set: {self.project.label}")
+        self.indexLoaded = False
+
+    def apiHost(self) -> str:
+        """Return the host of the Flywheel instance, keying cached lookups."""
+        baseURL = str(self.RestClient.base_url)
+        return urlsplit(baseURL).netloc or baseURL
+
+    def findProjectID(self, project_name: str) -> str:
+        """
+        Return the ID of the first project whose label starts with a prefix.
+
+        Parameters
+        ----------
+        project_name : str
+            Prefix of the Flywheel project label.
+
+        Returns
+        -------
+        str
+            Project ID.
+
+        Raises
+        ------
+        Exception
+            If project listing fails.
+        ValueError
+            If no project label begins with the provided prefix.
+        """
+        project_list = None
+        if "," not in project_name:
+            # Filters are comma separated, so such a prefix is matched locally.
+            try:
+                self.countCall("listProjects")
+                project_list = self.RestClient.get(
+                    "/api/projects",
+                    params={"filter": f"label=~^{re.escape(project_name)}"},
+                )
+            except ClientError as e:
+                logger.info(f"Filtered project lookup failed, listing all: {e}")
+
+        if project_list is None:
+            try:
+                self.countCall("listProjects")
+                project_list = self.RestClient.get("/api/projects")
+            except Exception as e:
+                logger.error(f"Error retrieving project list: {e}")
+                raise
+
+        # Servers ignoring the filter return every project: check locally too.
+        for p in project_list:
+            if p.label.startswith(project_name):
+                return p._id  # noqa: SLF001
+
+        raise ValueError(f"No project found starting with '{project_name}'")
+
+    def loadHierarchyIndex(self) -> None:
+        """
+        Load every subject, session and acquisition label of the project.
+
+        Three paginated listings replace the per-series `find_first` calls:
+        subjects are keyed by label, sessions by (subject ID, label) and
+        acquisitions by (session ID, label). When a label occurs more than
+        once under the same parent, the first container listed is kept.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        RuntimeError
+            If no project has been initialized.
+        Exception
+            If any SDK listing fails.
+        """
+        if not self.project:
+            raise RuntimeError("Project not initialized before indexing.")
+
+        with self.indexLock:
+            self.subjectIndex = {}
+            self.sessionIndex = {}
+            self.acquisitionIndex = {}
+
+            self.countCall("listSubjects")
+            self.countCall("listSessions")
+            self.countCall("listAcquisitions")
+            try:
+                for subject in self.project.subjects.iter():
+                    self.subjectIndex.setdefault(subject.label, subject)
+
+                for session in self.project.sessions.iter():
+                    key = (session.parents.subject, session.label)
+                    self.sessionIndex.setdefault(key, session)
+
+                for acq in self.SDKClient.acquisitions.iter_find(
+                    f"parents.project={self.project.id}"
+                ):
+                    key = (acq.parents.session, acq.label)
+                    self.acquisitionIndex.setdefault(key, acq)
+            except Exception as e:
+                logger.error(f"Error loading project hierarchy: {e}")
+                raise
+
+            self.indexLoaded = True
+
+        logger.info(
+            f"Indexed {len(self.subjectIndex)} subjects, "
+            f"{len(self.sessionIndex)} sessions and "
+            f"{len(self.acquisitionIndex)} acquisitions."
+        )
+
+    def getSubject(self, label: str):
+        """
+        Return the project subject with `label`, creating it if missing.
+
+        Parameters
+        ----------
+        label : str
+            Subject label.
+
+        Returns
+        -------
+        flywheel.Subject
+            Existing or newly created subject.
+        """
+        with self.indexLock:
+            if not self.indexLoaded:
+                self.loadHierarchyIndex()
+
+            subject = self.subjectIndex.get(label)
+            if subject is None:
+                logger.info(f"Creating new subject: {label}")
+                self.countCall("addSubject")
+                subject = self.project.add_subject(label=label)
+                self.subjectIndex[label] = subject
+            return subject
+
+    def getSession(self, subject, label: str):
+        """
+        Return the session of `subject` with `label`, creating it if missing.
+
+        Parameters
+        ----------
+        subject : flywheel.Subject
+            Parent subject.
+        label : str
+            Session label.
+
+        Returns
+        -------
+        flywheel.Session
+            Existing or newly created session.
+        """
+        with self.indexLock:
+            if not self.indexLoaded:
+                self.loadHierarchyIndex()
+
+            key = (subject.id, label)
+            session = self.sessionIndex.get(key)
+            if session is None:
+                logger.info(f"Creating session: {label}")
+                self.countCall("addSession")
+                session = subject.add_session(label=label)
+                self.sessionIndex[key] = session
+            return session
+
+    def getAcquisition(self, session, label: str):
+        """
+        Return the acquisition of `session` with `label`, creating it if missing.
+
+        Parameters
+        ----------
+        session : flywheel.Session
+            Parent session.
+        label : str
+            Acquisition label.
+
+        Returns
+        -------
+        flywheel.Acquisition
+            Existing or newly created acquisition.
+        """
+        with self.indexLock:
+            if not self.indexLoaded:
+                self.loadHierarchyIndex()
+
+            key = (session.id, label)
+            acquisition = self.acquisitionIndex.get(key)
+            if acquisition is None:
+                logger.info(f"Creating acquisition: {label}")
+                self.countCall("addAcquisition")
+                acquisition = session.add_acquisition(label=label)
+                self.acquisitionIndex[key] = acquisition
+            return acquisition
+
+    def subjectFiles(self, subject) -> List:
+        """Return every acquisition file object below one subject."""
+        return [
+            f
+            for session in subject.sessions.iter()
+            for acq in session.acquisitions.iter()
+            for f in acq.files
+        ]
+
+    def IterImageInformation(self, workers: int = 1) -> Iterator:
+        """
+        Yield Flywheel file objects from every acquisition in the project.
+
+        With more than one worker, subjects are fetched concurrently on a
+        thread pool sharing the SDK client's keep-alive connection pool,
+        and each subject's files are yielded as soon as that subject has
+        been crawled, so callers can start work before the crawl finishes.
+        Files are then grouped by subject, but subjects arrive in completion
+        order.
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of subjects fetched concurrently (default 1).
+
+        Yields
+        ------
+        flywheel.FileEntry
+            File objects as they are collected.
+
+        Raises
+        ------
+        RuntimeError
+            If no project has been initialized.
+        Exception
+            If any SDK iteration fails.
+        """
+        if not self.project:
+            raise RuntimeError("Project not initialized before image collection.")
+
+        try:
+            for files in iterConcurrent(
+                self.project.subjects.iter(), self.subjectFiles, workers
+            ):
+                yield from files
+        except Exception as e:
+            logger.error(f"Error collecting image information: {e}")
+            raise
+
+    def IterSessionInformation(self, workers: int = 1) -> Iterator:
+        """
+        Yield session objects from every subject in the selected project.
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of subjects fetched concurrently (default 1).
+
+        Yields
+        ------
+        flywheel.Session
+            Sessions as they are collected, in subject completion order.
+
+        Raises
+        ------
+        RuntimeError
+            If project is not set.
+        Exception
+            If SDK traversal fails.
+        """
+        if not self.project:
+            raise RuntimeError("Project not initialized before session collection.")
+
+        try:
+            for sessions in iterConcurrent(
+                self.project.subjects.iter(),
+                lambda subject: list(subject.sessions.iter()),
+                workers,
+            ):
+                yield from sessions
+        except Exception as e:
+            logger.error(f"Error collecting session information: {e}")
+            raise
+
+    def CollectImageInformation(
+        self, workers: int = 1, inventory: Optional["InventoryCache"] = None
+    ) -> None:
+        """
+        Collect all Flywheel file objects from every acquisition in the project.
+
+        With an `inventory`, the cache is brought up to date by a delta
+        `SyncInventory` and `imageList` holds its acquisition file rows
+        (``container_id``, ``name``, ``size``, ``modified``) instead, so the
+        cost of a refresh follows the changes since the last sync.
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of subjects fetched concurrently (default 1). Not used
+            with an `inventory`.
+        inventory : InventoryCache, optional
+            Local inventory cache to collect from.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        RuntimeError
+            If no project has been initialized.
+        Exception
+            If any SDK iteration fails.
+        """
+        if inventory is not None:
+            self.SyncInventory(inventory)
+            self.imageList = inventory.files(self.project.id)
+            return
+        self.imageList = []
+        self.imageList.extend(self.IterImageInformation(workers))
+
+    def CollectSessionInformation(
+        self, workers: int = 1, inventory: Optional["InventoryCache"] = None
+    ) -> None:
+        """
+        Collect all session objects from every subject in the selected project.
+
+        With an `inventory`, the cache is brought up to date by a delta
+        `SyncInventory` and `sessionList` holds its session rows (``id``,
+        ``parent_id``, ``label``, ``modified``) instead.
+
+        Parameters
+        ----------
+        workers : int, optional
+            Number of subjects fetched concurrently (default 1). Not used
+            with an `inventory`.
+        inventory : InventoryCache, optional
+            Local inventory cache to collect from.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        RuntimeError
+            If project is not set.
+        Exception
+            If SDK traversal fails.
+        """
+        if inventory is not None:
+            self.SyncInventory(inventory)
+            self.sessionList = inventory.containers(self.project.id, "session")
+            return
+        self.sessionList = []
+        self.sessionList.extend(self.IterSessionInformation(workers))
+
+    def SeedInstanceIndex(self, index: "InstanceIndex") -> int:
+        """
+        Record the series already uploaded to the project in an index.
+
+        Series ZIPs uploaded by `UploadImageData` carry their
+        SeriesInstanceUID and content digest in the file's ``info``; one
+        listing of the project's acquisitions adds every such file to
+        `index`, so series sent from another host are skipped too. The
+        project is marked as seeded in the index.
+
+        Parameters
+        ----------
+        index : InstanceIndex
+            Index to update.
+
+        Returns
+        -------
+        int
+            Number of series recorded.
+
+        Raises
+        ------
+        RuntimeError
+            If no project has been initialized.
+        Exception
+            If the SDK listing fails.
+        """
+        if not self.project:
+            raise RuntimeError("Project not initialized before seeding the index.")
+
+        found = 0
+        try:
+            self.countCall("listAcquisitions")
+            for acquisition in self.SDKClient.acquisitions.iter_find(
+                f"parents.project={self.project.id}"
+            ):
+                for f in acquisition.files or []:
+                    info = f.info or {}
+                    digest = info.get("seriesDigest")
+                    if digest:
+                        index.addSeries(
+                            info.get("SeriesInstanceUID", ""), digest, acquisition.id
+                        )
+                        found += 1
+        except Exception as e:
+            logger.error(f"Error seeding the instance index: {e}")
+            raise
+
+        index.markSeeded(self.project.id)
+        logger.info(f"Instance index seeded with {found} series from the project.")
+        return found
+
+    def SyncInventory(self, cache: "InventoryCache", full: bool = False) -> int:
+        """
+        Bring the local inventory cache of the project up to date.
+
+        The first sync of a project, or any sync with `full`, lists every
+        subject, session and acquisition and replaces the cached rows. Later
+        syncs add a ``modified>`` filter on the previous sync time to the
+        same three listings, so their cost follows the number of changed
+        containers rather than the size of the project. Files are cached
+        with the container they are attached to and are refreshed whenever
+        that container is modified.
+
+        Deletions are only picked up by a full sync.
+
+        Parameters
+        ----------
+        cache : InventoryCache
+            Cache to update.
+        full : bool, optional
+            Re-list the whole project even if it was synced before.
+
+        Returns
+        -------
+        int
+            Number of containers fetched.
+
+        Raises
+        ------
+        RuntimeError
+            If no project has been initialized.
+        Exception
+            If any SDK listing fails.
+        """
+        if not self.project:
+            raise RuntimeError("Project not initialized before inventory sync.")
+
+        projectID = self.project.id
+        since = None if full else cache.lastSync(projectID)
+        started = datetime.now(timezone.utc) - INVENTORY_SYNC_MARGIN
+        filters = [f"modified>{since}"] if since else []
+
+        try:
+            listings = (
+                ("subject", self.project.subjects.iter_find(*filters)),
+                ("session", self.project.sessions.iter_find(*filters)),
+                (
+                    "acquisition",
+                    self.SDKClient.acquisitions.iter_find(
+                        f"parents.project={projectID}", *filters
+                    ),
+                ),
+            )
+            containers = []
+            files = []
+            for level, listing in listings:
+                for container in listing:
+                    containers.append(
+                        (
+                            container.id,
+                            level,
+                            inventoryParent(level, container, projectID),
+                            container.label,
+                            inventoryTimestamp(container.modified),
+                        )
+                    )
+                    files.extend(
+                        (
+                            container.id,
+                            f.name,
+                            f.size,
+                            inventoryTimestamp(f.modified),
+                        )
+                        for f in container.files or []
+                    )
+        except Exception as e:
+            logger.error(f"Error syncing project inventory: {e}")
+            raise
+
+        cache.update(
+            projectID,
+            containers,
+            files,
+            started.strftime("%Y-%m-%dT%H:%M:%S"),
+            replace=since is None,
+        )
+        logger.info(
+            f"{'Delta' if since else 'Full'} inventory sync fetched "
+            f"{len(containers)} containers and {len(files)} files."
+        )
+        return len(containers)
+
+
+###############################################################################
+# Local SQLite Stores
+###############################################################################
+
+
+def cacheDirectory() -> str:
+    """Return the per-user cache directory of the uploader, creating it."""
+    root = os.getenv("XDG_CACHE_HOME") or path.join(path.expanduser("~"), ".cache")
+    directory = path.join(root, "fwImageUpload")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class SqliteStore:
+    """
+    SqliteStore.
+
+    Thread-safe SQLite file shared by the uploader's local stores. The
+    connection is opened in WAL mode and may be used from any thread; every
+    statement runs under `lock`.
+
+    Subclasses list their ``CREATE ... IF NOT EXISTS`` statements in
+    `SCHEMA` and name themselves in `DESCRIPTION` for error messages.
+
+    Parameters
+    ----------
+    fileSpec : str
+        Path of the SQLite file. Created if it does not exist.
+
+    Attributes
+    ----------
+    fileSpec : str
+        Path of the SQLite file.
+    """
+
+    SCHEMA: Tuple[str, ...] = ()
+    DESCRIPTION = "SQLite store"
+
+    def __init__(self, fileSpec: str):
+        self.fileSpec = fileSpec
+        self.lock = threading.Lock()
+
+        db = None
+        try:
+            db = sqlite3.connect(fileSpec, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                db.execute(statement)
+            db.commit()
+        except sqlite3.Error as e:
+            if db is not None:
+                db.close()
+            logger.error(f"Could not open {self.DESCRIPTION} '{fileSpec}': {e}")
+            raise
+        self.db = db
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+        with self.lock:
+            self.db.close()
+
+
+###############################################################################
+# Upload Journal
+###############################################################################
+
+
+class UploadJournal(SqliteStore):
+    """
+    UploadJournal.
+
+    SQLite record of the series uploaded from an archive, used to resume an
+    interrupted run without re-packaging or re-uploading finished series.
+
+    Each row is keyed by SeriesInstanceUID and stores the instance count, a
+    content digest of the series and the Flywheel acquisition it landed in.
+    A series is only considered done when count and digest still match, so
+    series that gained, lost or changed instances are uploaded again.
+
+    Parameters
+    ----------
+    fileSpec : str
+        Path of the SQLite journal file. Created if it does not exist.
+
+    Attributes
+    ----------
+    fileSpec : str
+        Path of the journal file.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS series ("
+        " series_uid TEXT PRIMARY KEY,"
+        " instance_count INTEGER NOT NULL,"
+        " digest TEXT NOT NULL,"
+        " acquisition_id TEXT,"
+        " status TEXT NOT NULL,"
+        " updated REAL NOT NULL)",
+    )
+    DESCRIPTION = "upload journal"
+
+    @staticmethod
+    def pathFor(archiveSpec: str) -> str:
+        """Return the journal path kept next to an input archive."""
+        return f"{archiveSpec}.journal.sqlite"
+
+    def completedAcquisition(
+        self, seriesUID: str, instanceCount: int, digest: str
+    ) -> Optional[str]:
+        """
+        Return the acquisition ID of an unchanged, completed series.
+
+        Parameters
+        ----------
+        seriesUID : str
+            SeriesInstanceUID of the series.
+        instanceCount : int
+            Number of instances currently in the archive for the series.
+        digest : str
+            Current content digest of the series.
+
+        Returns
+        -------
+        Optional[str]
+            Acquisition ID if the series was uploaded with the same count and
+            digest, otherwise None.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT acquisition_id FROM series WHERE series_uid = ?"
+                " AND instance_count = ? AND digest = ? AND status = 'complete'",
+                (seriesUID, instanceCount, digest),
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(
+        self,
+        seriesUID: str,
+        instanceCount: int,
+        digest: str,
+        status: str,
+        acquisitionID: Optional[str] = None,
+    ) -> None:
+        """
+        Store the outcome of one series, replacing any earlier entry.
+
+        Parameters
+        ----------
+        seriesUID : str
+            SeriesInstanceUID of the series.
+        instanceCount : int
+            Number of instances uploaded.
+        digest : str
+            Content digest of the series.
+        status : str
+            Either "complete" or "failed".
+        acquisitionID : Optional[str]
+            Flywheel acquisition the series was uploaded to.
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?)",
+                (seriesUID, instanceCount, digest, acquisitionID, status, time.time()),
+            )
+            self.db.commit()
+
+
+###############################################################################
+# Inventory Cache
+###############################################################################
+
+# Flywheel container levels held in the inventory cache, parents first.
+INVENTORY_LEVELS = ("subject", "session", "acquisition")
+
+# A delta sync asks for containers modified after the previous sync started,
+# less this margin, so clock skew between this host and Flywheel cannot drop
+# a change. Containers inside the margin are simply fetched twice.
+INVENTORY_SYNC_MARGIN = timedelta(minutes=5)
+
+
+class InventoryCache(SqliteStore):
+    """
+    InventoryCache.
+
+    Persistent local copy of a project's container and file inventory, so
+    repeated inventories only fetch what changed since the previous sync.
+
+    Containers are stored with their level, parent ID, label and modified
+    timestamp; files with their parent container, name, size and modified
+    timestamp. The start time of each sync is recorded per project and is
+    the lower bound of the ``modified>`` filter used by the next one.
+
+    Modified-time filters cannot report deletions: containers or files
+    removed from Flywheel stay cached until a full sync replaces the
+    project's rows.
+
+    Parameters
+    ----------
+    fileSpec : str
+        Path of the SQLite cache file. Created if it does not exist.
+
+    Attributes
+    ----------
+    fileSpec : str
+        Path of the cache file.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS sync ("
+        " project_id TEXT PRIMARY KEY,"
+        " last_sync TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS containers ("
+        " id TEXT PRIMARY KEY,"
+        " project_id TEXT NOT NULL,"
+        " level TEXT NOT NULL,"
+        " parent_id TEXT,"
+        " label TEXT,"
+        " modified TEXT)",
+        "CREATE INDEX IF NOT EXISTS containers_project"
+        " ON containers (project_id, level)",
+        "CREATE TABLE IF NOT EXISTS files ("
+        " container_id TEXT NOT NULL,"
+        " name TEXT NOT NULL,"
+        " size INTEGER,"
+        " modified TEXT,"
+        " PRIMARY KEY (container_id, name))",
+    )
+    DESCRIPTION = "inventory cache"
+
+    @staticmethod
+    def pathFor(projectID: str) -> str:
+        """Return the per-user inventory cache path of a project."""
+        return path.join(cacheDirectory(), f"inventory-{projectID}.sqlite")
+
+    def lastSync(self, projectID: str) -> Optional[str]:
+        """Return the start time of the last sync of a project, if any."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT last_sync FROM sync WHERE project_id = ?", (projectID,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def update(
+        self,
+        projectID: str,
+        containers: Iterable[Tuple[str, str, Optional[str], str, Optional[str]]],
+        files: Iterable[Tuple[str, str, Optional[int], Optional[str]]],
+        syncedAt: str,
+        replace: bool = False,
+    ) -> None:
+        """
+        Store the result of one sync in a single transaction.
+
+        The files of every container passed in replace its cached files, so
+        files removed from a modified container disappear from the cache.
+
+        Parameters
+        ----------
+        projectID : str
+            Project the containers belong to.
+        containers : Iterable[Tuple[str, str, Optional[str], str, Optional[str]]]
+            (ID, level, parent ID, label, modified) of each fetched container.
+        files : Iterable[Tuple[str, str, Optional[int], Optional[str]]]
+            (container ID, name, size, modified) of each of their files.
+        syncedAt : str
+            Lower bound for the next delta sync of the project.
+        replace : bool, optional
+            Drop every cached row of the project first (default False).
+        """
+        containers = list(containers)
+        with self.lock, self.db:
+            if replace:
+                self.db.execute(
+                    "DELETE FROM files WHERE container_id IN"
+                    " (SELECT id FROM containers WHERE project_id = ?)",
+                    (projectID,),
+                )
+                self.db.execute(
+                    "DELETE FROM containers WHERE project_id = ?", (projectID,)
+                )
+            else:
+                self.db.executemany(
+                    "DELETE FROM files WHERE container_id = ?",
+                    [(row[0],) for row in containers],
+                )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?, ?, ?, ?)",
+                [(cid, projectID, *rest) for cid, *rest in containers],
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", files
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO sync VALUES (?, ?)", (projectID, syncedAt)
+            )
+
+    def containers(self, projectID: str, level: str) -> List[Dict[str, Any]]:
+        """
+        Return the cached containers of one level, ordered by label.
+
+        Parameters
+        ----------
+        projectID : str
+            Project to query.
+        level : str
+            One of `INVENTORY_LEVELS`.
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            Rows with ``id``, ``parent_id``, ``label`` and ``modified``.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, parent_id, label, modified FROM containers"
+                " WHERE project_id = ? AND level = ? ORDER BY label, id",
+                (projectID, level),
+            ).fetchall()
+        keys = ("id", "parent_id", "label", "modified")
+        return [dict(zip(keys, row, strict=True)) for row in rows]
+
+    def files(self, projectID: str, level: str = "acquisition") -> List[Dict[str, Any]]:
+        """
+        Return the cached files attached to containers of one level.
+
+        Parameters
+        ----------
+        projectID : str
+            Project to query.
+        level : str, optional
+            Container level the files belong to (default "acquisition").
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            Rows with ``container_id``, ``name``, ``size`` and ``modified``.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT f.container_id, f.name, f.size, f.modified"
+                " FROM files f JOIN containers c ON c.id = f.container_id"
+                " WHERE c.project_id = ? AND c.level = ?"
+                " ORDER BY f.container_id, f.name",
+                (projectID, level),
+            ).fetchall()
+        keys = ("container_id", "name", "size", "modified")
+        return [dict(zip(keys, row, strict=True)) for row in rows]
+
+
+###############################################################################
+# Project Cache
+###############################################################################
+
+# How long a cached project lookup is trusted before the server is asked again.
+PROJECT_CACHE_TTL = timedelta(hours=24)
+
+
+class ProjectCache(SqliteStore):
+    """
+    ProjectCache.
+
+    Small persistent cache of the project a label prefix resolved to, keyed
+    by API host and prefix, so start-up does not list every project on the
+    instance. Entries older than the TTL are ignored. A cached ID that the
+    server no longer accepts is dropped by `FlywheelConnector.setProject`,
+    which then looks the project up again.
+
+    Parameters
+    ----------
+    fileSpec : str
+        Path of the SQLite cache file. Created if it does not exist.
+
+    Attributes
+    ----------
+    fileSpec : str
+        Path of the cache file.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS projects ("
+        " host TEXT NOT NULL,"
+        " prefix TEXT NOT NULL,"
+        " project_id TEXT NOT NULL,"
+        " label TEXT,"
+        " cached_at REAL NOT NULL,"
+        " PRIMARY KEY (host, prefix))",
+    )
+    DESCRIPTION = "project cache"
+
+    @staticmethod
+    def defaultPath() -> str:
+        """Return the per-user cache path."""
+        return path.join(cacheDirectory(), "projects.sqlite")
+
+    def lookup(
+        self, host: str, prefix: str, ttl: timedelta = PROJECT_CACHE_TTL
+    ) -> Optional[str]:
+        """Return the cached project ID of a prefix, if fresher than `ttl`."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT project_id FROM projects"
+                " WHERE host = ? AND prefix = ? AND cached_at >= ?",
+                (host, prefix, time.time() - ttl.total_seconds()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def store(self, host: str, prefix: str, projectID: str, label: str) -> None:
+        """Record the project a prefix resolved to."""
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO projects VALUES (?, ?, ?, ?, ?)",
+                (host, prefix, projectID, label, time.time()),
+            )
+            self.db.commit()
+
+    def forget(self, host: str, prefix: str) -> None:
+        """Drop the cached project of a prefix."""
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM projects WHERE host = ? AND prefix = ?", (host, prefix)
+            )
+            self.db.commit()
+
+
+###############################################################################
+# Instance Index
+###############################################################################
+
+# Keys per ``IN (...)`` membership query, below SQLite's bound parameter limit.
+INSTANCE_QUERY_BATCH = 500
+
+
+def instanceKey(sopInstanceUID: str) -> int:
+    """
+    Return the 64-bit key of a SOPInstanceUID, or 0 if it is empty.
+
+    Keys are the first eight bytes of a BLAKE2b digest as a signed integer,
+    so they fit SQLite's INTEGER and an ``array("q")``. Two different UIDs
+    sharing a key is vanishingly unlikely even across millions of instances
+    (about 1 in 10^7 at 10^6 UIDs), and would only skip one instance.
+    """
+    if not sopInstanceUID:
+        return 0
+    digest = hashlib.blake2b(sopInstanceUID.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True) or 1
+
+
+class InstanceIndex(SqliteStore):
+    """
+    InstanceIndex.
+
+    Persistent record of the DICOM instances and series already present in
+    one Flywheel project, used to skip data resent in overlapping archives.
+
+    Instances are stored by `instanceKey` as the table's integer primary
+    key, so membership of millions of SOPInstanceUIDs is a B-tree lookup
+    on eight-byte keys. Series are stored by their content digest with the
+    acquisition they were uploaded to. Uploads add both; series uploaded
+    from other hosts are learned from the project's file metadata by
+    `FlywheelConnector.SeedInstanceIndex`.
+
+    Parameters
+    ----------
+    fileSpec : str
+        Path of the SQLite index file. Created if it does not exist.
+
+    Attributes
+    ----------
+    fileSpec : str
+        Path of the index file.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS instances (key INTEGER PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS series ("
+        " digest TEXT PRIMARY KEY,"
+        " series_uid TEXT,"
+        " acquisition_id TEXT)",
+        "CREATE TABLE IF NOT EXISTS seeded (project_id TEXT PRIMARY KEY)",
+    )
+    DESCRIPTION = "instance index"
+
+    @staticmethod
+    def pathFor(projectID: str) -> str:
+        """Return the per-user index path of a project."""
+        return path.join(cacheDirectory(), f"instances-{projectID}.sqlite")
+
+    def isSeeded(self, projectID: str) -> bool:
+        """Return whether the index was seeded from the project's files."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM seeded WHERE project_id = ?", (projectID,)
+            ).fetchone()
+        return row is not None
+
+    def markSeeded(self, projectID: str) -> None:
+        """Record that the index was seeded from the project's files."""
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO seeded VALUES (?)", (projectID,))
+            self.db.commit()
+
+    def seriesAcquisition(self, digest: str) -> Optional[str]:
+        """Return the acquisition of a series digest, "" if unknown, or None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT acquisition_id FROM series WHERE digest = ?", (digest,)
+            ).fetchone()
+        return None if row is None else row[0] or ""
+
+    def knownInstances(self, keys: Iterable[int]) -> Set[int]:
+        """
+        Return the subset of instance keys present in the index.
+
+        Parameters
+        ----------
+        keys : Iterable[int]
+            Keys from `instanceKey`; 0 (no SOPInstanceUID) never matches.
+
+        Returns
+        -------
+        Set[int]
+            Keys already recorded.
+        """
+        wanted = [key for key in keys if key]
+        known: Set[int] = set()
+        with self.lock:
+            for start in range(0, len(wanted), INSTANCE_QUERY_BATCH):
+                batch = wanted[start : start + INSTANCE_QUERY_BATCH]
+                known.update(
+                    key
+                    for (key,) in self.db.execute(
+                        "SELECT key FROM instances WHERE key IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+        return known
+
+    def addSeries(
+        self,
+        seriesUID: str,
+        digest: str,
+        acquisitionID: Optional[str] = None,
+        keys: Iterable[int] = (),
+    ) -> None:
+        """
+        Record a series and its instances as present in the project.
+
+        Parameters
+        ----------
+        seriesUID : str
+            SeriesInstanceUID of the series.
+        digest : str
+            Content digest of the series (see `UploadImageData.seriesDigest`).
+        acquisitionID : str, optional
+            Acquisition holding the series.
+        keys : Iterable[int], optional
+            Instance keys of the series.
+        """
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO series VALUES (?, ?, ?)",
+                (digest, seriesUID, acquisitionID),
+            )
+            self.db.executemany(
+                "INSERT OR IGNORE INTO instances VALUES (?)",
+                ((key,) for key in keys if key),
+            )
+            self.db.commit()
+
+
+###############################################################################
+# Header Catalogue
+###############################################################################
+
+# Header keywords catalogued by default: enough to select cohorts by
+# sequence, scanner, echoes and geometry without reopening any archive.
+CATALOGUE_TAGS = (
+    "SeriesDescription",
+    "ProtocolName",
+    "ImageType",
+    "Manufacturer",
+    "ManufacturerModelName",
+    "MagneticFieldStrength",
+    "EchoTime",
+    "EchoNumbers",
+    "RepetitionTime",
+    "FlipAngle",
+    "Rows",
+    "Columns",
+    "AcquisitionMatrix",
+    "PixelSpacing",
+    "SliceThickness",
+)
+
+
+def catalogueTags(keywords: Iterable[str]) -> Tuple[int, ...]:
+    """
+    Return the tags of DICOM keywords.
+
+    Raises
+    ------
+    ValueError
+        If a keyword is not in the DICOM dictionary.
+    """
+    tags = []
+    for keyword in keywords:
+        tag = pydicom.datadict.tag_for_keyword(keyword)
+        if tag is None:
+            raise ValueError(f"Unknown DICOM keyword: '{keyword}'")
+        tags.append(tag)
+    return tuple(tags)
+
+
+def catalogueValue(value: Any) -> Any:
+    """Convert a DICOM element value to JSON, or None for binary values."""
+    if isinstance(value, (bytes, bytearray)):
+        return None
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+        return [catalogueValue(v) for v in value]
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int):
+        return int(value)
+    return str(value)
+
+
+def catalogueValues(meta: pydicom.Dataset, tags: Iterable[int]) -> Dict[str, Any]:
+    """Return the non-empty values of `tags` in a header, keyed by keyword."""
+    values = {}
+    for tag in tags:
+        element = meta.get(tag)
+        if element is None or element.value in (None, ""):
+            continue
+        value = catalogueValue(element.value)
+        if value is not None:
+            values[element.keyword] = value
+    return values
+
+
+def seriesSummary(instanceTags: Iterable[Dict[str, Any]]) -> Dict[str, List[Any]]:
+    """Return the distinct values of each keyword over a series' instances."""
+    distinct: Dict[str, Dict[str, Any]] = {}
+    for tags in instanceTags:
+        for keyword, value in tags.items():
+            if keyword == "SOPInstanceUID":
+                continue
+            distinct.setdefault(keyword, {})[json.dumps(value)] = value
+
+    summary = {}
+    for keyword, values in distinct.items():
+        try:
+            summary[keyword] = sorted(values.values())
+        except TypeError:
+            summary[keyword] = list(values.values())
+    return summary
+
+
+# Comparison operators accepted by `HeaderCatalogue.findSeries` filters.
+FILTER_OPERATORS = frozenset({"=", "!=", "<", "<=", ">", ">=", "LIKE"})
+
+
+class HeaderCatalogue(SqliteStore):
+    """
+    HeaderCatalogue.
+
+    Searchable SQLite catalogue of DICOM headers, filled from the headers the
+    uploader already parses, so cohort questions are answered by a query
+    instead of re-reading archives.
+
+    Each instance is stored with its series, archive, member name and the
+    catalogued tags as JSON. Each series is stored with its subject label,
+    SeriesNumber, StudyDate, instance count and, for every catalogued tag,
+    the sorted list of distinct values over its instances. A multi-echo
+    series therefore lists all its echo times, and
+    ``json_array_length(tags, '$.EchoTime')`` is its number of echoes.
+
+    Parameters
+    ----------
+    fileSpec : str
+        Path of the SQLite catalogue file. Created if it does not exist.
+    keywords : Iterable[str], optional
+        DICOM keywords to catalogue (default `CATALOGUE_TAGS`).
+
+    Attributes
+    ----------
+    fileSpec : str
+        Path of the catalogue file.
+    tags : Tuple[int, ...]
+        Tags read for the catalogue, SOPInstanceUID first.
+
+    Raises
+    ------
+    ValueError
+        If a keyword is not in the DICOM dictionary.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS instances ("
+        " sop_uid TEXT PRIMARY KEY,"
+        " series_uid TEXT NOT NULL,"
+        " archive TEXT NOT NULL,"
+        " member TEXT NOT NULL,"
+        " tags TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS instances_series ON instances (series_uid)",
+        "CREATE TABLE IF NOT EXISTS series ("
+        " series_uid TEXT PRIMARY KEY,"
+        " subject TEXT,"
+        " series_number INTEGER,"
+        " study_date TEXT,"
+        " archive TEXT NOT NULL,"
+        " instance_count INTEGER NOT NULL,"
+        " tags TEXT NOT NULL,"
+        " updated REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS series_subject ON series (subject)",
+    )
+    DESCRIPTION = "header catalogue"
+
+    def __init__(self, fileSpec: str, keywords: Iterable[str] = CATALOGUE_TAGS):
+        self.tags = (SOP_INSTANCE_UID_TAG, *catalogueTags(keywords))
+        super().__init__(fileSpec)
+
+    def addInstances(
+        self, archive: str, instances: Iterable[Tuple[str, str, Dict[str, Any]]]
+    ) -> None:
+        """
+        Record instances of an archive.
+
+        Parameters
+        ----------
+        archive : str
+            Name of the archive.
+        instances : Iterable[Tuple[str, str, Dict[str, Any]]]
+            Member name, SeriesInstanceUID and catalogued values of each
+            instance. Instances without a SOPInstanceUID are keyed by
+            archive and member name.
+        """
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        tags.get("SOPInstanceUID") or f"{archive}/{member}",
+                        seriesUID,
+                        archive,
+                        member,
+                        json.dumps(tags),
+                    )
+                    for member, seriesUID, tags in instances
+                ),
+            )
+            self.db.commit()
+
+    def summariseSeries(
+        self, archive: str, series: Iterable[Tuple[str, int, str, str]]
+    ) -> None:
+        """
+        Record the series of an archive from their catalogued instances.
+
+        Parameters
+        ----------
+        archive : str
+            Name of the archive.
+        series : Iterable[Tuple[str, int, str, str]]
+            SeriesInstanceUID, SeriesNumber, StudyDate and subject label of
+            each series.
+        """
+        with self.lock:
+            for seriesUID, seriesNumber, studyDate, subject in series:
+                instanceTags = [
+                    json.loads(tags)
+                    for (tags,) in self.db.execute(
+                        "SELECT tags FROM instances WHERE series_uid = ?",
+                        (seriesUID,),
+                    )
+                ]
+                self.db.execute(
+                    "INSERT OR REPLACE INTO series VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        seriesUID,
+                        subject,
+                        seriesNumber,
+                        studyDate,
+                        archive,
+                        len(instanceTags),
+                        json.dumps(seriesSummary(instanceTags)),
+                        time.time(),
+                    ),
+                )
+            self.db.commit()
+
+    def seriesCondition(self, key: str, value: Any) -> Tuple[str, List[Any]]:
+        """
+        Return the SQL condition and parameters of one `findSeries` filter.
+
+        Raises
+        ------
+        ValueError
+            If the key names no ``series`` column or DICOM keyword, or the
+            operator is not in `FILTER_OPERATORS`.
+        """
+        operator, operand = value if isinstance(value, tuple) else ("=", value)
+        operator = operator.upper()
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter operator: '{operator}'")
+
+        if key.startswith("tags."):
+            keyword, _, suffix = key[len("tags.") :].partition(".")
+            if suffix not in ("", "count"):
+                raise ValueError(f"Unknown series filter: '{key}'")
+            # Checked against the DICOM dictionary, so safe in a JSON path.
+            catalogueTags([keyword])
+            if suffix:
+                condition = f"json_array_length(tags, '$.{keyword}') {operator} ?"
+            else:
+                condition = (
+                    f"EXISTS (SELECT 1 FROM json_each(tags, '$.{keyword}')"
+                    f" WHERE value {operator} ?)"
+                )
+            return condition, [operand]
+
+        with self.lock:
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(series)")}
+        if key not in columns or key == "tags":
+            raise ValueError(f"Unknown series filter: '{key}'")
+        return f"{key} {operator} ?", [operand]
+
+    def findSeries(
+        self, filters: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Return the catalogued series matching every filter.
+
+        Parameters
+        ----------
+        filters : Dict[str, Any], optional
+            Conditions keyed by a ``series`` column (e.g. ``subject``), by
+            ``tags.<Keyword>`` (any distinct value of the tag matches) or by
+            ``tags.<Keyword>.count`` (number of distinct values, e.g. echoes
+            for ``EchoTime``). A value is compared for equality; an
+            ``(operator, value)`` tuple uses one of `FILTER_OPERATORS`.
+            Values are bound as query parameters.
+
+        Returns
+        -------
+        List[Dict[str, Any]]
+            Matching series ordered by subject, StudyDate and SeriesNumber,
+            with their tags decoded.
+
+        Raises
+        ------
+        ValueError
+            If a filter key or operator is not recognised.
+        """
+        conditions, params = ["1"], []
+        for key, value in (filters or {}).items():
+            condition, values = self.seriesCondition(key, value)
+            conditions.append(condition)
+            params.extend(values)
+        where = " AND ".join(conditions)
+
+        with self.lock:
+            cursor = self.db.execute(
+                "SELECT series_uid, subject, series_number, study_date, archive,"
+                f" instance_count, tags FROM series WHERE {where}"
+                " ORDER BY subject, study_date, series_number",
+                params,
+            )
+            columns = [c[0] for c in cursor.description]
+            rows = cursor.fetchall()
+
+        found = []
+        for row in rows:
+            record = dict(zip(columns, row, strict=True))
+            record["tags"] = json.loads(record["tags"])
+            found.append(record)
+        return found
+
+
+###############################################################################
+# Series ZIP Assembly
+###############################################################################
+
+# Local file header of a ZIP member: signature, version, flags, method,
+# time, date, CRC-32, sizes, name length and extra field length.
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+CENTRAL_HEADER_SIGNATURE = b"PK\x01\x02"
+END_RECORD = struct.Struct("<4s4H2LH")
+END_RECORD_SIGNATURE = b"PK\x05\x06"
+ZIP64_END_RECORD = struct.Struct("<4sQ2H2L4Q")
+ZIP64_END_RECORD_SIGNATURE = b"PK\x06\x06"
+ZIP64_LOCATOR = struct.Struct("<4sLQL")
+ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+ZIP64_LIMIT = zipfile.ZIP64_LIMIT
+ZIP_FILECOUNT_LIMIT = zipfile.ZIP_FILECOUNT_LIMIT
+
+# Compression methods copied byte-for-byte. Members using anything else are
+# decompressed and written ZIP_STORED so every consumer can read the bundle.
+RAW_COPY_METHODS = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)
+COPY_CHUNK_SIZE = 1 << 20
+
+# Series ZIPs up to this size are buffered in memory; larger ones spill to
+# an anonymous temporary file until they have been uploaded.
+DEFAULT_SPOOL_THRESHOLD = 64 << 20
+
+
+class SeriesZipWriter:
+    """
+    SeriesZipWriter.
+
+    Streams a ZIP archive built from members of another ZIP without
+    recompressing them. Each member's compressed bytes are copied verbatim
+    from the source archive, with the CRC-32 and sizes taken from its
+    central directory entry, so packaging a series costs I/O rather than
+    deflate CPU. Members that cannot be copied raw are decompressed and
+    written ZIP_STORED, since DICOM pixel data compresses poorly anyway.
+
+    The output is written strictly sequentially, so any writable binary
+    stream can be used as the destination.
+
+    Parameters
+    ----------
+    fp : BinaryIO
+        Writable binary stream receiving the archive.
+
+    Attributes
+    ----------
+    entries : List[Tuple[zipfile.ZipInfo, int]]
+        Written members and their local header offsets.
+    """
+
+    def __init__(self, fp: BinaryIO):
+        self.fp = fp
+        self.offset = 0
+        self.entries: List[Tuple[zipfile.ZipInfo, int]] = []
+
+    def write(self, data: bytes) -> None:
+        """Write raw bytes to the output and advance the offset."""
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def addMember(
+        self,
+        source: zipfile.ZipFile,
+        sourceFile: BinaryIO,
+        info: zipfile.ZipInfo,
+        arcname: str,
+    ) -> None:
+        """
+        Append one member of `source` to the output under `arcname`.
+
+        Parameters
+        ----------
+        source : zipfile.ZipFile
+            Archive the member belongs to, used for the stored fallback.
+        sourceFile : BinaryIO
+            Separate binary handle on the same archive, used for raw reads.
+        info : zipfile.ZipInfo
+            Central directory entry of the member.
+        arcname : str
+            Member name in the output archive.
+        """
+        out = zipfile.ZipInfo(arcname, info.date_time)
+        out.CRC = info.CRC
+        out.file_size = info.file_size
+        out.external_attr = info.external_attr
+        out.create_system = info.create_system
+
+        encrypted = info.flag_bits & 0x1
+        if info.compress_type in RAW_COPY_METHODS and not encrypted:
+            out.compress_type = info.compress_type
+            out.compress_size = info.compress_size
+            self.writeLocalHeader(out)
+            self.copyRaw(sourceFile, info)
+        else:
+            out.compress_type = zipfile.ZIP_STORED
+            out.compress_size = info.file_size
+            self.writeLocalHeader(out)
+            with source.open(info) as src:
+                while chunk := src.read(COPY_CHUNK_SIZE):
+                    self.write(chunk)
+
+    def writeLocalHeader(self, info: zipfile.ZipInfo) -> None:
+        """Write the local file header of a member and register it."""
+        name, flags = self.encodeName(info.filename)
+        extra = b""
+        compress_size, file_size = info.compress_size, info.file_size
+        if file_size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT:
+            extra = struct.pack("<2H2Q", 0x0001, 16, file_size, compress_size)
+            compress_size = file_size = 0xFFFFFFFF
+
+        dos_time, dos_date = self.dosDateTime(info.date_time)
+        self.entries.append((info, self.offset))
+        self.write(
+            LOCAL_HEADER.pack(
+                LOCAL_HEADER_SIGNATURE,
+                45 if extra else 20,
+                flags,
+                info.compress_type,
+                dos_time,
+                dos_date,
+                info.CRC,
+                compress_size,
+                file_size,
+                len(name),
+                len(extra),
+            )
+            + name
+            + extra
+        )
+
+    def copyRaw(self, sourceFile: BinaryIO, info: zipfile.ZipInfo) -> None:
+        """Copy the compressed bytes of a source member to the output."""
+        sourceFile.seek(info.header_offset)
+        header = sourceFile.read(LOCAL_HEADER.size)
+        if len(header) != LOCAL_HEADER.size or header[:4] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+
+        fields = LOCAL_HEADER.unpack(header)
+        sourceFile.seek(fields[9] + fields[10], os.SEEK_CUR)
+
+        remaining = info.compress_size
+        while remaining:
+            chunk = sourceFile.read(min(COPY_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+            self.write(chunk)
+            remaining -= len(chunk)
+
+    def close(self) -> None:
+        """Write the central directory and end-of-archive records."""
+        cd_offset = self.offset
+        for info, header_offset in self.entries:
+            name, flags = self.encodeName(info.filename)
+
+            zip64 = []
+            file_size, compress_size = info.file_size, info.compress_size
+            if file_size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT:
+                zip64 += [file_size, compress_size]
+                file_size = compress_size = 0xFFFFFFFF
+            if header_offset >= ZIP64_LIMIT:
+                zip64.append(header_offset)
+                header_offset = 0xFFFFFFFF
+            extra = b""
+            if zip64:
+                extra = struct.pack(f"<2H{len(zip64)}Q", 0x0001, 8 * len(zip64), *zip64)
+
+            dos_time, dos_date = self.dosDateTime(info.date_time)
+            version = 45 if extra else 20
+            self.write(
+                CENTRAL_HEADER.pack(
+                    CENTRAL_HEADER_SIGNATURE,
+                    (info.create_system << 8) | version,
+                    version,
+                    flags,
+                    info.compress_type,
+                    dos_time,
+                    dos_date,
+                    info.CRC,
+                    compress_size,
+                    file_size,
+                    len(name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    info.external_attr,
+                    header_offset,
+                )
+                + name
+                + extra
+            )
+
+        count = len(self.entries)
+        cd_size = self.offset - cd_offset
+        if (
+            count >= ZIP_FILECOUNT_LIMIT
+            or cd_offset >= ZIP64_LIMIT
+            or cd_size >= ZIP64_LIMIT
+        ):
+            zip64_offset = self.offset
+            self.write(
+                ZIP64_END_RECORD.pack(
+                    ZIP64_END_RECORD_SIGNATURE,
+                    ZIP64_END_RECORD.size - 12,
+                    45,
+                    45,
+                    0,
+                    0,
+                    count,
+                    count,
+                    cd_size,
+                    cd_offset,
+                )
+            )
+            self.write(ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, zip64_offset, 1))
+            count = min(count, 0xFFFF)
+            cd_size = min(cd_size, 0xFFFFFFFF)
+            cd_offset = min(cd_offset, 0xFFFFFFFF)
+
+        self.write(
+            END_RECORD.pack(
+                END_RECORD_SIGNATURE, 0, 0, count, count, cd_size, cd_offset, 0
+            )
+        )
+
+    @staticmethod
+    def encodeName(name: str) -> Tuple[bytes, int]:
+        """Encode a member name, flagging UTF-8 names as the spec requires."""
+        try:
+            return name.encode("ascii"), 0
+        except UnicodeEncodeError:
+            return name.encode("utf-8"), 0x800
+
+    @staticmethod
+    def dosDateTime(date_time: Tuple[int, ...]) -> Tuple[int, int]:
+        """Convert a ZipInfo timestamp into MS-DOS time and date fields."""
+        year, month, day, hour, minute, second = date_time
+        dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+        dos_time = hour << 11 | minute << 5 | second // 2
+        return dos_time, dos_date
+
+
+###############################################################################
+# Archive Index
+###############################################################################
+
+
+def subjectSegment(name: str) -> Optional[str]:
+    """Return the first segment of a member path that contains "NACC"."""
+    at = name.find("NACC")
+    if at < 0:
+        return None
+
+    end = name.find("/", at)
+    return name[name.rfind("/", 0, at) + 1 : end if end >= 0 else None]
+
+
+class ArchiveIndex:
+    """
+    ArchiveIndex.
+
+    Compact index of the DICOM members of an input archive, shared by the
+    scan, grouping and packaging stages.
+
+    It is built in a single pass over the archive's central directory. A
+    member is identified by its row, and per member the index only keeps
+    integers in typed arrays: the member's position in the central directory
+    and, once headers are read, the ID of its series and the `instanceKey`
+    of its SOPInstanceUID. Names and sizes are
+    read back from the archive's own `ZipInfo` records when needed. Subject
+    labels are interned and map to one array of rows each, and every series
+    is a single (SeriesInstanceUID, SeriesNumber, StudyDate) record however
+    many instances it has.
+
+    Parameters
+    ----------
+    archive : zipfile.ZipFile
+        Open input archive.
+
+    Attributes
+    ----------
+    subjectRows : Dict[str, array]
+        Rows of each subject's members, keyed by subject label.
+    seriesRecords : List[Tuple[str, int, str]]
+        SeriesInstanceUID, SeriesNumber and StudyDate of each series ID.
+    instanceKeys : array
+        Instance key of each row, 0 until read or without SOPInstanceUID.
+    unlabelled : int
+        Number of DICOM members without a NACC ID in their path.
+    """
+
+    def __init__(self, archive: zipfile.ZipFile):
+        self.archive = archive
+        self.infos = archive.infolist()
+        self.members = array("I")
+        self.series = array("i")
+        self.instanceKeys = array("q")
+        self.subjectRows: Dict[str, array] = {}
+        self.seriesRecords: List[Tuple[str, int, str]] = []
+        self.seriesIDs: Dict[str, int] = {}
+        self.unlabelled = 0
+        self.build()
+
+    def build(self) -> None:
+        """Index the archive's DICOM members by subject."""
+        for position, info in enumerate(self.infos):
+            name = info.filename
+            _, ext = path.splitext(name)
+            if ext.lower() != ".dcm":
+                continue
+
+            label = subjectSegment(name)
+            if label is None:
+                logger.warning(f"No NACC ID in file path: {name}")
+                self.unlabelled += 1
+                continue
+
+            rows = self.subjectRows.get(label)
+            if rows is None:
+                rows = self.subjectRows[sys.intern(label)] = array("I")
+            rows.append(len(self.members))
+            self.members.append(position)
+
+        self.series = array("i", [-1]) * len(self.members)
+        self.instanceKeys = array("q", [0]) * len(self.members)
+
+    def __len__(self) -> int:
+        """Return the number of indexed DICOM members."""
+        return len(self.members)
+
+    def info(self, row: int) -> zipfile.ZipInfo:
+        """Return the central directory record of a row."""
+        return self.infos[self.members[row]]
+
+    def name(self, row: int) -> str:
+        """Return the member name of a row."""
+        return self.infos[self.members[row]].filename
+
+    def setHeader(
+        self,
+        row: int,
+        seriesUID: str,
+        seriesNumber: int,
+        studyDate: str,
+        instanceKey: int = 0,
+    ):
+        """Assign a row to its series, creating the series record if new."""
+        seriesID = self.seriesIDs.get(seriesUID)
+        if seriesID is None:
+            seriesID = self.seriesIDs[seriesUID] = len(self.seriesRecords)
+            self.seriesRecords.append((seriesUID, seriesNumber, studyDate))
+        self.series[row] = seriesID
+        self.instanceKeys[row] = instanceKey
+
+
+###############################################################################
+# Header Extraction
+###############################################################################
+
+# Errors that make a single member's header unreadable.
+HEADER_ERRORS = (
+    OSError,
+    KeyError,
+    AttributeError,
+    zipfile.BadZipFile,
+    pydicom.errors.InvalidDicomError,
+)
+
+# Members per task handed to a header worker process. Large enough to
+# amortise inter-process overhead, small enough to balance uneven shards.
+HEADER_SHARD_SIZE = 512
+
+# (row, SeriesInstanceUID, SeriesNumber, StudyDate, instance key) of one
+# instance.
+HeaderRecord = Tuple[int, str, int, str, int]
+
+# Archive opened once by each header worker process.
+_workerArchive: Optional[zipfile.ZipFile] = None
+
+
+def readHeader(
+    archive: zipfile.ZipFile,
+    member: str,
+    tags: Sequence[int] = tuple(SERIES_HEADER_TAGS),
+) -> pydicom.Dataset:
+    """
+    Decode selected tags of one archive member's header.
+
+    The member is streamed straight out of the ZIP and only `tags` are
+    parsed, so nothing is written to disk and pixel data is never
+    decompressed past the header.
+
+    Parameters
+    ----------
+    archive : zipfile.ZipFile
+        Open input archive.
+    member : str
+        Name of the DICOM member within the archive.
+    tags : Sequence[int], optional
+        Tags to decode (default `SERIES_HEADER_TAGS`).
+
+    Returns
+    -------
+    pydicom.Dataset
+        Dataset holding the decoded tags.
+    """
+    with archive.open(member) as fp:
+        return pydicom.dcmread(fp, stop_before_pixels=True, specific_tags=list(tags))
+
+
+def seriesHeader(meta: pydicom.Dataset) -> Tuple[str, str, int, str]:
+    """
+    Return the series grouping values of a decoded header.
+
+    Returns
+    -------
+    Tuple[str, str, int, str]
+        SeriesInstanceUID, StudyDate, SeriesNumber and SOPInstanceUID of the
+        instance. The SOPInstanceUID is "" when absent.
+
+    Raises
+    ------
+    AttributeError
+        If one of the series tags is missing from the header.
+    """
+    sopInstanceUID = meta.get(SOP_INSTANCE_UID_TAG)
+    return (
+        meta.get(SERIES_UID_TAG).value,
+        meta.get(STUDY_DATE_TAG).value,
+        meta.get(SERIES_NUMBER_TAG).value,
+        str(sopInstanceUID.value) if sopInstanceUID is not None else "",
+    )
+
+
+def readSeriesHeader(
+    archive: zipfile.ZipFile, member: str
+) -> Tuple[str, str, int, str]:
+    """
+    Decode the series grouping tags of one archive member.
+
+    Parameters
+    ----------
+    archive : zipfile.ZipFile
+        Open input archive.
+    member : str
+        Name of the DICOM member within the archive.
+
+    Returns
+    -------
+    Tuple[str, str, int, str]
+        See `seriesHeader`.
+    """
+    return seriesHeader(readHeader(archive, member))
+
+
+def openHeaderArchive(fileSpec: str) -> None:
+    """Open the input archive once in a header worker process."""
+    global _workerArchive
+    _workerArchive = zipfile.ZipFile(fileSpec)
+
+
+def readHeaderShard(
+    members: List[str],
+    start: int = 0,
+    archive: Optional[zipfile.ZipFile] = None,
+    extraTags: Sequence[int] = (),
+) -> Tuple[List[HeaderRecord], List[Tuple[str, str]], List[Dict[str, Any]]]:
+    """
+    Read the series headers of a shard of archive members.
+
+    Parameters
+    ----------
+    members : List[str]
+        Member names to read.
+    start : int, optional
+        Index row of the first member; records carry ``start`` plus the
+        member's position in the shard.
+    archive : zipfile.ZipFile, optional
+        Archive to read from. Defaults to the one opened by
+        `openHeaderArchive` in this worker process.
+    extraTags : Sequence[int], optional
+        Further tags decoded in the same pass for a `HeaderCatalogue`.
+
+    Returns
+    -------
+    Tuple[List[HeaderRecord], List[Tuple[str, str]], List[Dict[str, Any]]]
+        Header records of the readable members, (member, error message)
+        for the others, and the catalogued values of each record when
+        `extraTags` is given.
+    """
+    archive = archive or _workerArchive
+    tags = (*SERIES_HEADER_TAGS, *extraTags)
+    records: List[HeaderRecord] = []
+    failures: List[Tuple[str, str]] = []
+    tagValues: List[Dict[str, Any]] = []
+
+    for row, member in enumerate(members, start):
+        try:
+            meta = readHeader(archive, member, tags)
+            suid, studyDate, seriesNumber, sopUID = seriesHeader(meta)
+        except HEADER_ERRORS as e:
+            failures.append((member, str(e)))
+            continue
+        records.append((row, suid, seriesNumber, studyDate, instanceKey(sopUID)))
+        if extraTags:
+            tagValues.append(catalogueValues(meta, extraTags))
+
+    return records, failures, tagValues
+
+
+###############################################################################
+# Upload Image Data
+###############################################################################
+
+
+class SeriesJob:
+    """
+    SeriesJob.
+
+    One series of the input archive, queued for packaging and upload.
+
+    Parameters
+    ----------
+    seriesUID : str
+        SeriesInstanceUID shared by every file of the series.
+    seriesNumber : int
+        SeriesNumber of the first instance seen.
+    studyDate : str
+        StudyDate of the first instance seen.
+    index : ArchiveIndex
+        Index of the archive the series was found in.
+
+    Attributes
+    ----------
+    rows : array
+        Rows of `index` to upload. Instances found in the instance index
+        are removed from it.
+    digest : str
+        Content digest of the series, set once grouping is complete.
+    instanceCount : int
+        Number of instances of the series in the archive, set with `digest`.
+    uploadDigest : str
+        Content digest of the instances in `rows`; equal to `digest` unless
+        some instances were found in the instance index.
+    """
+
+    def __init__(
+        self, seriesUID: str, seriesNumber: int, studyDate: str, index: "ArchiveIndex"
+    ):
+        self.seriesUID = seriesUID
+        self.seriesNumber = seriesNumber
+        self.studyDate = studyDate
+        self.index = index
+        self.rows = array("I")
+        self.digest = ""
+        self.instanceCount = 0
+        self.uploadDigest = ""
+
+    @property
+    def files(self) -> List[str]:
+        """Archive member names belonging to the series."""
+        return [self.index.name(row) for row in self.rows]
+
+    @property
+    def partial(self) -> bool:
+        """Whether only part of the series is uploaded."""
+        return len(self.rows) < self.instanceCount
+
+    @property
+    def zipFileName(self) -> str:
+        """
+        Name of the per-series ZIP uploaded to Flywheel.
+
+        A partial upload gets a name of its own, derived from its content,
+        so it never replaces the ZIP of the instances already present.
+        """
+        base_name = path.basename(self.index.name(self.rows[0])).split("_br")[0]
+        if self.partial:
+            return f"{self.seriesNumber}-{base_name}-{self.uploadDigest[:12]}.zip"
+        return f"{self.seriesNumber}-{base_name}.zip"
+
+
+class UploadImageData:
+    """
+    UploadImageData.
+
+    Responsible for uploading DICOMs from an input ZIP file to Flywheel.
+    Files are grouped by SeriesInstanceUID and uploaded as per-series ZIPs.
+
+    Series are packaged by a pool of worker threads and handed through a
+    bounded queue to a pool of uploader threads, so packaging and network
+    transfer overlap. Each series ZIP is assembled in a spooled buffer that
+    stays in memory up to `spoolThreshold` bytes and spills to a temporary
+    file beyond it, and is streamed from there to Flywheel. Since at most
+    workers + maxPending + uploaders buffers exist at once, temporary space
+    is bounded by the concurrency level rather than by subject size.
+
+    Parameters
+    ----------
+    fc : FlywheelConnector
+        Initialized FlywheelConnector instance with project selected.
+    fileSpec : str
+        Path to the ZIP archive containing DICOM files.
+    workers : int, optional
+        Number of series packaging threads (default 1).
+    uploaders : int, optional
+        Number of upload threads. Defaults to `workers`.
+    journalSpec : str, optional
+        Path of an `UploadJournal` used to skip series finished by an
+        earlier run. No journal is kept when omitted, or when it cannot be
+        opened (e.g. next to an archive in a read-only folder).
+    force : bool, optional
+        Upload every series even if the journal marks it complete.
+    spoolThreshold : int, optional
+        Size in bytes above which a series buffer spills to disk
+        (default `DEFAULT_SPOOL_THRESHOLD`).
+    processes : int, optional
+        Number of processes parsing DICOM headers (default 1, in-process).
+    metrics : RunMetrics, optional
+        Collector for stage timings and counters. A new one is created when
+        omitted.
+    instanceIndex : InstanceIndex, optional
+        Index of the project's instances and series. Series and instances
+        found in it are not uploaded again, unless `force` is set.
+    catalogue : HeaderCatalogue, optional
+        Catalogue receiving the headers read from the archive. Its tags
+        are decoded in the same pass as the series grouping tags.
+
+    Attributes
+    ----------
+    fc : FlywheelConnector
+        Connector used for Flywheel operations.
+    fileSpec : str
+        Provided ZIP file path.
+    zip : zipfile.ZipFile
+        Opened ZIP archive.
+    baseName : str
+        Base name of the input archive (without extension).
+    workers : int
+        Number of series packaging threads.
+    uploaders : int
+        Number of upload threads.
+    maxPending : int
+        Maximum number of packaged series waiting for an uploader.
+    spoolThreshold : int
+        In-memory size limit of each series buffer.
+    processes : int
+        Number of header parsing processes.
+    failedSeries : List[str]
+        SeriesInstanceUIDs that failed packaging or upload in the last run.
+    uploadQueue : queue.Queue or None
+        Queue of packaged series awaiting upload during a run.
+    journal : UploadJournal or None
+        Journal of completed series, if enabled.
+    force : bool
+        Whether completed series are uploaded again.
+    skippedSeries : List[str]
+        SeriesInstanceUIDs skipped as already complete in the last run.
+    duplicateSeries : List[str]
+        SeriesInstanceUIDs skipped as already present in the project
+        according to `instanceIndex` in the last run.
+    duplicateInstances : int
+        Instances left out of partially present series in the last run.
+    index : ArchiveIndex or None
+        Index of the archive built by the last scan.
+    metrics : RunMetrics
+        Stage timings and counters of the runs.
+
+    Raises
+    ------
+    Exception
+        If the ZIP archive cannot be opened.
+    """
+
+    def __init__(
+        self,
+        fc: FlywheelConnector,
+        fileSpec: str,
+        workers: int = 1,
+        uploaders: Optional[int] = None,
+        journalSpec: Optional[str] = None,
+        force: bool = False,
+        spoolThreshold: int = DEFAULT_SPOOL_THRESHOLD,
+        processes: int = 1,
+        metrics: Optional[RunMetrics] = None,
+        instanceIndex: Optional[InstanceIndex] = None,
+        catalogue: Optional[HeaderCatalogue] = None,
+    ):
+        self.fc = fc
+        self.fileSpec = fileSpec
+
+        try:
+            self.zip = zipfile.ZipFile(fileSpec)
+        except Exception as e:
+            logger.error(f"Could not open zip file '{fileSpec}': {e}")
+            raise
+
+        try:
+            self.journal = self.openJournal(journalSpec)
+        except BaseException:
+            self.zip.close()
+            raise
+
+        self.baseName, _ = path.splitext(path.basename(fileSpec))
+
+        self.workers = max(1, workers)
+        self.uploaders = max(1, uploaders or self.workers)
+        self.maxPending = self.uploaders
+        self.spoolThreshold = spoolThreshold
+        self.processes = max(1, processes)
+        self.failedSeries: List[str] = []
+        self.uploadQueue: Optional[queue.Queue] = None
+
+        self.force = force
+        self.skippedSeries: List[str] = []
+        self.instanceIndex = instanceIndex
+        self.catalogue = catalogue
+        self.duplicateSeries: List[str] = []
+        self.duplicateInstances = 0
+        self.index: Optional[ArchiveIndex] = None
+        self.metrics = metrics or RunMetrics()
+
+        self.failureLock = threading.Lock()
+
+    @staticmethod
+    def openJournal(journalSpec: Optional[str]) -> Optional[UploadJournal]:
+        """Open the upload journal, or return None to run without resume."""
+        if not journalSpec:
+            return None
+        try:
+            return UploadJournal(journalSpec)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Upload journal disabled, the run cannot be resumed: {e}")
+            return None
+
+    def close(self) -> None:
+        """Close the archive and the journal."""
+        self.zip.close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def readSeriesHeader(self, member: str) -> Tuple[str, str, int, str]:
+        """Decode the series grouping tags of one member of the archive."""
+        return readSeriesHeader(self.zip, member)
+
+    def readHeaders(self, index: ArchiveIndex) -> None:
+        """
+        Read the series header of every indexed member into `index`.
+
+        The rows are cut into shards of `HEADER_SHARD_SIZE`. With more than
+        one process, shards are spread over a process pool in which every
+        worker opens its own handle on the archive and returns compact
+        header tuples, so parsing scales with the number of cores instead of
+        being bound to one interpreter. Members whose header cannot be read
+        are logged and keep no series.
+
+        Parameters
+        ----------
+        index : ArchiveIndex
+            Index of the archive.
+        """
+        starts = range(0, len(index), HEADER_SHARD_SIZE)
+        shards = [
+            [
+                index.name(row)
+                for row in range(start, min(start + HEADER_SHARD_SIZE, len(index)))
+            ]
+            for start in starts
+        ]
+
+        logger.info(
+            f"Reading {len(index)} DICOM headers with {self.processes} "
+            f"process{'es' if self.processes > 1 else ''}…"
+        )
+
+        with self.metrics.stage("headers", files=len(index)):
+            self.readShards(shards, starts, index)
+
+    def readShards(
+        self, shards: List[List[str]], starts: range, index: ArchiveIndex
+    ) -> None:
+        """Read header shards in-process or on the process pool."""
+        tags = self.catalogue.tags if self.catalogue is not None else ()
+        if self.processes <= 1 or len(shards) <= 1:
+            results: Iterable = (
+                readHeaderShard(shard, start, self.zip, tags)
+                for shard, start in zip(shards, starts, strict=True)
+            )
+            self.collectHeaders(results, index)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=min(self.processes, len(shards)),
+                initializer=openHeaderArchive,
+                initargs=(self.fileSpec,),
+            ) as pool:
+                read = partial(readHeaderShard, extraTags=tags)
+                self.collectHeaders(pool.map(read, shards, starts), index)
+
+        if self.catalogue is not None:
+            self.catalogueSeries(index)
+
+    def collectHeaders(self, results: Iterable[Tuple], index: ArchiveIndex) -> None:
+        """Store shard results in `index`, logging unreadable members."""
+        archive = path.basename(self.fileSpec)
+        for records, failures, tagValues in results:
+            for record in records:
+                index.setHeader(*record)
+            if self.catalogue is not None:
+                self.catalogue.addInstances(
+                    archive,
+                    (
+                        (index.name(record[0]), record[1], tags)
+                        for record, tags in zip(records, tagValues, strict=True)
+                    ),
+                )
+            for member, error in failures:
+                logger.error(f"Cannot read DICOM header of {member}: {error}")
+
+    def catalogueSeries(self, index: ArchiveIndex) -> None:
+        """Record every series of `index` in the header catalogue."""
+        subjects: Dict[int, str] = {}
+        for subject_label, rows in index.subjectRows.items():
+            for row in rows:
+                seriesID = index.series[row]
+                if seriesID >= 0:
+                    subjects.setdefault(seriesID, subject_label)
+
+        self.catalogue.summariseSeries(
+            path.basename(self.fileSpec),
+            (
+                (*index.seriesRecords[seriesID], subject_label)
+                for seriesID, subject_label in subjects.items()
+            ),
+        )
+
+    def scanArchive(self) -> ArchiveIndex:
+        """
+        Index the archive's DICOM members by the NACC ID in their path.
+
+        Returns
+        -------
+        ArchiveIndex
+            Index of the archive, also kept in `index`.
+        """
+        logger.info("Scanning archive for DICOM files…")
+
+        try:
+            with self.metrics.stage("scan"):
+                self.index = ArchiveIndex(self.zip)
+        except Exception as e:
+            logger.error(f"Error scanning DICOM files: {e}")
+            raise
+
+        self.metrics.addVolume("scan", files=len(self.index))
+        logger.info(
+            f"Found {len(self.index.subjectRows)} subjects and "
+            f"{len(self.index)} DICOM files in archive."
+        )
+        return self.index
+
+    def groupSeries(self, subject_label: str, rows: array) -> List[SeriesJob]:
+        """
+        Group one subject's members by SeriesInstanceUID.
+
+        Parameters
+        ----------
+        subject_label : str
+            Subject the files belong to (used for logging only).
+        rows : array
+            Rows of `index` belonging to the subject, with headers read.
+
+        Returns
+        -------
+        List[SeriesJob]
+            One job per series, or an empty list if any header is unreadable.
+        """
+        logger.info(f"Processing subject {subject_label} with {len(rows)} files…")
+
+        with self.metrics.stage("group", files=len(rows)):
+            return self.groupRows(subject_label, rows)
+
+    def groupRows(self, subject_label: str, rows: array) -> List[SeriesJob]:
+        """Build the series jobs of one subject's rows (see `groupSeries`)."""
+        index = self.index
+        series: Dict[int, SeriesJob] = {}
+        for row in rows:
+            seriesID = index.series[row]
+            if seriesID < 0:
+                logger.error(
+                    f"Metadata extraction failure for subject {subject_label}: "
+                    f"unreadable header in {index.name(row)}"
+                )
+                return []
+
+            job = series.get(seriesID)
+            if job is None:
+                job = series[seriesID] = SeriesJob(
+                    *index.seriesRecords[seriesID], index
+                )
+            job.rows.append(row)
+
+        for job in series.values():
+            job.digest = job.uploadDigest = self.seriesDigest(job)
+            job.instanceCount = len(job.rows)
+
+        return list(series.values())
+
+    def seriesDigest(self, job: SeriesJob) -> str:
+        """
+        Digest the content of a series from the archive's central directory.
+
+        Member names, CRC-32 values and sizes identify the instances without
+        reading any member data.
+
+        Parameters
+        ----------
+        job : SeriesJob
+            Series to digest.
+
+        Returns
+        -------
+        str
+            Hex SHA-256 digest.
+        """
+        digest = hashlib.sha256()
+        infos = sorted(
+            (job.index.info(row) for row in job.rows), key=lambda i: i.filename
+        )
+        for info in infos:
+            digest.update(
+                f"{info.filename}\0{info.CRC:08x}\0{info.file_size}\n".encode()
+            )
+        return digest.hexdigest()
+
+    def isComplete(self, job: SeriesJob) -> bool:
+        """Return whether the journal records `job` as already uploaded."""
+        if self.journal is None or self.force:
+            return False
+
+        acquisitionID = self.journal.completedAcquisition(
+            job.seriesUID, job.instanceCount, job.digest
+        )
+        if acquisitionID is None:
+            return False
 
-    Provides a convenience wrapper around:
+        logger.info(
+            f"Skipping series {job.seriesNumber} ({job.seriesUID}); "
+            f"already uploaded to acquisition {acquisitionID}."
+        )
+        return True
 
-      • The Flywheel REST API client (FWClient)
-      • The official Flywheel Python SDK (flywheel.Client)
+    def isDuplicate(self, job: SeriesJob) -> bool:
+        """
+        Return whether `job` is already present in the project.
 
-    It centralizes retrieval and iteration over projects, subjects, sessions,
-    acquisitions, and file objects.
+        A series whose digest is in the instance index is skipped whole.
+        Otherwise the rows of instances already in the index are removed
+        from `job`, and the series is only skipped if none remain. The
+        remaining instances are uploaded as a separate ZIP, identified by
+        their own `SeriesJob.uploadDigest`.
 
-    Parameters
-    ----------
-    api_key : str
-        A valid Flywheel API key used for authentication.
+        Parameters
+        ----------
+        job : SeriesJob
+            Series to check; its `rows` may be reduced.
 
-    Attributes
-    ----------
-    APIKey : str
-        Stored Flywheel API token.
-    RestClient : FWClient
-        Wrapper around Flywheel REST API.
-    SDKClient : flywheel.Client
-        Official Flywheel SDK client.
-    project : flywheel.Project or None
-        Selected project object after calling `setProject`.
-    imageList : List
-        Collected list of file objects from acquisitions.
-    sessionList : List
-        Collected list of session objects.
-    """
+        Returns
+        -------
+        bool
+            True if nothing of the series needs uploading.
+        """
+        if self.instanceIndex is None or self.force:
+            return False
 
-    def __init__(self, api_key: str):
-        self.APIKey: str = api_key
-        self.project = None
+        acquisitionID = self.instanceIndex.seriesAcquisition(job.digest)
+        if acquisitionID is not None:
+            logger.info(
+                f"Skipping series {job.seriesNumber} ({job.seriesUID}); "
+                f"already in acquisition {acquisitionID or 'unknown'}."
+            )
+            return True
 
-        self.RestClient: FWClient = FWClient(api_key=self.APIKey)
-        self.SDKClient = flywheel.Client(self.APIKey)
+        keys = job.index.instanceKeys
+        known = self.instanceIndex.knownInstances(keys[row] for row in job.rows)
+        if not known:
+            return False
 
-        self.imageList: List = []
-        self.sessionList: List = []
+        job.rows = array("I", (row for row in job.rows if keys[row] not in known))
+        self.duplicateInstances += job.instanceCount - len(job.rows)
+        if not job.rows:
+            logger.info(
+                f"Skipping series {job.seriesNumber} ({job.seriesUID}); "
+                "every instance is already in the project."
+            )
+            return True
+
+        job.uploadDigest = self.seriesDigest(job)
+        logger.info(
+            f"Series {job.seriesNumber} ({job.seriesUID}): "
+            f"{job.instanceCount - len(job.rows)} instances already in the "
+            f"project, uploading {len(job.rows)}."
+        )
+        return False
 
-    def setProject(self, project_name: str) -> None:
+    def packageSeries(self, job: SeriesJob) -> Tuple[BinaryIO, int]:
         """
-        Locate and set the Flywheel project matching a prefix string.
+        Write the members of one series into a spooled ZIP buffer.
+
+        Member data is copied from the input archive without being
+        decompressed or recompressed (see `SeriesZipWriter`). The buffer
+        lives in memory until it exceeds `spoolThreshold` bytes, after which
+        it is transparently moved to an anonymous temporary file.
 
         Parameters
         ----------
-        project_name : str
-            Prefix of the Flywheel project label. The first matching project
-            returned by the REST API list will be selected.
+        job : SeriesJob
+            Series to package.
 
         Returns
         -------
-        None
-
-        Raises
-        ------
-        Exception
-            If project listing or retrieval fails.
-        ValueError
-            If no project label begins with the provided prefix.
+        Tuple[BinaryIO, int]
+            Buffer positioned at the start of the ZIP, and the ZIP size.
+            The caller is responsible for closing the buffer.
         """
+        logger.info(f"Packaging series {job.seriesNumber} -> {job.zipFileName}")
+
+        # The buffer outlives this call; the uploader closes it after sending.
+        bundle = tempfile.SpooledTemporaryFile(max_size=self.spoolThreshold)  # noqa: SIM115
         try:
-            project_list = self.RestClient.get("/api/projects")
-        except Exception as e:
-            logger.error(f"Error retrieving project list: {e}")
+            with self.metrics.stage("package"), open(self.fileSpec, "rb") as src:
+                writer = SeriesZipWriter(bundle)
+                for row in job.rows:
+                    info = job.index.info(row)
+                    writer.addMember(self.zip, src, info, path.basename(info.filename))
+                writer.close()
+        except BaseException:
+            bundle.close()
             raise
 
-        for p in project_list:
-            if p.label.startswith(project_name):
-                try:
-                    self.project = self.SDKClient.get_project(p._id)  # noqa: SLF001
-                except Exception as e:
-                    logger.error(f"Cannot fetch project '{project_name}' via SDK: {e}")
-                    raise
-                logger.info(f"Project set: {self.project.label}")
-                return
+        self.metrics.addVolume("package", len(job.rows), writer.offset)
+        bundle.seek(0)
+        return bundle, writer.offset
 
-        raise ValueError(f"No project found starting with '{project_name}'")
-
-    def CollectImageInformation(self) -> None:
+    def resolveAcquisition(self, job: SeriesJob, segIndex: int):
         """
-        Collect all Flywheel file objects from every acquisition in the project.
+        Find or create the subject, session and acquisition for a series.
+
+        Lookups are served from the connector's hierarchy index, which is
+        shared by all uploader threads and only calls the API to create
+        containers that do not exist yet.
+
+        Parameters
+        ----------
+        job : SeriesJob
+            Series whose first member path supplies the labels.
+        segIndex : int
+            Index of the path segment containing the subject label.
 
         Returns
         -------
-        None
-
-        Raises
-        ------
-        RuntimeError
-            If no project has been initialized.
-        Exception
-            If any SDK iteration fails.
+        flywheel.Acquisition
+            Acquisition the series ZIP is uploaded to.
         """
-        if not self.project:
-            raise RuntimeError("Project not initialized before image collection.")
+        segments = job.index.name(job.rows[0]).split("/")
+        subject_label = segments[segIndex]
+        session_label = f"{job.studyDate}_MRI"
+        acquisition_label = segments[segIndex + 1]
 
-        self.imageList = []
+        with self.metrics.stage("resolve"):
+            subject = self.fc.getSubject(subject_label)
+            session = self.fc.getSession(subject, session_label)
+            return self.fc.getAcquisition(session, acquisition_label)
+
+    def recordFailure(self, job: SeriesJob, stage: str, error: Exception) -> None:
+        """Log a failed series and remember it without stopping the run."""
+        logger.error(f"Failed to {stage} series {job.seriesUID}: {error}")
+        with self.failureLock:
+            self.failedSeries.append(job.seriesUID)
+        if self.journal is not None:
+            self.journal.record(job.seriesUID, job.instanceCount, job.digest, "failed")
+
+    def packageWorker(self, job: SeriesJob, uploadQueue: "queue.Queue") -> None:
+        """Package one series and hand it to the upload queue."""
         try:
-            for subject in self.project.subjects.iter():
-                for session in subject.sessions.iter():
-                    for acq in session.acquisitions.iter():
-                        for f in acq.files:
-                            self.imageList.append(f)
+            bundle, size = self.packageSeries(job)
+        except (OSError, zipfile.BadZipFile, RuntimeError, NotImplementedError) as e:
+            # RuntimeError/NotImplementedError: encrypted members or methods
+            # zipfile cannot decompress for the stored fallback.
+            self.recordFailure(job, "package", e)
+            return
         except Exception as e:
-            logger.error(f"Error collecting image information: {e}")
-            raise
+            # A corrupt member can also raise zlib.error, struct.error or
+            # ValueError; fail this series only, with its traceback.
+            logger.exception(f"Unexpected error packaging {job.seriesUID}")
+            self.recordFailure(job, "package", e)
+            return
+
+        # Blocks while the queue is full, which throttles packaging to the
+        # pace of the uploaders and bounds buffered memory and disk usage.
+        uploadQueue.put((job, bundle, size))
+
+    def uploadWorker(self, uploadQueue: "queue.Queue", segIndex: int) -> None:
+        """Drain packaged series from the queue until a None sentinel."""
+        while True:
+            item = uploadQueue.get()
+            if item is None:
+                return
+
+            job, bundle, size = item
+            try:
+                acquisition = self.resolveAcquisition(job, segIndex)
 
-    def CollectSessionInformation(self) -> None:
+                logger.info(f"Uploading {job.zipFileName}…")
+                spec = flywheel.FileSpec(
+                    job.zipFileName, bundle, "application/zip", size
+                )
+                metadata = {
+                    "type": "dicom",
+                    "info": {
+                        "SeriesInstanceUID": job.seriesUID,
+                        # What this ZIP holds, which other hosts seed from.
+                        "seriesDigest": job.uploadDigest,
+                        "instanceCount": len(job.rows),
+                    },
+                }
+                self.metrics.count("api.uploadFile")
+                with self.metrics.stage("upload"):
+                    self.fc.uploadFile(acquisition, spec, metadata)
+                self.metrics.addVolume("upload", len(job.rows), size)
+
+                if self.journal is not None:
+                    self.journal.record(
+                        job.seriesUID,
+                        job.instanceCount,
+                        job.digest,
+                        "complete",
+                        acquisition.id,
+                    )
+                if self.instanceIndex is not None:
+                    self.instanceIndex.addSeries(
+                        job.seriesUID,
+                        job.uploadDigest,
+                        acquisition.id,
+                        (job.index.instanceKeys[row] for row in job.rows),
+                    )
+            except (OSError, flywheel.ApiException) as e:
+                self.recordFailure(job, "upload", e)
+            except Exception as e:
+                # Keep the uploader alive so the queue keeps draining; an
+                # unexpected error is still reported with its traceback.
+                logger.exception(f"Unexpected error uploading {job.seriesUID}")
+                self.recordFailure(job, "upload", e)
+            finally:
+                bundle.close()
+
+    def pendingJobs(self, index: ArchiveIndex) -> List[SeriesJob]:
+        """Group every subject into series, leaving out those to skip."""
+        jobs: List[SeriesJob] = []
+        for subject_label, rows in index.subjectRows.items():
+            for job in self.groupSeries(subject_label, rows):
+                if self.isComplete(job):
+                    self.skippedSeries.append(job.seriesUID)
+                elif self.isDuplicate(job):
+                    self.duplicateSeries.append(job.seriesUID)
+                else:
+                    jobs.append(job)
+        return jobs
+
+    def uploadImages(self, segIndex: int) -> None:
         """
-        Collect all session objects from every subject in the selected project.
+        Extract, group, package, and upload DICOMs to Flywheel.
+
+        Workflow:
+        1. Index the archive's DICOM members by the NACC ID in their path.
+        2. Group DICOMs by SeriesInstanceUID, reading headers in place on
+           `processes` worker processes.
+        3. Copy grouped members' compressed bytes into per-series ZIPs.
+        4. Ensure subject/session/acquisition exist in Flywheel.
+        5. Upload each ZIP to Flywheel with metadata.
+
+        Steps 3-5 run concurrently: packaging threads feed a bounded queue
+        that uploader threads drain. A failure in one series is logged and
+        recorded in `failedSeries` without affecting the others.
+
+        Parameters
+        ----------
+        segIndex : int
+            Index of the path segment containing the subject label.
 
         Returns
         -------
@@ -158,204 +3542,374 @@ class FlywheelConnector:
 
         Raises
         ------
-        RuntimeError
-            If project is not set.
         Exception
-            If SDK traversal fails.
+            If the archive cannot be scanned.
         """
-        if not self.project:
-            raise RuntimeError("Project not initialized before session collection.")
+        self.failedSeries = []
+        self.skippedSeries = []
+        self.duplicateSeries = []
+        self.duplicateInstances = 0
+        index = self.scanArchive()
+        self.readHeaders(index)
+
+        jobs = self.pendingJobs(index)
+
+        uploadQueue: queue.Queue = queue.Queue(maxsize=self.maxPending)
+        self.uploadQueue = uploadQueue
+        uploadThreads = [
+            threading.Thread(
+                target=self.uploadWorker, args=(uploadQueue, segIndex), daemon=True
+            )
+            for _ in range(self.uploaders)
+        ]
+        for t in uploadThreads:
+            t.start()
 
-        self.sessionList = []
         try:
-            for subject in self.project.subjects.iter():
-                for session in subject.sessions.iter():
-                    self.sessionList.append(session)
-        except Exception as e:
-            logger.error(f"Error collecting session information: {e}")
-            raise
+            with ThreadPoolExecutor(max_workers=self.workers) as packers:
+                futures = [
+                    packers.submit(self.packageWorker, job, uploadQueue) for job in jobs
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            for _ in uploadThreads:
+                uploadQueue.put(None)
+            for t in uploadThreads:
+                t.join()
+
+        if self.skippedSeries:
+            logger.info(f"{len(self.skippedSeries)} series were already uploaded.")
+        if self.duplicateSeries or self.duplicateInstances:
+            logger.info(
+                f"{len(self.duplicateSeries)} series and {self.duplicateInstances} "
+                "more instances were already in the project."
+            )
+        if self.failedSeries:
+            logger.warning(
+                f"{len(self.failedSeries)} of {len(jobs)} series failed to upload."
+            )
+        logger.info("Upload processing complete.")
 
 
 ###############################################################################
-# Upload Image Data
+# Ingest Service
 ###############################################################################
 
 
-class UploadImageData:
+class IngestService:
     """
-    UploadImageData.
+    IngestService.
 
-    Responsible for uploading DICOMs from an input ZIP file to Flywheel.
-    Files are grouped by SeriesInstanceUID and uploaded as per-series ZIPs.
+    Long-running ingest of the archives dropped into a watch directory.
+
+    The directory is polled for ZIP files. An archive is picked up once its
+    size and modification time have stayed the same for `settleSeconds`,
+    so files still being copied in are left alone. Up to `maxArchives`
+    archives are uploaded at once by `UploadImageData` on worker threads.
+    All of them share one authenticated `FlywheelConnector`, so its
+    hierarchy index, keep-alive connections and transport limiter (the
+    global limit on uploads in flight) carry over from archive to archive.
+    An archive with no failed series is moved to `doneDir`, any other to
+    `failedDir`, each with its JSON run report beside it. Upload journals
+    are kept in `stateDir`, so an archive dropped again after a failure
+    resumes where it stopped.
+
+    Archive reports cover the stages and uploads of their archive. The
+    lookups and retries of the shared connector cannot be told apart by
+    archive; they are counted in the connector's `RunMetrics`, written to
+    `reportSpec` when the service stops.
 
     Parameters
     ----------
     fc : FlywheelConnector
-        Initialized FlywheelConnector instance with project selected.
-    fileSpec : str
-        Path to the ZIP archive containing DICOM files.
+        Connector with the project set, ideally with a transport enabled.
+    watchDir : str
+        Directory watched for new archives.
+    doneDir : str, optional
+        Destination of ingested archives (default ``<watchDir>/done``).
+    failedDir : str, optional
+        Destination of failed archives (default ``<watchDir>/failed``).
+    stateDir : str, optional
+        Directory of the upload journals (default ``<watchDir>/.ingest``).
+    maxArchives : int, optional
+        Number of archives processed concurrently (default 2).
+    pollInterval : float, optional
+        Seconds between directory scans (default 5).
+    settleSeconds : float, optional
+        Seconds an archive must stay unchanged before ingest (default 10).
+    segIndex : int, optional
+        Index of the path segment containing the subject label (default 1).
+    uploaderOptions : Dict[str, Any], optional
+        Keyword arguments passed to every `UploadImageData`.
+    reportSpec : str, optional
+        Path of the service report (default
+        ``<stateDir>/service.report.json``).
 
     Attributes
     ----------
-    fc : FlywheelConnector
-        Connector used for Flywheel operations.
-    fileSpec : str
-        Provided ZIP file path.
-    zip : zipfile.ZipFile
-        Opened ZIP archive.
-    baseName : str
-        Base name of the input archive (without extension).
-
-    Raises
-    ------
-    Exception
-        If the ZIP archive cannot be opened.
+    ingested : List[str]
+        Destination paths of the archives moved to `doneDir`.
+    failed : List[str]
+        Destination paths of the archives moved to `failedDir`.
     """
 
-    def __init__(self, fc: FlywheelConnector, fileSpec: str):
+    def __init__(
+        self,
+        fc: FlywheelConnector,
+        watchDir: str,
+        doneDir: Optional[str] = None,
+        failedDir: Optional[str] = None,
+        stateDir: Optional[str] = None,
+        maxArchives: int = 2,
+        pollInterval: float = 5.0,
+        settleSeconds: float = 10.0,
+        segIndex: int = 1,
+        uploaderOptions: Optional[Dict[str, Any]] = None,
+        reportSpec: Optional[str] = None,
+    ):
         self.fc = fc
-        self.fileSpec = fileSpec
+        self.watchDir = watchDir
+        self.doneDir = doneDir or path.join(watchDir, "done")
+        self.failedDir = failedDir or path.join(watchDir, "failed")
+        self.stateDir = stateDir or path.join(watchDir, ".ingest")
+        self.maxArchives = max(1, maxArchives)
+        self.pollInterval = pollInterval
+        self.settleSeconds = settleSeconds
+        self.segIndex = segIndex
+        self.uploaderOptions = uploaderOptions or {}
+        self.reportSpec = reportSpec or path.join(self.stateDir, "service.report.json")
 
-        try:
-            self.zip = zipfile.ZipFile(fileSpec)
-        except Exception as e:
-            logger.error(f"Could not open zip file '{fileSpec}': {e}")
-            raise
-
-        self.baseName, _ = path.splitext(path.basename(fileSpec))
+        self.pending: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        self.active: Set[str] = set()
+        self.ingested: List[str] = []
+        self.failed: List[str] = []
+        self.stopping: Optional[asyncio.Event] = None
 
-    def uploadImages(self, segIndex: int) -> None:  # noqa: C901
+    def readyArchives(self, now: float) -> List[str]:
         """
-        Extract, group, package, and upload DICOMs to Flywheel.
-
-        Workflow:
-        1. Identify subject folders containing NACC IDs.
-        2. Group DICOMs by SeriesInstanceUID.
-        3. Extract grouped files to temporary directory.
-        4. Create ZIP archives per series.
-        5. Ensure subject/session/acquisition exist in Flywheel.
-        6. Upload each ZIP to Flywheel with metadata.
+        Return the archives in `watchDir` that are ready for ingest.
 
         Parameters
         ----------
-        segIndex : int
-            Index of the path segment containing the subject label.
+        now : float
+            Current `time.monotonic` value.
 
         Returns
         -------
-        None
+        List[str]
+            Paths of archives unchanged for at least `settleSeconds` that are
+            not already being processed.
+        """
+        seen: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        ready: List[str] = []
 
-        Raises
-        ------
-        Exception
-            On DICOM metadata read failure or Flywheel upload issues.
+        with os.scandir(self.watchDir) as entries:
+            for entry in entries:
+                if not entry.name.lower().endswith(".zip") or not entry.is_file():
+                    continue
+                if entry.path in self.active:
+                    continue
+
+                stat = entry.stat()
+                signature = (stat.st_size, stat.st_mtime_ns)
+                previous = self.pending.get(entry.path)
+                since = previous[1] if previous and previous[0] == signature else now
+                if now - since >= self.settleSeconds:
+                    ready.append(entry.path)
+                else:
+                    seen[entry.path] = (signature, since)
+
+        self.pending = seen
+        return sorted(ready)
+
+    def stop(self) -> None:
+        """Stop watching; archives already being uploaded are finished."""
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def run(self, handleSignals: bool = False) -> None:
         """
-        acqList: Dict[str, List[str]] = {}
+        Watch `watchDir` and ingest archives until `stop` is called.
 
-        logger.info("Scanning archive for DICOM files…")
+        Parameters
+        ----------
+        handleSignals : bool, optional
+            Call `stop` on SIGINT and SIGTERM (default False).
+        """
+        self.stopping = asyncio.Event()
+        if handleSignals:
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self.stop)
 
-        try:
-            for f in self.zip.namelist():
-                _, ext = path.splitext(f)
-                if ext.lower() != ".dcm":
-                    continue
+        for directory in (self.doneDir, self.failedDir, self.stateDir):
+            os.makedirs(directory, exist_ok=True)
 
-                segments = f.split("/")
-                subject_label = next((s for s in segments if "NACC" in s), None)
+        slots = asyncio.Semaphore(self.maxArchives)
+        tasks: Set[asyncio.Task] = set()
+        logger.info(f"Watching {self.watchDir} for archives…")
 
-                if subject_label is None:
-                    logger.warning(f"No NACC ID in file path: {f}")
-                    continue
+        try:
+            while not self.stopping.is_set():
+                for spec in self.readyArchives(time.monotonic()):
+                    self.active.add(spec)
+                    task = asyncio.create_task(self.ingest(spec, slots))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
 
-                acqList.setdefault(subject_label, []).append(f)
-        except Exception as e:
-            logger.error(f"Error scanning DICOM files: {e}")
-            raise
+                with suppress(TimeoutError):
+                    await asyncio.wait_for(self.stopping.wait(), self.pollInterval)
 
-        logger.info(f"Found {len(acqList)} subjects in archive.")
+            if tasks:
+                logger.info(f"Stopping after {len(tasks)} archives in progress…")
+                await asyncio.gather(*tasks)
+        finally:
+            self.writeReport()
+        logger.info("Ingest service stopped.")
 
-        for subject_label, file_list in acqList.items():
-            logger.info(
-                f"Processing subject {subject_label} with {len(file_list)} files…"
+    def writeReport(self) -> None:
+        """Write the service report of the shared connector, if it has metrics."""
+        if self.fc.metrics is None:
+            return
+        try:
+            self.fc.metrics.writeReport(
+                self.reportSpec,
+                watchDir=self.watchDir,
+                archives={"ingested": len(self.ingested), "failed": len(self.failed)},
             )
+        except OSError as e:
+            logger.error(f"Could not write service report: {e}")
 
-            with tempfile.TemporaryDirectory() as tmpDir:
-                zipFiles: Dict[str, List[str]] = {}
-                zipNumbers: Dict[str, List[int]] = {}
-                zipDates: Dict[str, List[str]] = {}
+    async def ingest(self, spec: str, slots: asyncio.Semaphore) -> None:
+        """Upload one archive once a slot is free, then file it away."""
+        async with slots:
+            if self.stopping.is_set():
+                # Not started yet: leave it for the next run of the service.
+                self.active.discard(spec)
+                return
 
-                try:
-                    for f in file_list:
-                        self.zip.extract(f, path=tmpDir)
-                        meta = pydicom.dcmread(
-                            path.join(tmpDir, f), stop_before_pixels=True
-                        )
+            logger.info(f"Ingesting {spec}")
+            metrics = RunMetrics()
+            ok = await asyncio.to_thread(self.uploadArchive, spec, metrics)
+
+        try:
+            self.finish(spec, ok, metrics)
+        except OSError as e:
+            # Stays in `active`, so it is not picked up again in a loop.
+            logger.error(f"Could not move {spec}: {e}")
 
-                        suid = meta.get((0x0020, 0x000E)).value
-                        studyDate = meta.get((0x0008, 0x0020)).value
-                        seriesNumber = meta.get((0x0020, 0x0011)).value
+    def uploadArchive(self, spec: str, metrics: RunMetrics) -> bool:
+        """Upload one archive, returning whether every series succeeded."""
+        uploader = None
+        try:
+            uploader = UploadImageData(
+                self.fc,
+                spec,
+                journalSpec=UploadJournal.pathFor(
+                    path.join(self.stateDir, path.basename(spec))
+                ),
+                metrics=metrics,
+                **self.uploaderOptions,
+            )
+            uploader.uploadImages(self.segIndex)
+        except (
+            ValueError,
+            OSError,
+            RuntimeError,
+            zipfile.BadZipFile,
+            flywheel.ApiException,
+        ) as e:
+            logger.error(f"Ingest of {spec} failed: {e}")
+            return False
+        finally:
+            if uploader is not None:
+                uploader.close()
 
-                        zipFiles.setdefault(suid, []).append(f)
-                        zipNumbers.setdefault(suid, []).append(seriesNumber)
-                        zipDates.setdefault(suid, []).append(studyDate)
+        return not uploader.failedSeries
 
-                except (OSError, KeyError, AttributeError) as e:
-                    logger.error(
-                        f"Metadata extraction failure for subject {subject_label}: {e}"
-                    )
-                    continue
+    def finish(self, spec: str, ok: bool, metrics: RunMetrics) -> str:
+        """Move an archive to the done or failed folder with its report."""
+        dest = path.join(self.doneDir if ok else self.failedDir, path.basename(spec))
+        if path.exists(dest):
+            stem, ext = path.splitext(dest)
+            dest = f"{stem}-{time.strftime('%Y%m%dT%H%M%S')}{ext}"
 
-                for suid, file_group in zipFiles.items():
-                    try:
-                        first_file = file_group[0]
-                        fileName = path.basename(first_file)
-                        series_no = zipNumbers[suid][0]
-                        date_str = zipDates[suid][0]
+        shutil.move(spec, dest)
+        self.active.discard(spec)
+        (self.ingested if ok else self.failed).append(dest)
+        logger.info(f"{'Ingested' if ok else 'Failed'}: {spec} -> {dest}")
 
-                        base_name = fileName.split("_br")[0]
-                        zipFileName = f"{series_no}-{base_name}.zip"
-                        zipPath = path.join(tmpDir, zipFileName)
+        try:
+            metrics.writeReport(
+                RunMetrics.pathFor(dest),
+                archive=dest,
+                status="done" if ok else "failed",
+            )
+        except OSError as e:
+            logger.error(f"Could not write run report: {e}")
+        return dest
 
-                        logger.info(f"Packaging series {series_no} -> {zipPath}")
 
-                        with zipfile.ZipFile(zipPath, "w") as zf:
-                            for f in file_group:
-                                zf.write(path.join(tmpDir, f), path.basename(f))
+###############################################################################
+# Catalogue Backfill
+###############################################################################
 
-                        segments = first_file.split("/")
-                        subject_label = segments[segIndex]
-                        session_label = f"{date_str}_MRI"
-                        acquisition_label = segments[segIndex + 1]
 
-                        subject = self.fc.project.subjects.find_first(
-                            f"label={subject_label}"
-                        )
-                        if not subject:
-                            logger.info(f"Creating new subject: {subject_label}")
-                            subject = self.fc.project.add_subject(label=subject_label)
+def backfillCatalogue(
+    catalogue: HeaderCatalogue,
+    archives: Iterable[str],
+    processes: int = 1,
+    metrics: Optional[RunMetrics] = None,
+) -> int:
+    """
+    Catalogue the headers of existing archives without uploading them.
 
-                        session = subject.sessions.find_first(f"label={session_label}")
-                        if not session:
-                            logger.info(f"Creating session: {session_label}")
-                            session = subject.add_session(label=session_label)
+    Each archive is indexed and its headers are read on `processes` worker
+    processes, exactly as during an upload, and recorded in `catalogue`.
+    An archive that cannot be read is logged and skipped.
 
-                        acquisition = session.acquisitions.find_first(
-                            f"label={acquisition_label}"
-                        )
-                        if not acquisition:
-                            logger.info(f"Creating acquisition: {acquisition_label}")
-                            acquisition = session.add_acquisition(
-                                label=acquisition_label
-                            )
+    Parameters
+    ----------
+    catalogue : HeaderCatalogue
+        Catalogue to fill.
+    archives : Iterable[str]
+        Paths of the archives.
+    processes : int, optional
+        Header parsing processes per archive (default 1).
+    metrics : RunMetrics, optional
+        Collector for the scan and header stages.
 
-                        logger.info(f"Uploading {zipFileName}…")
-                        acquisition.upload_file(zipPath, metadata={"type": "dicom"})
+    Returns
+    -------
+    int
+        Number of DICOM members catalogued.
+    """
+    total = 0
+    for fileSpec in archives:
+        logger.info(f"Cataloguing {fileSpec}")
+        try:
+            reader = UploadImageData(
+                None,
+                fileSpec,
+                processes=processes,
+                metrics=metrics,
+                catalogue=catalogue,
+            )
+        except (OSError, zipfile.BadZipFile):
+            continue  # Already logged by UploadImageData.
 
-                    except (OSError, flywheel.ApiException) as e:
-                        logger.error(f"Failed to upload series {suid}: {e}")
-                        continue
+        try:
+            index = reader.scanArchive()
+            reader.readHeaders(index)
+            total += len(index)
+        except (OSError, zipfile.BadZipFile) as e:
+            logger.error(f"Could not catalogue {fileSpec}: {e}")
+        finally:
+            reader.close()
 
-        logger.info("Upload processing complete.")
+    logger.info(f"Catalogued {total} DICOM files.")
+    return total
 
 
 ###############################################################################
@@ -415,6 +3969,295 @@ class Config:
 ###############################################################################
 
 
+def writeRunReport(
+    metrics: RunMetrics, args: argparse.Namespace, uploader: Optional[UploadImageData]
+) -> None:
+    """Write the JSON run report of `main`, logging rather than raising."""
+    series = None
+    if uploader is not None and uploader.index is not None:
+        series = {
+            "total": len(uploader.index.seriesRecords),
+            "skipped": len(uploader.skippedSeries),
+            "duplicate": len(uploader.duplicateSeries),
+            "duplicateInstances": int(uploader.duplicateInstances),
+            "failed": len(uploader.failedSeries),
+        }
+
+    try:
+        metrics.writeReport(
+            args.report or RunMetrics.pathFor(args.file),
+            archive=args.file,
+            settings={
+                "workers": args.workers,
+                "uploaders": args.uploaders or args.workers,
+                "processes": args.processes,
+                "spoolMB": args.spool_mb,
+                "pooledUploads": args.pooled_uploads,
+                "timeout": args.timeout,
+                "retries": args.retries,
+            },
+            series=series,
+        )
+    except OSError as e:
+        logger.error(f"Could not write run report: {e}")
+
+
+def openProjectCache() -> Optional[ProjectCache]:
+    """Open the per-user project cache, or return None if it is unusable."""
+    try:
+        return ProjectCache(ProjectCache.defaultPath())
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Project cache disabled: {e}")
+        return None
+
+
+def openInstanceIndex(fc: FlywheelConnector) -> Optional[InstanceIndex]:
+    """Open the project's instance index, seeding it on first use."""
+    index = None
+    try:
+        index = InstanceIndex(InstanceIndex.pathFor(fc.project.id))
+        seeded = index.isSeeded(fc.project.id)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Duplicate detection disabled: {e}")
+        if index is not None:
+            index.close()
+        return None
+
+    if not seeded:
+        try:
+            fc.SeedInstanceIndex(index)
+        except flywheel.ApiException as e:
+            logger.warning(f"Instance index not seeded from the project: {e}")
+    return index
+
+
+def openCatalogue(
+    args: argparse.Namespace, config: Optional[Config]
+) -> HeaderCatalogue:
+    """Open the header catalogue named on the command line."""
+    if args.catalogue_tags:
+        keywords = [k.strip() for k in args.catalogue_tags.split(",") if k.strip()]
+    else:
+        keywords = (config.get("catalogueTags") if config else None) or CATALOGUE_TAGS
+    return HeaderCatalogue(args.catalogue, keywords)
+
+
+def buildParser() -> argparse.ArgumentParser:
+    """Return the command-line parser of `main`."""
+    parser = argparse.ArgumentParser(description="LONI to Flywheel upload tool")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-f", "--file", help="Archive file name (zip)")
+    source.add_argument(
+        "--watch", metavar="DIR", help="Ingest archives dropped into DIR until stopped"
+    )
+    source.add_argument(
+        "--backfill",
+        nargs="+",
+        metavar="ZIP",
+        help="Catalogue the headers of archives without uploading",
+    )
+    source.add_argument(
+        "--inventory",
+        action="store_true",
+        help="Refresh the project's local inventory cache without uploading",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        default=path.join(".", "fwImageUpload.conf"),
+        help="Configuration file (default: ./fwImageUpload.conf)",
+    )
+    parser.add_argument("-s", "--segIndex", help="Path segment containing NACC ID")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=4, help="Series packaging threads"
+    )
+    parser.add_argument(
+        "-u", "--uploaders", type=int, help="Concurrent uploads (default: workers)"
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="DICOM header parsing processes (default: CPU count)",
+    )
+    parser.add_argument(
+        "--spool-mb",
+        type=int,
+        default=DEFAULT_SPOOL_THRESHOLD >> 20,
+        help="Series buffer size in MiB before spilling to disk",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--resume",
+        dest="force",
+        action="store_false",
+        help="Skip series already uploaded according to the journal (default)",
+    )
+    mode.add_argument(
+        "--force",
+        dest="force",
+        action="store_true",
+        help="Upload every series, ignoring the journal",
+    )
+    parser.set_defaults(force=False)
+    parser.add_argument(
+        "--pooled-uploads",
+        action="store_true",
+        help="Post uploads through the API server on pooled, retrying "
+        "connections instead of the SDK's signed-URL uploads",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=300.0,
+        help="Upload socket timeout in seconds (--pooled-uploads)",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=4,
+        help="Retries of a failed upload request (--pooled-uploads)",
+    )
+    parser.add_argument(
+        "--report",
+        help="JSON run report path (default: <archive>.report.json, or "
+        "<DIR>/.ingest/service.report.json with --watch)",
+    )
+    parser.add_argument(
+        "--progress",
+        type=float,
+        metavar="SECONDS",
+        help="Log a progress summary at this interval",
+    )
+    parser.add_argument("--done-dir", help="Destination of ingested archives")
+    parser.add_argument("--failed-dir", help="Destination of failed archives")
+    parser.add_argument(
+        "--max-archives",
+        type=int,
+        default=2,
+        help="Archives ingested concurrently in watch mode",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        help="Uploads in flight across all archives (default: uploaders)",
+    )
+    parser.add_argument(
+        "--poll", type=float, default=5.0, help="Watch directory scan interval"
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=10.0,
+        help="Seconds an archive must stay unchanged before ingest",
+    )
+    parser.add_argument(
+        "--project-cache-hours",
+        type=float,
+        default=PROJECT_CACHE_TTL / timedelta(hours=1),
+        help="Hours a cached project lookup is trusted (0: no cache)",
+    )
+    parser.add_argument(
+        "--no-dedupe",
+        dest="dedupe",
+        action="store_false",
+        help="Do not skip series and instances already in the project",
+    )
+    parser.add_argument(
+        "--full-sync",
+        action="store_true",
+        help="Re-list the whole project with --inventory, dropping deletions",
+    )
+    parser.add_argument("--catalogue", help="SQLite DICOM header catalogue")
+    parser.add_argument(
+        "--catalogue-tags", help="Comma-separated DICOM keywords to catalogue"
+    )
+    return parser
+
+
+def connect(
+    args: argparse.Namespace, api_key: str, project_name: str, metrics: RunMetrics
+) -> FlywheelConnector:
+    """
+    Connect to Flywheel and set the project.
+
+    Uploads use the SDK, which sends file contents to signed storage URLs,
+    unless ``--pooled-uploads`` enables the `Transport`. That transport
+    posts every byte through the API server, so it only pays off where
+    signed URLs are unavailable or unreliable.
+    """
+    fc = FlywheelConnector(api_key, metrics=metrics)
+    projectCache = openProjectCache() if args.project_cache_hours > 0 else None
+    try:
+        fc.setProject(
+            project_name,
+            cache=projectCache,
+            ttl=timedelta(hours=args.project_cache_hours),
+        )
+    finally:
+        if projectCache is not None:
+            projectCache.close()
+    concurrency = args.max_in_flight or args.uploaders or args.workers
+    if args.pooled_uploads:
+        fc.enableTransport(
+            concurrency=concurrency, readTimeout=args.timeout, retries=args.retries
+        )
+    else:
+        fc.limitUploads(concurrency)
+    return fc
+
+
+def uploaderOptions(
+    args: argparse.Namespace, config: Config, fc: FlywheelConnector
+) -> Dict[str, Any]:
+    """Return the `UploadImageData` keyword arguments, opening its stores."""
+    options: Dict[str, Any] = {
+        "workers": args.workers,
+        "uploaders": args.uploaders,
+        "force": args.force,
+        "spoolThreshold": args.spool_mb << 20,
+        "processes": args.processes,
+    }
+    if args.dedupe:
+        options["instanceIndex"] = openInstanceIndex(fc)
+    if args.catalogue:
+        options["catalogue"] = openCatalogue(args, config)
+    return options
+
+
+def runBackfill(args: argparse.Namespace) -> None:
+    """Fill the catalogue from the archives given with --backfill."""
+    catalogue = openCatalogue(args, None)
+    try:
+        backfillCatalogue(catalogue, args.backfill, processes=args.processes)
+    finally:
+        catalogue.close()
+
+
+def runInventory(fc: FlywheelConnector, args: argparse.Namespace) -> None:
+    """Bring the project's inventory cache up to date for --inventory."""
+    projectID = fc.project.id
+    cache = InventoryCache(InventoryCache.pathFor(projectID))
+    try:
+        fc.SyncInventory(cache, full=args.full_sync)
+        sessions = len(cache.containers(projectID, "session"))
+        files = len(cache.files(projectID))
+    finally:
+        cache.close()
+    logger.info(
+        f"Inventory cache {cache.fileSpec} holds {sessions} sessions and "
+        f"{files} acquisition files."
+    )
+
+
+def closeStores(*stores: Optional[SqliteStore]) -> None:
+    """Close the local stores that were opened."""
+    for store in stores:
+        if store is not None:
+            store.close()
+
+
 def main() -> None:
     """
     Entry point for the LONI → Flywheel upload tool.
@@ -424,10 +4267,69 @@ def main() -> None:
 
     Command-Line Arguments
     ----------------------
-    -f / --file : str (required)
+    -f / --file : str
         Path to ZIP archive of DICOMs.
+    --watch : str
+        Run as an ingest service on archives dropped into this directory
+        (exactly one of --file and --watch is required).
+    -c / --config : str (optional)
+        Configuration file (default ./fwImageUpload.conf).
     -s / --segIndex : int (optional)
         Index of path segment containing subject label in filenames.
+    -w / --workers : int (optional)
+        Number of series packaging threads (default 4).
+    -u / --uploaders : int (optional)
+        Number of concurrent uploads (defaults to --workers).
+    -p / --processes : int (optional)
+        Number of DICOM header parsing processes (default: CPU count).
+    --spool-mb : int (optional)
+        Per-series in-memory buffer size in MiB before spilling to disk
+        (default 64).
+    --resume / --force : flag (optional)
+        Skip series recorded as complete in the archive's upload journal
+        (default), or upload every series again.
+    --pooled-uploads : flag (optional)
+        Post uploads through the API server with the pooled, retrying
+        `Transport` instead of the SDK's signed-URL uploads.
+    --timeout : float (optional)
+        Seconds allowed for each socket read or write of a pooled upload
+        (default 300).
+    --retries : int (optional)
+        Retries of a failed pooled upload request (default 4).
+    --report : str (optional)
+        Path of the JSON run report (default: next to the archive), or of
+        the service report in watch mode (default:
+        ``<watch dir>/.ingest/service.report.json``).
+    --progress : float (optional)
+        Log a progress summary every this many seconds.
+    --done-dir / --failed-dir : str (optional)
+        Destinations of ingested and failed archives in watch mode (default
+        ``done`` and ``failed`` inside the watch directory).
+    --max-archives : int (optional)
+        Archives ingested concurrently in watch mode (default 2).
+    --max-in-flight : int (optional)
+        Uploads in flight across all archives (default: --uploaders).
+    --poll : float (optional)
+        Seconds between scans of the watch directory (default 5).
+    --settle : float (optional)
+        Seconds an archive must stay unchanged before ingest (default 10).
+    --project-cache-hours : float (optional)
+        Hours a cached project lookup is trusted; 0 disables the cache
+        (default 24).
+    --no-dedupe : flag (optional)
+        Do not skip series and instances already in the project.
+    --catalogue : str (optional)
+        SQLite header catalogue filled while uploading.
+    --catalogue-tags : str (optional)
+        Comma-separated DICOM keywords to catalogue (default
+        `CATALOGUE_TAGS`, or the config's ``catalogueTags`` list).
+    --backfill : str, ...
+        Only catalogue these archives into --catalogue, without uploading.
+    --inventory : flag
+        Only bring the project's local `InventoryCache` up to date.
+    --full-sync : flag (optional)
+        Re-list the whole project with --inventory, dropping deleted
+        containers from the cache.
 
     Returns
     -------
@@ -437,14 +4339,18 @@ def main() -> None:
     ----------
     1 : Missing configuration, project not found, upload failure.
     """
-    parser = argparse.ArgumentParser(description="LONI to Flywheel upload tool")
-    parser.add_argument("-f", "--file", required=True, help="Archive file name (zip)")
-    parser.add_argument("-s", "--segIndex", help="Path segment containing NACC ID")
+    parser = buildParser()
     args = parser.parse_args()
 
+    if args.backfill:
+        if not args.catalogue:
+            parser.error("--backfill requires --catalogue")
+        runBackfill(args)
+        return
+
     segIndex = int(args.segIndex) if args.segIndex else 1
 
-    config = Config(path.join(".", "fwImageUpload.conf"))
+    config = Config(args.config)
     api_key = os.getenv("FLYWHEEL_API_KEY") or config.get("APIKey")
     if not api_key:
         raise ValueError(
@@ -458,14 +4364,55 @@ def main() -> None:
 
     logger.info(f"Connecting to Flywheel with project prefix: {project_name}")
 
+    metrics = RunMetrics()
+    if args.progress:
+        metrics.startProgress(args.progress)
+
+    uploader = None
+    options: Dict[str, Any] = {}
     try:
-        fc = FlywheelConnector(api_key)
-        fc.setProject(project_name)
-        uploader = UploadImageData(fc, args.file)
-        uploader.uploadImages(segIndex)
-    except (ValueError, OSError, zipfile.BadZipFile, flywheel.ApiException) as e:
+        fc = connect(args, api_key, project_name, metrics)
+        if args.inventory:
+            runInventory(fc, args)
+            return
+        options = uploaderOptions(args, config, fc)
+        if args.watch:
+            service = IngestService(
+                fc,
+                args.watch,
+                doneDir=args.done_dir,
+                failedDir=args.failed_dir,
+                maxArchives=args.max_archives,
+                pollInterval=args.poll,
+                settleSeconds=args.settle,
+                segIndex=segIndex,
+                uploaderOptions=options,
+                reportSpec=args.report,
+            )
+            asyncio.run(service.run(handleSignals=True))
+        else:
+            uploader = UploadImageData(
+                fc,
+                args.file,
+                journalSpec=UploadJournal.pathFor(args.file),
+                metrics=metrics,
+                **options,
+            )
+            uploader.uploadImages(segIndex)
+    except (
+        ValueError,
+        OSError,
+        sqlite3.Error,
+        zipfile.BadZipFile,
+        flywheel.ApiException,
+    ) as e:
         logger.error(f"Fatal error: {e}")
         sys.exit(1)
+    finally:
+        metrics.stopProgress()
+        closeStores(options.get("instanceIndex"), options.get("catalogue"))
+        if args.file:
+            writeRunReport(metrics, args, uploader)
 
 
 if __name__ == "__main__":
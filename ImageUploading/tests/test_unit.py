@@ -1,11 +1,22 @@
+import asyncio
+import io
 import json
 import os
 import sys
+import threading
+import time
 import zipfile
-from pathlib import Path
+import zlib
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from os import path
 from unittest.mock import MagicMock, patch
 
+import flywheel
+import pydicom
 import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
 
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(parent_dir)
@@ -17,6 +28,13 @@ from fwImageUpload import FlywheelConnector  # noqa: E402
 # --------------------------------------------------
 
 
+@pytest.fixture(autouse=True)
+def run_in_tmp_path(tmp_path, monkeypatch):
+    """Keep run reports and caches out of the working tree and home."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+
 class MockMeta:
     """Mock pydicom metadata."""
 
@@ -25,12 +43,35 @@ class MockMeta:
             (0x0020, 0x000E): MagicMock(value="SERIES123"),
             (0x0008, 0x0020): MagicMock(value="20240101"),
             (0x0020, 0x0011): MagicMock(value=5),
+            (0x0008, 0x0018): MagicMock(value="1.1.1"),
         }
 
     def get(self, key):
         return self.data[key]
 
 
+def make_dicom_bytes(
+    series_uid, series_number=5, study_date="20240101", sop_uid=None, **attributes
+):
+    """Serialize a minimal DICOM instance carrying the series grouping tags."""
+    ds = Dataset()
+    for keyword, value in attributes.items():
+        setattr(ds, keyword, value)
+    ds.SOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+    ds.SOPInstanceUID = sop_uid or pydicom.uid.generate_uid()
+    ds.SeriesInstanceUID = series_uid
+    ds.SeriesNumber = series_number
+    ds.StudyDate = study_date
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+    buf = io.BytesIO()
+    ds.save_as(buf, enforce_file_format=True)
+    return buf.getvalue()
+
+
 def make_mock_project():
     """Create nested Flywheel mock structure."""
     acquisition = MagicMock()
@@ -95,8 +136,55 @@ def test_set_project_not_found(mock_sdk, mock_rest):
         fc.setProject("MISSING")
 
 
+@patch("fwImageUpload.FWClient")
+@patch("fwImageUpload.flywheel.Client")
+def test_set_project_uses_cache(mock_sdk, mock_rest, tmp_path):
+    rest = mock_rest.return_value
+    rest.base_url = "https://fw.example.org"
+    rest.get.return_value = [
+        MagicMock(label="OTHER", _id="122"),
+        MagicMock(label="TEST_PROJECT", _id="123"),
+    ]
+    mock_sdk.return_value.get_project.return_value = MagicMock(label="TEST_PROJECT")
+    cache = fwImageUpload.ProjectCache(str(tmp_path / "projects.sqlite"))
+
+    fwImageUpload.FlywheelConnector("key").setProject("TEST", cache=cache)
+    assert rest.get.call_args.kwargs["params"] == {"filter": "label=~^TEST"}
+
+    rest.get.reset_mock()
+    fc = fwImageUpload.FlywheelConnector("key")
+    fc.setProject("TEST", cache=cache)
+
+    rest.get.assert_not_called()
+    mock_sdk.return_value.get_project.assert_called_with("123")
+    assert cache.lookup("fw.example.org", "TEST") == "123"
+    assert cache.lookup("fw.example.org", "TEST", ttl=timedelta(seconds=-1)) is None
+    assert cache.lookup("other.example.org", "TEST") is None
+
+
+@patch("fwImageUpload.FWClient")
+@patch("fwImageUpload.flywheel.Client")
+def test_set_project_replaces_stale_cache_entry(mock_sdk, mock_rest, tmp_path):
+    rest = mock_rest.return_value
+    rest.base_url = "https://fw.example.org"
+    rest.get.return_value = [MagicMock(label="TEST_PROJECT", _id="456")]
+    project = MagicMock(label="TEST_PROJECT")
+    mock_sdk.return_value.get_project.side_effect = [
+        flywheel.ApiException(status=404),
+        project,
+    ]
+    cache = fwImageUpload.ProjectCache(str(tmp_path / "projects.sqlite"))
+    cache.store("fw.example.org", "TEST", "123", "TEST_PROJECT")
+
+    fc = fwImageUpload.FlywheelConnector("key")
+    fc.setProject("TEST", cache=cache)
+
+    assert fc.project is project
+    assert cache.lookup("fw.example.org", "TEST") == "456"
+
+
 def test_collect_image_information_no_project():
-    fc = fwImageUpload.FlywheelConnector.__new__(fwImageUpload.FlywheelConnector)
+    fc = FlywheelConnector.__new__(FlywheelConnector)
     fc.project = None
 
     with pytest.raises(RuntimeError):
@@ -104,13 +192,142 @@ def test_collect_image_information_no_project():
 
 
 def test_collect_session_information_no_project():
-    fc = fwImageUpload.FlywheelConnector.__new__(fwImageUpload.FlywheelConnector)
+    fc = FlywheelConnector.__new__(FlywheelConnector)
     fc.project = None
 
     with pytest.raises(RuntimeError):
         fc.CollectSessionInformation()
 
 
+def make_multi_subject_project(n_subjects, files_per_subject=2):
+    """Project whose subjects each hold one session/acquisition with files."""
+    subjects = []
+    for i in range(n_subjects):
+        acquisition = MagicMock()
+        acquisition.files = [f"s{i}-f{j}" for j in range(files_per_subject)]
+        session = MagicMock(label=f"ses{i}")
+        session.acquisitions.iter.return_value = [acquisition]
+        subject = MagicMock()
+        subject.sessions.iter.return_value = [session]
+        subjects.append(subject)
+
+    project = make_mock_project()
+    project.subjects.iter.return_value = subjects
+    return project
+
+
+def make_connector(project):
+    fc = FlywheelConnector.__new__(FlywheelConnector)
+    fc.project = project
+    return fc
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_collect_image_information(workers):
+    fc = make_connector(make_multi_subject_project(10))
+
+    fc.CollectImageInformation(workers=workers)
+
+    assert sorted(fc.imageList) == sorted(
+        f"s{i}-f{j}" for i in range(10) for j in range(2)
+    )
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_collect_session_information(workers):
+    fc = make_connector(make_multi_subject_project(6))
+
+    fc.CollectSessionInformation(workers=workers)
+
+    assert sorted(s.label for s in fc.sessionList) == [f"ses{i}" for i in range(6)]
+
+
+def test_iter_image_information_streams_before_crawl_finishes():
+    project = make_multi_subject_project(50)
+    crawled = []
+
+    def track(subject):
+        sessions = subject.sessions.iter.return_value
+
+        def iter_sessions():
+            crawled.append(subject)
+            return sessions
+
+        subject.sessions.iter.side_effect = iter_sessions
+
+    for subject in project.subjects.iter.return_value:
+        track(subject)
+    fc = make_connector(project)
+
+    first = next(fc.IterImageInformation(workers=2))
+
+    assert first.startswith("s")
+    assert len(crawled) < 50
+
+
+def test_collect_image_information_empty_project():
+    fc = make_connector(make_mock_project())
+
+    fc.CollectImageInformation(workers=2)
+
+    assert fc.imageList == []
+
+
+def make_indexed_connector():
+    """Connector over a project with one subject/session/acquisition."""
+    subject = MagicMock(id="sub1", label="NACC001")
+    session = MagicMock(id="ses1", label="20240101_MRI")
+    session.parents.subject = "sub1"
+    acquisition = MagicMock(id="acq1", label="acq1")
+    acquisition.parents.session = "ses1"
+
+    fc = FlywheelConnector.__new__(FlywheelConnector)
+    fc.project = MagicMock(id="proj1")
+    fc.project.subjects.iter.return_value = [subject]
+    fc.project.sessions.iter.return_value = [session]
+    fc.SDKClient = MagicMock()
+    fc.SDKClient.acquisitions.iter_find.return_value = [acquisition]
+    fc.indexLoaded = False
+    fc.indexLock = threading.RLock()
+    return fc, subject, session, acquisition
+
+
+def test_hierarchy_index_resolves_existing_containers_locally():
+    fc, subject, session, acquisition = make_indexed_connector()
+
+    for _ in range(3):
+        found_subject = fc.getSubject("NACC001")
+        found_session = fc.getSession(found_subject, "20240101_MRI")
+        found_acq = fc.getAcquisition(found_session, "acq1")
+
+    assert (found_subject, found_session, found_acq) == (subject, session, acquisition)
+    fc.project.subjects.iter.assert_called_once()
+    fc.SDKClient.acquisitions.iter_find.assert_called_once_with("parents.project=proj1")
+    fc.project.subjects.find_first.assert_not_called()
+    fc.project.add_subject.assert_not_called()
+
+
+def test_hierarchy_index_caches_created_containers():
+    fc, subject, _, _ = make_indexed_connector()
+    new_session = MagicMock(id="ses2")
+    subject.add_session.return_value = new_session
+
+    first = fc.getSession(subject, "20250101_MRI")
+    second = fc.getSession(subject, "20250101_MRI")
+
+    assert first is second is new_session
+    subject.add_session.assert_called_once_with(label="20250101_MRI")
+
+
+def test_hierarchy_index_no_project():
+    fc = FlywheelConnector.__new__(FlywheelConnector)
+    fc.project = None
+    fc.indexLock = threading.RLock()
+
+    with pytest.raises(RuntimeError):
+        fc.loadHierarchyIndex()
+
+
 # --------------------------------------------------
 # Config
 # --------------------------------------------------
@@ -157,72 +374,868 @@ def test_upload_init_failure(mock_zip):
 
 
 @patch("fwImageUpload.pydicom.dcmread")
-@patch("fwImageUpload.zipfile.ZipFile")
-def test_upload_images_basic(mock_zip, mock_dcmread, tmp_path):
-    """End-to-end uploadImages test with mocks."""
+def test_upload_images_basic(mock_dcmread, tmp_path):
+    """End-to-end uploadImages test with mocked headers and Flywheel."""
     # ---- Setup ZIP ----
-    zip_inst = mock_zip.return_value
-    zip_inst.namelist.return_value = [
-        "root/NACC001/acq1/file1.dcm",
-        "root/NACC001/acq1/file2.dcm",
-    ]
-
-    def extract_mock(src, path):
-        full = Path(path) / src
-        full.parent.mkdir(parents=True, exist_ok=True)
-        full.write_text("fake")
-
-    zip_inst.extract.side_effect = extract_mock
+    archive = tmp_path / "fake.zip"
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("root/NACC001/acq1/file1.dcm", b"fake" * 100)
+        zf.writestr("root/NACC001/acq1/file2.dcm", b"fake" * 100)
 
     # ---- DICOM ----
     mock_dcmread.return_value = MockMeta()
 
     # ---- Flywheel hierarchy ----
     acquisition = MagicMock()
-    acquisition.upload_file = MagicMock()
+    uploaded = {}
 
-    session = MagicMock()
-    session.acquisitions.find_first.return_value = acquisition
+    def upload(spec, metadata):
+        with zipfile.ZipFile(spec.contents) as zf:
+            assert zf.testzip() is None
+            uploaded[spec.name] = zf.namelist()
 
-    subject = MagicMock()
-    subject.sessions.find_first.return_value = session
+    acquisition.upload_file.side_effect = upload
 
-    project = MagicMock()
-    project.subjects.find_first.return_value = subject
-
-    fc = MagicMock()
-    fc.project = project
+    fc = make_sdk_upload_connector()
+    fc.getAcquisition.return_value = acquisition
 
     # ---- Run ----
-    uploader = fwImageUpload.UploadImageData(fc, "fake.zip")
+    uploader = fwImageUpload.UploadImageData(fc, str(archive))
+    uploader.uploadImages(segIndex=1)
 
-    with patch("tempfile.TemporaryDirectory") as tmpdir:
-        tmpdir.return_value.__enter__.return_value = tmp_path
+    # ---- Assert one series ZIP with both instances was uploaded ----
+    assert uploaded == {"5-file1.dcm.zip": ["file1.dcm", "file2.dcm"]}
 
-        uploader.uploadImages(segIndex=1)
 
-    # ---- Assert upload called ----
-    assert acquisition.upload_file.called
+def test_read_series_header_from_archive(tmp_path):
+    archive = tmp_path / "in.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr(
+            "root/NACC001/acq1/file1.dcm",
+            make_dicom_bytes("1.2.3", 7, sop_uid="1.2.3.4"),
+        )
+
+    uploader = fwImageUpload.UploadImageData(MagicMock(), str(archive))
+
+    assert uploader.readSeriesHeader("root/NACC001/acq1/file1.dcm") == (
+        "1.2.3",
+        "20240101",
+        7,
+        "1.2.3.4",
+    )
+    assert list(tmp_path.iterdir()) == [archive]
 
 
 @patch("fwImageUpload.pydicom.dcmread")
 @patch("fwImageUpload.zipfile.ZipFile")
-def test_upload_images_no_nacc(mock_zip, mock_dcmread, tmp_path):
+def test_upload_images_no_nacc(mock_zip, mock_dcmread):
     zip_inst = mock_zip.return_value
-    zip_inst.namelist.return_value = ["root/NOID/file.dcm"]
+    zip_inst.infolist.return_value = [zipfile.ZipInfo("root/NOID/file.dcm")]
 
     fc = MagicMock()
     fc.project = MagicMock()
 
     uploader = fwImageUpload.UploadImageData(fc, "fake.zip")
+    uploader.uploadImages(segIndex=1)
+
+    # Should silently skip
+    mock_dcmread.assert_not_called()
+    fc.getAcquisition.assert_not_called()
+    fc.uploadFile.assert_not_called()
+
+
+def make_series_archive(tmp_path, series):
+    """Write a NACC-style archive with one instance per (uid, number) pair."""
+    archive = tmp_path / "in.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        for uid, number in series:
+            zf.writestr(
+                f"root/NACC001/acq{number}/img_br{number}.dcm",
+                make_dicom_bytes(uid, number),
+            )
+    return archive
+
+
+def make_sdk_upload_connector():
+    """Mock connector whose uploads fall back to the SDK, as without transport."""
+    fc = MagicMock(transport=None)
+    fc.uploadFile.side_effect = partial(FlywheelConnector.uploadFile, fc)
+    return fc
+
+
+def make_mock_connector():
+    """Connector that resolves every series to the same acquisition."""
+    acquisition = MagicMock()
+    fc = make_sdk_upload_connector()
+    fc.getAcquisition.return_value = acquisition
+    return fc, acquisition
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_read_headers_across_processes(tmp_path, monkeypatch, processes):
+    monkeypatch.setattr(fwImageUpload, "HEADER_SHARD_SIZE", 1)
+    archive = make_series_archive(tmp_path, [("1.1", 1), ("1.2", 2), ("1.3", 3)])
+    with zipfile.ZipFile(archive, "a") as zf:
+        zf.writestr("root/NACC001/acq4/broken.dcm", b"not a dicom")
+
+    uploader = fwImageUpload.UploadImageData(
+        MagicMock(), str(archive), processes=processes
+    )
+    index = uploader.scanArchive()
+    uploader.readHeaders(index)
+
+    headers = {
+        index.name(row): index.seriesRecords[index.series[row]]
+        for row in range(len(index))
+        if index.series[row] >= 0
+    }
+    assert headers == {
+        f"root/NACC001/acq{n}/img_br{n}.dcm": (f"1.{n}", n, "20240101")
+        for n in (1, 2, 3)
+    }
+    assert uploader.groupSeries("NACC001", index.subjectRows["NACC001"]) == []
+
+
+def test_archive_index_keeps_one_record_per_series(tmp_path):
+    archive = tmp_path / "in.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        for subject in ("NACC001", "NACC002"):
+            for n in range(3):
+                zf.writestr(
+                    f"root/{subject}/acq/img{n}_br1.dcm",
+                    make_dicom_bytes(f"1.{subject[-1]}", 4),
+                )
+        zf.writestr("root/NOID/img.dcm", b"")
+        zf.writestr("root/NACC001/notes.txt", b"")
+
+    uploader = fwImageUpload.UploadImageData(MagicMock(), str(archive))
+    index = uploader.scanArchive()
+    uploader.readHeaders(index)
+
+    assert len(index) == 6
+    assert index.unlabelled == 1
+    assert {k: list(v) for k, v in index.subjectRows.items()} == {
+        "NACC001": [0, 1, 2],
+        "NACC002": [3, 4, 5],
+    }
+    assert index.seriesRecords == [
+        ("1.1", 4, "20240101"),
+        ("1.2", 4, "20240101"),
+    ]
+    assert list(index.series) == [0, 0, 0, 1, 1, 1]
+
+    (job,) = uploader.groupSeries("NACC002", index.subjectRows["NACC002"])
+    assert job.files == [f"root/NACC002/acq/img{n}_br1.dcm" for n in range(3)]
+    assert job.zipFileName == "4-img0.zip"
+
+
+@pytest.mark.parametrize(
+    ("name", "label"),
+    [
+        ("root/NACC001/acq/f.dcm", "NACC001"),
+        ("NACC001/f.dcm", "NACC001"),
+        ("root/x-NACC9", "x-NACC9"),
+        ("root/NOID/f.dcm", None),
+    ],
+)
+def test_subject_segment(name, label):
+    assert fwImageUpload.subjectSegment(name) == label
+
+
+def test_upload_images_isolates_failed_series(tmp_path):
+    archive = make_series_archive(tmp_path, [("1.1", 1), ("1.2", 2), ("1.3", 3)])
+    fc, acquisition = make_mock_connector()
+
+    def upload(spec, metadata):
+        if spec.name.startswith("2-"):
+            raise flywheel.ApiException(status=500, reason="boom")
 
-    with patch("tempfile.TemporaryDirectory") as tmpdir:
-        tmpdir.return_value.__enter__.return_value = tmp_path
+    acquisition.upload_file.side_effect = upload
 
+    uploader = fwImageUpload.UploadImageData(fc, str(archive), workers=2)
+    uploader.uploadImages(segIndex=1)
+
+    assert acquisition.upload_file.call_count == 3
+    assert uploader.failedSeries == ["1.2"]
+
+
+def test_upload_images_isolates_unexpected_packaging_errors(tmp_path, caplog):
+    archive = make_series_archive(tmp_path, [("1.1", 1), ("1.2", 2), ("1.3", 3)])
+    fc, acquisition = make_mock_connector()
+    uploader = fwImageUpload.UploadImageData(fc, str(archive), workers=2)
+    package = uploader.packageSeries
+
+    def corrupt(job):
+        if job.seriesUID == "1.2":
+            raise zlib.error("invalid stored block lengths")
+        return package(job)
+
+    with patch.object(uploader, "packageSeries", side_effect=corrupt):
         uploader.uploadImages(segIndex=1)
 
-    # Should silently skip
-    assert True
+    assert acquisition.upload_file.call_count == 2
+    assert uploader.failedSeries == ["1.2"]
+    assert "Unexpected error packaging 1.2" in caplog.text
+
+
+def write_instances(archive, instances):
+    """Write one NACC001 series instance per (member, SOPInstanceUID) pair."""
+    with zipfile.ZipFile(archive, "w") as zf:
+        for member, sop_uid in instances:
+            # Real NACC member names share everything before "_br".
+            zf.writestr(
+                f"root/NACC001/acq1/NACC001_MR_acq1_br_raw_{member}.dcm",
+                make_dicom_bytes("1.1", 1, sop_uid=sop_uid),
+            )
+    return str(archive)
+
+
+def test_instance_index_membership(tmp_path):
+    index = fwImageUpload.InstanceIndex(str(tmp_path / "instances.sqlite"))
+    keys = [fwImageUpload.instanceKey(f"1.2.{n}") for n in range(1200)]
+    index.addSeries("1.2", "digest", "acq", keys[:1000])
+
+    assert fwImageUpload.instanceKey("") == 0
+    assert len(set(keys)) == 1200
+    assert index.knownInstances([*keys, 0]) == set(keys[:1000])
+    assert index.seriesAcquisition("digest") == "acq"
+    assert index.seriesAcquisition("other") is None
+
+
+def test_upload_images_skips_instances_already_in_project(tmp_path):
+    index = fwImageUpload.InstanceIndex(str(tmp_path / "instances.sqlite"))
+    fc, acquisition = make_mock_connector()
+    acquisition.id = "acq1"
+    # Flywheel keeps one file per name in an acquisition.
+    stored = {}
+
+    def upload(spec, metadata):
+        with zipfile.ZipFile(spec.contents) as zf:
+            stored[spec.name] = (zf.namelist(), metadata["info"])
+
+    acquisition.upload_file.side_effect = upload
+
+    first = write_instances(tmp_path / "a.zip", [("i1", "1.1.1"), ("i2", "1.1.2")])
+    fwImageUpload.UploadImageData(fc, first, instanceIndex=index).uploadImages(1)
+    assert list(stored) == ["1-NACC001_MR_acq1.zip"]
+    original = stored["1-NACC001_MR_acq1.zip"]
+    assert original[1]["instanceCount"] == 2
+
+    # The same series resent whole, then with one new instance.
+    again = fwImageUpload.UploadImageData(fc, first, instanceIndex=index)
+    again.uploadImages(1)
+    resent = write_instances(
+        tmp_path / "b.zip", [("j1", "1.1.1"), ("j2", "1.1.2"), ("j3", "1.1.3")]
+    )
+    overlap = fwImageUpload.UploadImageData(fc, resent, instanceIndex=index)
+    overlap.uploadImages(1)
+
+    assert again.duplicateSeries == ["1.1"]
+    assert overlap.duplicateSeries == []
+    assert overlap.duplicateInstances == 2
+    assert acquisition.upload_file.call_count == 2
+    # The new instance went to a ZIP of its own; the original is untouched.
+    assert stored["1-NACC001_MR_acq1.zip"] == original
+    (partName,) = set(stored) - {"1-NACC001_MR_acq1.zip"}
+    assert partName.startswith("1-NACC001_MR_acq1-")
+    members, info = stored[partName]
+    assert members == ["NACC001_MR_acq1_br_raw_j3.dcm"]
+    assert info["instanceCount"] == 1
+    assert info["seriesDigest"] != original[1]["seriesDigest"]
+    assert index.seriesAcquisition(info["seriesDigest"]) == "acq1"
+
+
+def test_seed_instance_index_from_project_files(tmp_path):
+    fc = FlywheelConnector.__new__(FlywheelConnector)
+    fc.project = MagicMock(id="p1")
+    fc.SDKClient = MagicMock()
+    fc.SDKClient.acquisitions.iter_find.return_value = [
+        MagicMock(
+            id="acq1",
+            files=[
+                MagicMock(info={"SeriesInstanceUID": "1.1", "seriesDigest": "d1"}),
+                MagicMock(info={}),
+            ],
+        )
+    ]
+    index = fwImageUpload.InstanceIndex(str(tmp_path / "instances.sqlite"))
+
+    assert fc.SeedInstanceIndex(index) == 1
+    assert index.seriesAcquisition("d1") == "acq1"
+    assert index.isSeeded("p1")
+    fc.SDKClient.acquisitions.iter_find.assert_called_once_with("parents.project=p1")
+
+
+def write_megre_archive(archive, subject="NACC001", echoes=3):
+    """Write a multi-echo series and a single-echo series for one subject."""
+    with zipfile.ZipFile(archive, "w") as zf:
+        for echo in range(echoes):
+            zf.writestr(
+                f"root/{subject}/megre/e{echo}_br.dcm",
+                make_dicom_bytes(
+                    f"1.{subject[-1]}.1",
+                    1,
+                    SeriesDescription="MEGRE",
+                    EchoTime=4.0 * (echo + 1),
+                    ImageType=["ORIGINAL", "PRIMARY", "M"],
+                    Rows=256,
+                ),
+            )
+        zf.writestr(
+            f"root/{subject}/t1/t1_br.dcm",
+            make_dicom_bytes(
+                f"1.{subject[-1]}.2", 2, SeriesDescription="T1w", EchoTime=2.5
+            ),
+        )
+    return str(archive)
+
+
+def test_upload_images_fills_header_catalogue(tmp_path):
+    catalogue = fwImageUpload.HeaderCatalogue(str(tmp_path / "catalogue.sqlite"))
+    archive = write_megre_archive(tmp_path / "in.zip")
+    fc, _ = make_mock_connector()
+
+    uploader = fwImageUpload.UploadImageData(fc, archive, catalogue=catalogue)
+    uploader.uploadImages(segIndex=1)
+
+    (megre,) = catalogue.findSeries(
+        {"tags.SeriesDescription": "MEGRE", "tags.EchoTime.count": 3}
+    )
+    assert megre["subject"] == "NACC001"
+    assert megre["archive"] == "in.zip"
+    assert megre["instance_count"] == 3
+    assert megre["tags"]["EchoTime"] == [4.0, 8.0, 12.0]
+    assert megre["tags"]["ImageType"] == [["ORIGINAL", "PRIMARY", "M"]]
+    assert megre["tags"]["Rows"] == [256]
+    assert len(catalogue.findSeries()) == 2
+    assert catalogue.findSeries({"tags.EchoTime": 8.0}) == [megre]
+    assert catalogue.findSeries({"tags.EchoTime": ("<", 3.0)})[0]["series_number"] == 2
+    assert catalogue.findSeries({"subject": "NACC001", "series_number": 1}) == [megre]
+    assert catalogue.findSeries({"subject": ("LIKE", "NACC%")}) != []
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {"subject = subject OR 1": 1},
+        {"tags": "{}"},
+        {"tags.NotAKeyword": 1},
+        {"tags.EchoTime') OR 1 --": 1},
+        {"tags.EchoTime.length": 1},
+        {"subject": ("= subject OR 1 = ", 1)},
+    ],
+)
+def test_find_series_rejects_unknown_filters(tmp_path, filters):
+    catalogue = fwImageUpload.HeaderCatalogue(str(tmp_path / "catalogue.sqlite"))
+
+    with pytest.raises(ValueError):
+        catalogue.findSeries(filters)
+
+
+def test_find_series_binds_filter_values(tmp_path):
+    catalogue = fwImageUpload.HeaderCatalogue(str(tmp_path / "catalogue.sqlite"))
+    catalogue.addInstances("a.zip", [("m1", "1.1", {"SOPInstanceUID": "1.1.1"})])
+    catalogue.summariseSeries("a.zip", [("1.1", 1, "20240101", "NACC001")])
+
+    assert catalogue.findSeries({"subject": "x' OR '1' = '1"}) == []
+    assert len(catalogue.findSeries({"subject": "NACC001"})) == 1
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_backfill_catalogue(tmp_path, monkeypatch, processes):
+    monkeypatch.setattr(fwImageUpload, "HEADER_SHARD_SIZE", 1)
+    archives = [
+        write_megre_archive(tmp_path / "a.zip", "NACC001"),
+        write_megre_archive(tmp_path / "b.zip", "NACC002", echoes=2),
+        str(tmp_path / "missing.zip"),
+    ]
+    catalogue = fwImageUpload.HeaderCatalogue(
+        str(tmp_path / "catalogue.sqlite"), ["SeriesDescription", "EchoTime"]
+    )
+
+    total = fwImageUpload.backfillCatalogue(catalogue, archives, processes=processes)
+
+    found = catalogue.findSeries({"tags.EchoTime.count": (">", 1)})
+    assert total == 7
+    assert [(s["subject"], s["instance_count"]) for s in found] == [
+        ("NACC001", 3),
+        ("NACC002", 2),
+    ]
+    assert "Rows" not in found[0]["tags"]
+
+
+def test_catalogue_rejects_unknown_keywords(tmp_path):
+    with pytest.raises(ValueError, match="EchoTimes"):
+        fwImageUpload.HeaderCatalogue(str(tmp_path / "c.sqlite"), ["EchoTimes"])
+
+
+def test_upload_images_records_stage_metrics(tmp_path):
+    archive = make_series_archive(tmp_path, [("1.1", 1), ("1.2", 2)])
+    fc, _ = make_mock_connector()
+
+    uploader = fwImageUpload.UploadImageData(fc, str(archive), workers=2)
+    uploader.uploadImages(segIndex=1)
+    report = uploader.metrics.report()
+
+    stages = report["stages"]
+    assert list(stages) == ["scan", "headers", "group", "package", "resolve", "upload"]
+    assert stages["headers"]["files"] == 2
+    assert stages["package"]["calls"] == 2
+    assert stages["upload"]["files"] == 2
+    assert stages["upload"]["bytes"] == stages["package"]["bytes"] > 0
+    assert report["apiCalls"] == 2
+    assert report["retries"] == 0
+    json.dumps(report)
+
+
+def test_connector_counts_api_calls():
+    fc, subject, _, _ = make_indexed_connector()
+    fc.metrics = fwImageUpload.RunMetrics()
+
+    fc.getSession(subject, "20250101_MRI")
+    fc.getSession(subject, "20250101_MRI")
+
+    assert fc.metrics.counters == {
+        "retries": 0,
+        "api.listSubjects": 1,
+        "api.listSessions": 1,
+        "api.listAcquisitions": 1,
+        "api.addSession": 1,
+    }
+
+
+def test_benchmark_upload_against_stand_in(tmp_path):
+    from benchmarks import bench_upload, standin, synthetic
+
+    archive = str(tmp_path / "bench.zip")
+    files, _ = synthetic.writeArchive(archive, subjects=2, series=2, instances=3)
+
+    with standin.StandInServer(latency=0.001) as server:
+        fc = bench_upload.StandInConnector(server.url)
+        uploader = fwImageUpload.UploadImageData(fc, archive, workers=2)
+        uploader.uploadImages(segIndex=1)
+        stats = fc.transport.json("GET", "/api/stats")
+
+    assert files == 12
+    assert uploader.failedSeries == []
+    assert stats["containers"] == {"subjects": 2, "sessions": 2, "acquisitions": 4}
+    assert stats["uploads"] == 4
+    # Request bodies add multipart framing around each series ZIP.
+    zipped = uploader.metrics.report()["stages"]["upload"]["bytes"]
+    assert zipped < stats["uploadedBytes"] < zipped + 4 * 1024
+
+
+def test_ingest_service_files_archives_by_outcome(tmp_path):
+    from benchmarks import bench_upload, standin, synthetic
+
+    watch = tmp_path / "drop"
+    watch.mkdir()
+    synthetic.writeArchive(str(watch / "a.zip"), subjects=1, series=2, instances=2)
+    synthetic.writeArchive(
+        str(watch / "b.zip"), subjects=2, series=1, instances=2, seed=1
+    )
+    (watch / "broken.zip").write_bytes(b"not a zip")
+    (watch / "notes.txt").write_text("ignored")
+
+    with standin.StandInServer(latency=0.001) as server:
+        fc = bench_upload.StandInConnector(
+            server.url, concurrency=2, metrics=fwImageUpload.RunMetrics()
+        )
+        service = fwImageUpload.IngestService(
+            fc, str(watch), maxArchives=2, pollInterval=0.05, settleSeconds=0
+        )
+
+        async def runUntilFiled():
+            task = asyncio.create_task(service.run())
+            while len(service.ingested) + len(service.failed) < 3:
+                await asyncio.sleep(0.05)
+            service.stop()
+            await task
+
+        asyncio.run(asyncio.wait_for(runUntilFiled(), 60))
+        stats = fc.transport.json("GET", "/api/stats")
+
+    assert sorted(os.listdir(watch / "done")) == [
+        "a.zip",
+        "a.zip.report.json",
+        "b.zip",
+        "b.zip.report.json",
+    ]
+    assert sorted(os.listdir(watch / "failed")) == [
+        "broken.zip",
+        "broken.zip.report.json",
+    ]
+    assert (watch / "notes.txt").exists()
+    assert stats["uploads"] == 4
+    report = json.loads((watch / "done" / "a.zip.report.json").read_text())
+    assert report["status"] == "done"
+    assert report["stages"]["upload"]["calls"] == 2
+    # Container lookups of the shared connector are reported service-wide.
+    service_report = json.loads((watch / ".ingest" / "service.report.json").read_text())
+    assert service_report["archives"] == {"ingested": 2, "failed": 1}
+    subjects = [key for key in fc.containers if key[0] == "subjects"]
+    assert service_report["counters"]["api.addSubject"] == len(subjects) > 0
+
+
+def test_ingest_service_waits_for_archives_to_settle(tmp_path):
+    archive = tmp_path / "a.zip"
+    archive.write_bytes(b"partial")
+    service = fwImageUpload.IngestService(MagicMock(), str(tmp_path), settleSeconds=10)
+
+    assert service.readyArchives(100.0) == []
+    assert service.readyArchives(105.0) == []
+    archive.write_bytes(b"partial, now longer")
+    assert service.readyArchives(111.0) == []
+    assert service.readyArchives(121.0) == [str(archive)]
+
+
+def make_transport(server, **kwargs):
+    kwargs.setdefault("backoff", 0.001)
+    return fwImageUpload.Transport(
+        server.url, metrics=fwImageUpload.RunMetrics(), **kwargs
+    )
+
+
+@pytest.mark.parametrize("fault", [503, 429, "reset", 0.5])
+def test_transport_retries_transient_faults(fault):
+    from benchmarks import standin
+
+    payload = b"x" * 300_000
+    with standin.StandInServer() as server:
+        server.inject("upload", fault)
+        transport = make_transport(server, readTimeout=0.2)
+        transport.upload(
+            "/api/acquisitions/a1/files", "s.zip", io.BytesIO(payload), 300_000
+        )
+        stats = transport.json("GET", "/api/stats")
+
+    assert stats["requests"]["upload"] == 2
+    assert stats["uploads"] == 1
+    assert 300_000 < stats["uploadedBytes"] < 301_000
+    assert transport.metrics.counters["retries"] == 1
+
+
+def test_transport_gives_up_after_retries():
+    from benchmarks import standin
+
+    with standin.StandInServer() as server:
+        server.inject("subjects", 503, 503, 503, 503)
+        transport = make_transport(server, retries=2)
+        with pytest.raises(fwImageUpload.TransportError) as raised:
+            transport.json("POST", "/api/subjects", {"label": "NACC001"})
+        stats = transport.json("GET", "/api/stats")
+
+    assert raised.value.status == 503
+    assert stats["requests"]["subjects"] == 3
+
+
+def test_transport_does_not_retry_client_errors():
+    from benchmarks import standin
+
+    with standin.StandInServer() as server:
+        server.inject("subjects", 400)
+        transport = make_transport(server)
+        with pytest.raises(fwImageUpload.TransportError) as raised:
+            transport.json("POST", "/api/subjects", {"label": "NACC001"})
+
+    assert raised.value.status == 400
+    assert transport.metrics.counters["retries"] == 0
+
+
+def test_transport_reuses_keep_alive_connections():
+    from benchmarks import standin
+
+    with standin.StandInServer() as server:
+        transport = make_transport(server)
+        for n in range(5):
+            transport.json("POST", "/api/subjects", {"label": f"NACC00{n}"})
+        stats = transport.json("GET", "/api/stats")
+
+    assert stats["requests"]["connections"] == 1
+
+
+def test_adaptive_limiter_backs_off_and_recovers():
+    limiter = fwImageUpload.AdaptiveLimiter(8, cooldown=0)
+
+    limiter.record(0.1, ok=False)
+    limiter.record(0.1, ok=False)
+    assert limiter.limit == 2
+
+    for _ in range(20):
+        limiter.record(0.1, ok=True)
+    assert 2 < limiter.limit <= 8
+
+    before = limiter.limit
+    limiter.record(10.0, ok=True)
+    assert limiter.limit == before / 2
+
+
+def test_upload_images_retries_through_transport(tmp_path):
+    from benchmarks import bench_upload, standin, synthetic
+
+    archive = str(tmp_path / "bench.zip")
+    synthetic.writeArchive(archive, subjects=1, series=3, instances=2)
+
+    with standin.StandInServer() as server:
+        server.inject("upload", 503, "reset")
+        fc = bench_upload.StandInConnector(server.url, concurrency=2)
+        fc.transport.backoff = 0.001
+        uploader = fwImageUpload.UploadImageData(fc, archive, workers=2)
+        fc.transport.metrics = uploader.metrics
+        uploader.uploadImages(segIndex=1)
+
+    assert uploader.failedSeries == []
+    assert uploader.metrics.report()["retries"] == 2
+
+
+def test_upload_images_bounds_pending_series(tmp_path):
+    archive = make_series_archive(tmp_path, [(f"1.{i}", i) for i in range(1, 7)])
+    fc, acquisition = make_mock_connector()
+
+    uploader = fwImageUpload.UploadImageData(fc, str(archive), workers=3, uploaders=1)
+    pending = []
+
+    def upload(spec, metadata):
+        pending.append(uploader.uploadQueue.qsize())
+
+    acquisition.upload_file.side_effect = upload
+    uploader.uploadImages(segIndex=1)
+
+    assert acquisition.upload_file.call_count == 6
+    assert max(pending) <= uploader.maxPending
+    assert uploader.failedSeries == []
+
+
+def test_upload_images_spills_large_series(tmp_path):
+    archive = make_series_archive(tmp_path, [("1.1", 1)])
+    fc, acquisition = make_mock_connector()
+    sent = []
+
+    def upload(spec, metadata):
+        # Above the threshold the buffer has rolled over to a real file
+        sent.append((spec.size, spec.contents.name is not None))
+        with zipfile.ZipFile(spec.contents) as zf:
+            assert zf.testzip() is None
+
+    acquisition.upload_file.side_effect = upload
+
+    uploader = fwImageUpload.UploadImageData(fc, str(archive), spoolThreshold=16)
+    uploader.uploadImages(segIndex=1)
+
+    assert len(sent) == 1
+    assert sent[0][0] > 16
+    assert sent[0][1]
+
+
+def make_inventory_connector():
+    """Connector over one subject/session/acquisition with modified times."""
+    fc, subject, session, acquisition = make_indexed_connector()
+    stamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for container in (subject, session, acquisition):
+        container.modified = stamp
+        container.files = []
+    acquisition.files = [MagicMock(size=10, modified=stamp)]
+    acquisition.files[0].name = "a.zip"
+    fc.project.subjects.iter_find.return_value = [subject]
+    fc.project.sessions.iter_find.return_value = [session]
+    return fc, subject, session, acquisition
+
+
+def test_inventory_sync_fetches_only_modified_containers(tmp_path):
+    fc, _, _, acquisition = make_inventory_connector()
+    cache = fwImageUpload.InventoryCache(str(tmp_path / "inventory.sqlite"))
+
+    assert fc.SyncInventory(cache) == 3
+    fc.project.subjects.iter_find.assert_called_once_with()
+    assert [f["name"] for f in cache.files("proj1")] == ["a.zip"]
+    since = cache.lastSync("proj1")
+
+    replacement = MagicMock(size=20, modified="2024-02-01T00:00:00+00:00")
+    replacement.name = "b.zip"
+    acquisition.files = [replacement]
+    fc.project.subjects.iter_find.return_value = []
+    fc.project.sessions.iter_find.return_value = []
+
+    assert fc.SyncInventory(cache) == 1
+    fc.project.sessions.iter_find.assert_called_with(f"modified>{since}")
+    fc.SDKClient.acquisitions.iter_find.assert_called_with(
+        "parents.project=proj1", f"modified>{since}"
+    )
+    assert [(f["name"], f["size"]) for f in cache.files("proj1")] == [("b.zip", 20)]
+    assert [s["label"] for s in cache.containers("proj1", "session")] == [
+        "20240101_MRI"
+    ]
+    cache.close()
+
+
+def test_collect_information_from_inventory_cache(tmp_path):
+    fc, _, _, _ = make_inventory_connector()
+    cache = fwImageUpload.InventoryCache(str(tmp_path / "inventory.sqlite"))
+
+    fc.CollectImageInformation(inventory=cache)
+    assert [f["name"] for f in fc.imageList] == ["a.zip"]
+    since = cache.lastSync("proj1")
+
+    fc.CollectSessionInformation(inventory=cache)
+    assert [s["label"] for s in fc.sessionList] == ["20240101_MRI"]
+    # The second collection only asks for what changed since the first.
+    fc.project.sessions.iter_find.assert_called_with(f"modified>{since}")
+    fc.project.subjects.iter.assert_not_called()
+    cache.close()
+
+
+def test_inventory_full_sync_drops_deleted_containers(tmp_path):
+    fc, _, _, _ = make_inventory_connector()
+    cache = fwImageUpload.InventoryCache(str(tmp_path / "inventory.sqlite"))
+    fc.SyncInventory(cache)
+
+    fc.project.sessions.iter_find.return_value = []
+    fc.SDKClient.acquisitions.iter_find.return_value = []
+    fc.SyncInventory(cache, full=True)
+
+    assert cache.containers("proj1", "session") == []
+    assert cache.files("proj1") == []
+    assert [s["id"] for s in cache.containers("proj1", "subject")] == ["sub1"]
+    cache.close()
+
+
+def test_upload_journal_skips_completed_series(tmp_path):
+    archive = make_series_archive(tmp_path, [("1.1", 1), ("1.2", 2)])
+    journal = str(tmp_path / "journal.sqlite")
+    fc, acquisition = make_mock_connector()
+    acquisition.id = "acq1"
+
+    def upload(spec, metadata):
+        if spec.name.startswith("2-"):
+            raise flywheel.ApiException(status=503, reason="unavailable")
+
+    acquisition.upload_file.side_effect = upload
+    first = fwImageUpload.UploadImageData(fc, str(archive), journalSpec=journal)
+    first.uploadImages(segIndex=1)
+    assert first.failedSeries == ["1.2"]
+
+    acquisition.upload_file.reset_mock(side_effect=True)
+    second = fwImageUpload.UploadImageData(fc, str(archive), journalSpec=journal)
+    second.uploadImages(segIndex=1)
+
+    assert second.skippedSeries == ["1.1"]
+    assert acquisition.upload_file.call_count == 1
+    assert acquisition.upload_file.call_args.args[0].name == "2-img.zip"
+
+
+def test_upload_journal_reuploads_changed_series(tmp_path):
+    journal_path = str(tmp_path / "journal.sqlite")
+    journal = fwImageUpload.UploadJournal(journal_path)
+    journal.record("1.1", 1, "old-digest", "complete", "acq1")
+    journal.close()
+
+    archive = make_series_archive(tmp_path, [("1.1", 1)])
+    fc, acquisition = make_mock_connector()
+
+    uploader = fwImageUpload.UploadImageData(fc, str(archive), journalSpec=journal_path)
+    uploader.uploadImages(segIndex=1)
+
+    assert uploader.skippedSeries == []
+    acquisition.upload_file.assert_called_once()
+
+
+def test_upload_journal_force(tmp_path):
+    archive = make_series_archive(tmp_path, [("1.1", 1)])
+    journal = str(tmp_path / "journal.sqlite")
+    fc, acquisition = make_mock_connector()
+
+    fwImageUpload.UploadImageData(fc, str(archive), journalSpec=journal).uploadImages(1)
+    fwImageUpload.UploadImageData(
+        fc, str(archive), journalSpec=journal, force=True
+    ).uploadImages(1)
+
+    assert acquisition.upload_file.call_count == 2
+
+
+def test_upload_without_usable_journal(tmp_path, caplog):
+    archive = make_series_archive(tmp_path, [("1.1", 1)])
+    journal = str(tmp_path / "missing" / "journal.sqlite")
+    fc, acquisition = make_mock_connector()
+
+    uploader = fwImageUpload.UploadImageData(fc, str(archive), journalSpec=journal)
+    uploader.uploadImages(segIndex=1)
+
+    assert uploader.journal is None
+    assert "Upload journal disabled" in caplog.text
+    acquisition.upload_file.assert_called_once()
+
+
+def test_uploader_closes_archive_when_init_fails(tmp_path, monkeypatch):
+    archive = make_series_archive(tmp_path, [("1.1", 1)])
+    fc, _ = make_mock_connector()
+
+    opened = []
+    real_zip = zipfile.ZipFile
+
+    def open_zip(*args):
+        opened.append(real_zip(*args))
+        return opened[-1]
+
+    def open_journal(*args):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(zipfile, "ZipFile", open_zip)
+    monkeypatch.setattr(fwImageUpload.UploadImageData, "openJournal", open_journal)
+    with pytest.raises(KeyboardInterrupt):
+        fwImageUpload.UploadImageData(fc, str(archive), journalSpec="journal")
+    assert opened[0].fp is None
+
+
+def write_series_zip(tmp_path, members):
+    """Assemble a series ZIP from (name, data, method) source members."""
+    source = tmp_path / "source.zip"
+    with zipfile.ZipFile(source, "w") as zf:
+        for name, data, method in members:
+            zf.writestr(name, data, compress_type=method)
+
+    bundle = io.BytesIO()
+    with zipfile.ZipFile(source) as zf, open(source, "rb") as raw:
+        writer = fwImageUpload.SeriesZipWriter(bundle)
+        for info in zf.infolist():
+            writer.addMember(zf, raw, info, path.basename(info.filename))
+        writer.close()
+        source_infos = {path.basename(i.filename): i for i in zf.infolist()}
+
+    bundle.seek(0)
+    return source_infos, zipfile.ZipFile(bundle)
+
+
+def test_series_zip_copies_compressed_members(tmp_path):
+    data = bytes(range(256)) * 64
+    source, bundle = write_series_zip(
+        tmp_path,
+        [
+            ("a/NACC001/s/deflated.dcm", data, zipfile.ZIP_DEFLATED),
+            ("a/NACC001/s/stored.dcm", data, zipfile.ZIP_STORED),
+            ("a/NACC001/s/bzip2.dcm", data, zipfile.ZIP_BZIP2),
+        ],
+    )
+
+    assert bundle.testzip() is None
+    assert all(bundle.read(name) == data for name in bundle.namelist())
+
+    deflated = bundle.getinfo("deflated.dcm")
+    assert deflated.compress_type == zipfile.ZIP_DEFLATED
+    assert deflated.compress_size == source["deflated.dcm"].compress_size
+    assert bundle.getinfo("stored.dcm").compress_type == zipfile.ZIP_STORED
+    # Methods outside the raw-copy set fall back to ZIP_STORED
+    assert bundle.getinfo("bzip2.dcm").compress_type == zipfile.ZIP_STORED
+
+
+def test_series_zip_writes_zip64_records(tmp_path, monkeypatch):
+    monkeypatch.setattr(fwImageUpload, "ZIP64_LIMIT", 64)
+    monkeypatch.setattr(fwImageUpload, "ZIP_FILECOUNT_LIMIT", 2)
+    members = [(f"s/{i}.dcm", bytes([i]) * 200, zipfile.ZIP_STORED) for i in range(3)]
+
+    _, bundle = write_series_zip(tmp_path, members)
+
+    assert bundle.testzip() is None
+    assert [bundle.read(f"{i}.dcm") for i in range(3)] == [m[1] for m in members]
 
 
 # --------------------------------------------------
@@ -264,6 +1277,188 @@ def test_main_success(
 
     instance.setProject.assert_called_once()
     uploader.uploadImages.assert_called_once()
+    assert mock_uploader.call_args.kwargs["workers"] == 4
+
+
+@patch("fwImageUpload.UploadImageData")
+@patch("fwImageUpload.FlywheelConnector")
+@patch("fwImageUpload.Config")
+def test_main_workers_option(mock_config, mock_connector, mock_uploader, monkeypatch):
+    cfg = MagicMock()
+    cfg.get.side_effect = {"APIKey": "123", "project": "TEST"}.get
+    mock_config.return_value = cfg
+
+    monkeypatch.setattr(sys, "argv", ["prog", "-f", "file.zip", "-w", "8", "-u", "2"])
+
+    fwImageUpload.main()
+
+    kwargs = mock_uploader.call_args.kwargs
+    assert (kwargs["workers"], kwargs["uploaders"]) == (8, 2)
+    assert kwargs["journalSpec"] == "file.zip.journal.sqlite"
+    assert kwargs["force"] is False
+
+
+@patch("fwImageUpload.UploadImageData")
+@patch("fwImageUpload.FlywheelConnector")
+@patch("fwImageUpload.Config")
+def test_main_uploads_through_sdk_by_default(
+    mock_config, mock_connector, mock_uploader, monkeypatch
+):
+    cfg = MagicMock()
+    cfg.get.side_effect = {"APIKey": "123", "project": "TEST"}.get
+    mock_config.return_value = cfg
+
+    monkeypatch.setattr(sys, "argv", ["prog", "-f", "file.zip", "-u", "3"])
+    fwImageUpload.main()
+
+    mock_connector.return_value.enableTransport.assert_not_called()
+    mock_connector.return_value.limitUploads.assert_called_once_with(3)
+
+
+def test_sdk_uploads_respect_upload_limit():
+    fc = FlywheelConnector.__new__(FlywheelConnector)
+    fc.transport = None
+    fc.limitUploads(2)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def upload_file(spec, metadata=None):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+
+    acquisition = MagicMock()
+    acquisition.upload_file.side_effect = upload_file
+    threads = [
+        threading.Thread(target=fc.uploadFile, args=(acquisition, MagicMock()))
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert acquisition.upload_file.call_count == 6
+    assert peak[0] == 2
+
+
+@patch("fwImageUpload.UploadImageData")
+@patch("fwImageUpload.FlywheelConnector")
+@patch("fwImageUpload.Config")
+def test_main_force_option(mock_config, mock_connector, mock_uploader, monkeypatch):
+    cfg = MagicMock()
+    cfg.get.side_effect = {"APIKey": "123", "project": "TEST"}.get
+    mock_config.return_value = cfg
+
+    monkeypatch.setattr(sys, "argv", ["prog", "-f", "file.zip", "--force"])
+
+    fwImageUpload.main()
+
+    assert mock_uploader.call_args.kwargs["force"] is True
+
+
+@patch("fwImageUpload.UploadImageData")
+@patch("fwImageUpload.FlywheelConnector")
+@patch("fwImageUpload.Config")
+def test_main_writes_run_report(
+    mock_config, mock_connector, mock_uploader, monkeypatch, tmp_path
+):
+    cfg = MagicMock()
+    cfg.get.side_effect = {"APIKey": "123", "project": "TEST"}.get
+    mock_config.return_value = cfg
+    report = tmp_path / "report.json"
+    monkeypatch.setattr(
+        sys, "argv", ["prog", "-f", "file.zip", "-w", "3", "--report", str(report)]
+    )
+
+    fwImageUpload.main()
+
+    data = json.loads(report.read_text())
+    assert data["archive"] == "file.zip"
+    assert data["settings"]["workers"] == 3
+    assert mock_uploader.call_args.kwargs["metrics"] is not None
+
+
+@patch("fwImageUpload.IngestService")
+@patch("fwImageUpload.UploadImageData")
+@patch("fwImageUpload.FlywheelConnector")
+@patch("fwImageUpload.Config")
+def test_main_watch_option(
+    mock_config, mock_connector, mock_uploader, mock_service, monkeypatch, tmp_path
+):
+    cfg = MagicMock()
+    cfg.get.side_effect = {"APIKey": "123", "project": "TEST"}.get
+    mock_config.return_value = cfg
+    mock_service.return_value.run = MagicMock(return_value=asyncio.sleep(0))
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "prog",
+            "--watch",
+            "drop",
+            "-c",
+            "site.conf",
+            "--max-in-flight",
+            "6",
+            "--pooled-uploads",
+        ],
+    )
+
+    fwImageUpload.main()
+
+    mock_config.assert_called_once_with("site.conf")
+    mock_uploader.assert_not_called()
+    assert mock_service.call_args.args[1] == "drop"
+    assert mock_service.call_args.kwargs["maxArchives"] == 2
+    assert mock_service.return_value.run.call_args.kwargs["handleSignals"] is True
+    mock_connector.return_value.enableTransport.assert_called_once()
+    assert (
+        mock_connector.return_value.enableTransport.call_args.kwargs["concurrency"] == 6
+    )
+    assert not list(tmp_path.glob("*.report.json"))
+
+
+@patch("fwImageUpload.FlywheelConnector")
+def test_main_backfill_option(mock_connector, monkeypatch, tmp_path):
+    archive = write_megre_archive(tmp_path / "a.zip")
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["prog", "--backfill", archive, "--catalogue", "c.sqlite", "-p", "1"],
+    )
+
+    fwImageUpload.main()
+
+    catalogue = fwImageUpload.HeaderCatalogue(str(tmp_path / "c.sqlite"))
+    assert len(catalogue.findSeries()) == 2
+    mock_connector.assert_not_called()
+
+
+@patch("fwImageUpload.UploadImageData")
+@patch("fwImageUpload.FlywheelConnector")
+@patch("fwImageUpload.Config")
+def test_main_inventory_option(
+    mock_config, mock_connector, mock_uploader, monkeypatch, tmp_path
+):
+    cfg = MagicMock()
+    cfg.get.side_effect = {"APIKey": "123", "project": "TEST"}.get
+    mock_config.return_value = cfg
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    fc = mock_connector.return_value
+    fc.project.id = "proj1"
+    monkeypatch.setattr(sys, "argv", ["prog", "--inventory", "--full-sync"])
+
+    fwImageUpload.main()
+
+    (cache,) = fc.SyncInventory.call_args.args
+    assert cache.fileSpec == str(tmp_path / "fwImageUpload" / "inventory-proj1.sqlite")
+    assert fc.SyncInventory.call_args.kwargs == {"full": True}
+    mock_uploader.assert_not_called()
+    fc.SeedInstanceIndex.assert_not_called()
 
 
 @patch("fwImageUpload.Config")
@@ -3,119 +3,791 @@
 Flywheel Gear: QSMxT Processing Pipeline.
 
 This gear:
-1. Unzips MEGRE and T1w DICOM archives.
-2. Converts MEGRE using `dicom-convert`.
-3. Converts T1w DICOMs using `dcm2niix`.
+1. Unzips MEGRE and T1w DICOM archives in parallel.
+2. Converts MEGRE using `dicom-convert` and, concurrently, T1w DICOMs
+   using `dcm2niix`.
+3. Names the T1w NIfTI after the MEGRE BIDS subject/session.
 4. Launches QSMxT with user-provided config options.
-5. Collects workflow outputs, standard NIfTI results, and crash logs.
-6. Packages results into artifacts suitable for Flywheel.
+5. Packages workflow and QSM outputs in one parallel pass, publishing
+   NIfTI results individually, and collects crash logs.
+
+With ``--batch MANIFEST --scratch DIR --out DIR`` it instead processes many
+sessions locally, several at a time, each in its own process and scratch
+directories (see `run_batch`).
 
 Environment Assumptions:
 - QSMxT, dicom-convert, and dcm2niix are already installed in the container.
 - Filesystem paths /dicoms, /bids, /qsm are writable.
 """
 
+import argparse
 import glob
+import json
 import os
+import re
 import shutil
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack, contextmanager, suppress
 from pathlib import Path
 
 import flywheel
+from conversion_cache import ConversionCache, converter_version
+
+MEGRE_DICOM_DIR = "/dicoms/qsm"
+T1W_DICOM_DIR = "/dicoms/T1w"
+T1W_NIFTI_DIR = "/dicoms/T1w_nifti"
+BIDS_DIR = "/bids"
+QSM_DIR = "/qsm"
+
+# Nipype writes crash files into the working directory.
+CRASH_DIR = "/flywheel/v0"
+
+# dcm2niix output name of the T1w, renamed once the BIDS prefix is known.
+T1W_STEM = "T1w"
+
+DEFAULT_WORKERS = 4
+DEFAULT_CONVERSION_CACHE_GB = 50
+
+
+###############################################################################
+# Command runner and stage timing
+###############################################################################
+
+# Seconds between samples of the child process tree's resident memory.
+RSS_SAMPLE_INTERVAL = 1.0
+
+# Output lines kept to report a failing command.
+FAILURE_TAIL_LINES = 50
+
+TIMING_REPORT = "timing.json"
+
+
+def process_children():
+    """
+    Map each running process ID to its child process IDs, from /proc.
+
+    Returns an empty mapping where /proc is not available.
+    """
+    children = {}
+    for entry in os.scandir("/proc") if os.path.isdir("/proc") else ():
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, "stat")) as f:
+                stat = f.read()
+        except OSError:
+            continue  # exited since the directory was listed
+        # The command name may contain spaces; the fields follow its ")".
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    return children
+
+
+def tree_rss_kb(pid):
+    """Return the summed resident memory (KiB) of `pid` and its descendants."""
+    children = process_children()
+    page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+    total = 0
+    todo = [pid]
+    while todo:
+        current = todo.pop()
+        todo.extend(children.get(current, ()))
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * page_kb
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Background sampler of the peak resident memory of a process tree."""
+
+    def __init__(self, pid, interval=RSS_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self.done = threading.Event()
+
+    def run(self):
+        """Sample until stopped."""
+        while True:
+            self.peak_kb = max(self.peak_kb, tree_rss_kb(self.pid))
+            if self.done.wait(self.interval):
+                return
+
+    def stop(self):
+        """Stop sampling and return the peak seen, in KiB."""
+        self.done.set()
+        self.join()
+        return self.peak_kb
+
+
+class StageLog:
+    """
+    Thread-safe record of the gear's stages and commands.
+
+    Each entry has the stage name, its kind ("stage" for in-process work,
+    "command" for a child process), its start offset and wall time in
+    seconds, and for commands the CPU time, peak memory and return code of
+    the child process tree.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, name, kind, start, **fields):
+        """Record a stage or command that began at monotonic time `start`."""
+        entry = {
+            "name": name,
+            "kind": kind,
+            "start_seconds": round(start - self.started, 3),
+            "wall_seconds": round(time.monotonic() - start, 3),
+            **fields,
+        }
+        with self.lock:
+            self.entries.append(entry)
+        return entry
+
+    @contextmanager
+    def stage(self, name):
+        """Time the in-process work of the enclosed block as one stage."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, "stage", start)
+
+    def report(self):
+        """Return the timing report, naming the stage with most wall time."""
+        with self.lock:
+            entries = sorted(self.entries, key=lambda e: e["start_seconds"])
+        return {
+            "total_wall_seconds": round(time.monotonic() - self.started, 3),
+            "dominant_stage": max(
+                entries, key=lambda e: e["wall_seconds"], default={}
+            ).get("name"),
+            "stages": entries,
+        }
+
+    def write(self, out_dir):
+        """Write the report as ``timing.json`` in `out_dir`; return its path."""
+        path = os.path.join(out_dir, TIMING_REPORT)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+stage_log = StageLog()
 
 
 def run_cmd(cmd, description):
-    """Run a shell command with logging + error trapping."""
-    print(f"\n[CMD] {description}: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    """
+    Run a command, streaming its output to the log as it is produced.
 
-    print(result.stdout)
-    if result.returncode != 0:
-        print(result.stderr)
-        raise RuntimeError(f"Command failed during: {description}")
+    stderr is merged into stdout so lines keep their order. The command's
+    wall time, CPU time (its own and that of the descendants it waited for)
+    and peak memory are recorded in `stage_log` under `description`;
+    ``max_rss_kb`` is the largest single process and ``peak_tree_rss_kb``
+    the sampled total of the whole process tree.
 
-    return result
+    Raises
+    ------
+    RuntimeError
+        If the command exits with a non-zero status.
+    """
+    print(f"\n[CMD] {description}: {' '.join(cmd)}", flush=True)
+    start = time.monotonic()
+    proc = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        bufsize=1,
+    )
+    sampler = RssSampler(proc.pid)
+    sampler.start()
+    tail = deque(maxlen=FAILURE_TAIL_LINES)
+    with proc.stdout:
+        for line in proc.stdout:
+            print(line, end="", flush=True)
+            tail.append(line)
 
+    # wait4 instead of Popen.wait, for the child's resource usage.
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    stage_log.add(
+        description,
+        "command",
+        start,
+        command=cmd,
+        returncode=proc.returncode,
+        user_cpu_seconds=round(usage.ru_utime, 3),
+        system_cpu_seconds=round(usage.ru_stime, 3),
+        max_rss_kb=usage.ru_maxrss,
+        peak_tree_rss_kb=sampler.stop(),
+    )
 
-def flywheel_run():
-    """Execute main Flywheel gear workflow."""
-    with flywheel.GearContext() as context:
-        config = context.config
-        dicom_megre_zip = []
-        dicom_megre_zip.append(context.get_input_path("input_file"))
-        dicom_megre_zip.append(context.get_input_path("input_file_opt"))
-        dicom_megre_zip.append(context.get_input_path("input_file_opt2"))
-        dicom_t1w_zip = context.get_input_path("anatomical")
-        out_dir = context.output_dir
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"Command failed during: {description} (exit {proc.returncode}); "
+            f"last output:\n{''.join(tail)}"
+        )
 
-    ###########################################################################
-    # Step 1: Unzip MEGRE DICOMs
-    ###########################################################################
-    print(f"Unzipping MEGRE DICOMs: {dicom_megre_zip}")
-    for i in range(len(dicom_megre_zip)):
-        if dicom_megre_zip[i] != None:
-            with zipfile.ZipFile(dicom_megre_zip[i], "r") as zf:
-                zf.extractall("/dicoms/qsm")
+    return subprocess.CompletedProcess(cmd, proc.returncode)
 
-    ###########################################################################
-    # Step 2: Convert MEGRE DICOMs to BIDS using dicom-convert
-    ###########################################################################
-    run_cmd(
-        [
-            "dicom-convert",
-            "/dicoms/",
-            "/bids/",
-            "--auto_yes",
-        ],
-        description="DICOM to BIDS conversion (MEGRE)",
+
+###############################################################################
+# Input extraction and conversion
+###############################################################################
+
+
+def extract_members(zip_path, dest, names):
+    """Extract some members of a ZIP archive into `dest`."""
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        for name in names:
+            try:
+                zf.extract(name, dest)
+            except FileExistsError:
+                # Another thread created the member's directory in between
+                # zipfile's existence check and its makedirs; it exists now.
+                zf.extract(name, dest)
+
+
+def submit_extraction(pool, zip_paths, dest, workers):
+    """
+    Queue the extraction of ZIP archives into `dest` on a thread pool.
+
+    Each archive's members are split into up to `workers` slices, each
+    extracted through its own archive handle, so even a single large
+    archive is decompressed on several threads.
+
+    Returns
+    -------
+    list of Future
+        One future per slice; all are done once the archives are extracted.
+    """
+    futures = []
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path, "r") as zf:
+            names = zf.namelist()
+        for i in range(workers):
+            if names[i::workers]:
+                futures.append(
+                    pool.submit(extract_members, zip_path, dest, names[i::workers])
+                )
+    return futures
+
+
+def after(futures, fn, *args):
+    """Wait for `futures` (re-raising their errors), then call `fn`."""
+    for future in futures:
+        future.result()
+    return fn(*args)
+
+
+def run_conversion(cmd, description, input_dir, output_dir, cache=None):
+    """
+    Run a converter from `input_dir` into `output_dir`, through `cache`.
+
+    With a `cache`, a conversion of identical inputs by the same converter
+    version and options is materialised from it instead of run again.
+    """
+    if cache is None:
+        run_cmd(cmd, description)
+        return
+
+    start = time.monotonic()
+    options = [a for a in cmd[1:] if a not in (input_dir, output_dir)]
+    key = cache.key(cmd[0], converter_version(cmd[0]), options, input_dir)
+    if cache.fetch(key, output_dir) is not None:
+        print(f"\n[CACHE] {description}: reused conversion {key[:12]}")
+        stage_log.add(description, "cache", start)
+        return
+    run_cmd(cmd, description)
+    cache.store(key, output_dir)
+
+
+def convert_megre(cache=None):
+    """Convert the extracted MEGRE DICOMs to BIDS with dicom-convert."""
+    run_conversion(
+        ["dicom-convert", MEGRE_DICOM_DIR, BIDS_DIR, "--auto_yes"],
+        "DICOM to BIDS conversion (MEGRE)",
+        MEGRE_DICOM_DIR,
+        BIDS_DIR,
+        cache,
     )
 
-    ###########################################################################
-    # Step 3: Unzip T1w anatomical DICOMs
-    ###########################################################################
-    print(f"Unzipping T1w DICOMs: {dicom_t1w_zip}")
-    if dicom_t1w_zip != None:
-        with zipfile.ZipFile(dicom_t1w_zip, "r") as zf:
-            zf.extractall("/dicoms/T1w")
 
+def convert_t1w(cache=None):
+    """Convert the extracted T1w DICOMs to NIfTI with dcm2niix."""
+    os.makedirs(T1W_NIFTI_DIR, exist_ok=True)
+    run_conversion(
+        ["dcm2niix", "-b", "y", "-f", T1W_STEM, "-o", T1W_NIFTI_DIR, T1W_DICOM_DIR],
+        "T1w DICOM to NIfTI conversion",
+        T1W_DICOM_DIR,
+        T1W_NIFTI_DIR,
+        cache,
+    )
+
+
+def place_t1w(anat_dir, target_name):
+    """Move the converted T1w files into `anat_dir` under the BIDS name."""
+    placed = []
+    for f in sorted(Path(T1W_NIFTI_DIR).glob(f"{T1W_STEM}*")):
+        dest = Path(anat_dir) / (target_name + f.name[len(T1W_STEM) :])
+        shutil.move(str(f), dest)
+        placed.append(dest)
+    return placed
+
+
+def convert_inputs(megre_zips, t1w_zip, workers, cache=None):
+    """
+    Extract the inputs in parallel and convert MEGRE and T1w concurrently.
+
+    Extraction of every archive runs on `workers` threads. The MEGRE
+    conversion starts as soon as the MEGRE archives are extracted, and the
+    T1w conversion as soon as the T1w archive is, so the two converters
+    overlap with each other and with the remaining extraction. The T1w is
+    only renamed into the BIDS tree once both are done, since its name
+    derives from the MEGRE subject and session. Conversions go through the
+    `cache` when one is given.
+    """
+    print(f"Unzipping MEGRE DICOMs: {megre_zips}")
+    print(f"Unzipping T1w DICOMs: {t1w_zip}")
+
+    # Converters are a separate pool so that waiting on extraction can never
+    # hold an extraction worker.
+    with (
+        ThreadPoolExecutor(max_workers=workers) as extractors,
+        ThreadPoolExecutor(max_workers=2) as converters,
+    ):
+        megre_extracted = submit_extraction(
+            extractors, megre_zips, MEGRE_DICOM_DIR, workers
+        )
+        t1w_extracted = submit_extraction(
+            extractors, [t1w_zip] if t1w_zip else [], T1W_DICOM_DIR, workers
+        )
+
+        megre = converters.submit(after, megre_extracted, convert_megre, cache)
+        t1w = (
+            converters.submit(after, t1w_extracted, convert_t1w, cache)
+            if t1w_zip
+            else None
+        )
+
+        megre.result()
+        if t1w is not None:
+            t1w.result()
+
+    if t1w_zip is None:
+        return
+
+    anat_list = sorted(Path(BIDS_DIR).glob("sub*/ses*/anat/*.nii"))
+    if not anat_list:
+        print("WARNING: No MEGRE anat/*.nii found. Skipping T1w renaming.")
+        return
+
+    # Derive subject/session from existing BIDS file
+    first_file = anat_list[0]
+    important_parts = [
+        s for s in first_file.name.split("_") if "sub" in s or "ses" in s
+    ]
+    t1_target_name = "_".join([*important_parts, "T1w"])
+    print(f"T1w placed as: {place_t1w(first_file.parent, t1_target_name)}")
+
+
+###############################################################################
+# Output packaging
+###############################################################################
+
+# Files already compressed are stored in the output ZIPs as they are.
+STORED_SUFFIXES = (".gz", ".pklz", ".zip", ".bz2", ".xz", ".zst")
+DEFLATE_LEVEL = 6
+COPY_CHUNK = 1 << 20
+
+# Compressed members up to this size stay in memory until written.
+SPOOL_BYTES = 64 << 20
+
+# Sizes and offsets from this value on need ZIP64 records, and are replaced
+# by ZIP64_MARKER in the 32-bit header fields.
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+
+LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+CENTRAL_HEADER = struct.Struct("<4s6H3L5H2L")
+ZIP64_END = struct.Struct("<4sQ2H2L4Q")
+ZIP64_LOCATOR = struct.Struct("<4sLQL")
+END_RECORD = struct.Struct("<4s4H2LH")
+
+
+def dos_time(mtime):
+    """Return the MS-DOS (time, date) fields of a modification time."""
+    t = time.localtime(max(mtime, 315532800))  # 1980-01-01, the DOS epoch
+    return (
+        t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+        (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+    )
+
+
+def field32(value):
+    """Return `value` for a 32-bit ZIP field, or the ZIP64 marker."""
+    return ZIP64_MARKER if value >= ZIP64_LIMIT else value
+
+
+def compress_member(src, stored):
+    """
+    Read one file, computing its CRC-32 and, unless `stored`, deflating it.
+
+    Returns
+    -------
+    tuple
+        (crc, size, compressed file or None when stored). The compressed
+        data is a spooled temporary file positioned at its start.
+    """
+    crc = size = 0
+    data = deflate = None
+    if not stored:
+        data = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)  # noqa: SIM115
+        deflate = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+    with open(src, "rb") as f:
+        while chunk := f.read(COPY_CHUNK):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if deflate is not None:
+                data.write(deflate.compress(chunk))
+    if deflate is not None:
+        data.write(deflate.flush())
+        data.seek(0)
+    return crc, size, data
+
+
+def discard_pending(pool, pending):
+    """
+    Shut down `pool`, freeing the members it compressed that were not written.
+
+    `pending` holds ``(sink, arcname, src, future)`` entries of
+    `compress_member` calls; it is empty after a successful packaging.
+    """
+    for *_, future in pending:
+        future.cancel()
+    pool.shutdown(wait=True)
+    for *_, future in pending:
+        if future.cancelled() or future.exception() is not None:
+            continue
+        data = future.result()[2]
+        if data is not None:
+            data.close()
+
+
+class ZipSink:
+    """
+    ZIP archive written from members compressed elsewhere.
+
+    `zipfile` compresses each member in the thread that writes it. Here
+    members arrive already deflated (or are stored), so compression can run
+    on a thread pool while a single thread appends the results. ZIP64
+    records are written for members and archives beyond 4 GiB.
+
+    Used as a context manager, the archive is completed on a normal exit and
+    removed if the block raises.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fp = open(path, "wb")  # noqa: SIM115
+        self.central = []
+
+    def __enter__(self):
+        """Return the sink."""
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        """Complete the archive, or remove it if the block raised."""
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Close the file and remove the partial archive."""
+        self.fp.close()
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    def add(self, arcname, src, crc, size, data):
+        """
+        Append a member; `data` is its deflated stream, or None if stored.
+
+        `data` is closed once appended, or if appending fails.
+        """
+        try:
+            self.write_member(arcname, src, crc, size, data)
+        finally:
+            if data is not None:
+                data.close()
+
+    def write_member(self, arcname, src, crc, size, data):
+        """Write the local header and contents of a member."""
+        stat = os.stat(src)
+        method = zipfile.ZIP_STORED if data is None else zipfile.ZIP_DEFLATED
+        if data is None:
+            csize = size
+        else:
+            csize = data.seek(0, os.SEEK_END)
+            data.seek(0)
+
+        offset = self.fp.tell()
+        name = arcname.encode()
+        mtime = dos_time(stat.st_mtime)
+        large = size >= ZIP64_LIMIT or csize >= ZIP64_LIMIT
+        extra = struct.pack("<2H2Q", 1, 16, size, csize) if large else b""
+        version = 45 if large else 20
+        self.fp.write(
+            LOCAL_HEADER.pack(
+                b"PK\x03\x04",
+                version,
+                0x800,
+                method,
+                *mtime,
+                crc,
+                ZIP64_MARKER if large else csize,
+                ZIP64_MARKER if large else size,
+                len(name),
+                len(extra),
+            )
+        )
+        self.fp.write(name + extra)
+
+        if data is None:
+            with open(src, "rb") as f:
+                shutil.copyfileobj(f, self.fp, COPY_CHUNK)
+        else:
+            shutil.copyfileobj(data, self.fp, COPY_CHUNK)
+
+        self.central.append(
+            (name, version, method, mtime, crc, csize, size, offset, stat.st_mode)
+        )
+
+    def add_directory(self, arcname, src):
+        """Append an empty directory member."""
+        offset = self.fp.tell()
+        name = arcname.rstrip("/").encode() + b"/"
+        stat = os.stat(src)
+        mtime = dos_time(stat.st_mtime)
+        self.fp.write(
+            LOCAL_HEADER.pack(
+                b"PK\x03\x04", 20, 0x800, 0, *mtime, 0, 0, 0, len(name), 0
+            )
+        )
+        self.fp.write(name)
+        self.central.append((name, 20, 0, mtime, 0, 0, 0, offset, stat.st_mode))
+
+    def close(self):
+        """Write the central directory and end records."""
+        start = self.fp.tell()
+        for (
+            name,
+            version,
+            method,
+            mtime,
+            crc,
+            csize,
+            size,
+            offset,
+            mode,
+        ) in self.central:
+            fields = [v for v in (size, csize, offset) if v >= ZIP64_LIMIT]
+            extra = (
+                struct.pack(f"<2H{len(fields)}Q", 1, 8 * len(fields), *fields)
+                if fields
+                else b""
+            )
+            self.fp.write(
+                CENTRAL_HEADER.pack(
+                    b"PK\x01\x02",
+                    0x0300 | version,  # made by UNIX, for the mode bits
+                    version,
+                    0x800,
+                    method,
+                    *mtime,
+                    crc,
+                    field32(csize),
+                    field32(size),
+                    len(name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    (mode & 0xFFFF) << 16 | (0x10 if name.endswith(b"/") else 0),
+                    field32(offset),
+                )
+            )
+            self.fp.write(name + extra)
+
+        end = self.fp.tell()
+        count = len(self.central)
+        if count >= 0xFFFF or start >= ZIP64_LIMIT or end - start >= ZIP64_LIMIT:
+            self.fp.write(
+                ZIP64_END.pack(
+                    b"PK\x06\x06", 44, 45, 45, 0, 0, count, count, end - start, start
+                )
+            )
+            self.fp.write(ZIP64_LOCATOR.pack(b"PK\x06\x07", 0, end, 1))
+        self.fp.write(
+            END_RECORD.pack(
+                b"PK\x05\x06",
+                0,
+                0,
+                min(count, 0xFFFF),
+                min(count, 0xFFFF),
+                field32(end - start),
+                field32(start),
+                0,
+            )
+        )
+        self.fp.close()
+
+
+def publish(src, out_dir):
+    """Expose one output file in `out_dir`, hard-linked when possible."""
+    dest = os.path.join(out_dir, os.path.basename(src))
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        # Different filesystem, or links not supported: fall back to a copy.
+        shutil.copy2(src, dest)
+    return dest
+
+
+def package_outputs(qsm_dir, out_dir, workers):
+    """
+    Package the QSMxT result tree in a single walk.
+
+    `<qsm_dir>/workflow` goes into ``workflow.zip`` and the rest of the tree
+    into ``qsm.zip``, so nothing is compressed twice. Members are deflated
+    on `workers` threads and appended in walk order; files with a suffix in
+    `STORED_SUFFIXES` are stored without recompression. Every ``*.nii``
+    outside the workflow directory is also published on its own in
+    `out_dir` as a hard link.
+
+    Returns
+    -------
+    dict
+        Paths of the two archives ("workflow", "qsm") and of the published
+        NIfTI files ("nifti").
+    """
+    workflow_dir = os.path.join(qsm_dir, "workflow")
+    published = []
+    pending = deque()
+
+    def drain(limit):
+        while len(pending) > limit:
+            sink, arcname, src, future = pending.popleft()
+            sink.add(arcname, src, *future.result())
+
+    # Exits in reverse: on failure the sinks remove their partial archives,
+    # then members compressed but not yet written are discarded.
+    with ExitStack() as stack:
+        pool = ThreadPoolExecutor(max_workers=workers)
+        stack.callback(discard_pending, pool, pending)
+        workflow_sink = stack.enter_context(
+            ZipSink(os.path.join(out_dir, "workflow.zip"))
+        )
+        qsm_sink = stack.enter_context(ZipSink(os.path.join(out_dir, "qsm.zip")))
+
+        for root, dirs, files in os.walk(qsm_dir):
+            dirs.sort()
+            in_workflow = os.path.commonpath([root, workflow_dir]) == workflow_dir
+            sink = workflow_sink if in_workflow else qsm_sink
+            base = workflow_dir if in_workflow else qsm_dir
+            rel_root = os.path.relpath(root, base)
+
+            if rel_root != "." and not files and not dirs:
+                drain(0)
+                sink.add_directory(rel_root, root)
+
+            for name in sorted(files):
+                src = os.path.join(root, name)
+                if not os.path.isfile(src):
+                    continue
+                arcname = os.path.normpath(os.path.join(rel_root, name))
+                stored = name.endswith(STORED_SUFFIXES)
+                future = pool.submit(compress_member, src, stored)
+                pending.append((sink, arcname, src, future))
+                # Bounds the compressed members waiting to be written.
+                drain(2 * workers)
+
+                if name.endswith(".nii") and not in_workflow:
+                    published.append(publish(src, out_dir))
+        drain(0)
+
+    print("NIfTI files published:", published)
+    return {
+        "workflow": workflow_sink.path,
+        "qsm": qsm_sink.path,
+        "nifti": published,
+    }
+
+
+def open_conversion_cache(config):
+    """Open the conversion cache configured for the gear, if any."""
+    cache_dir = config.get("conversion_cache_dir", "")
+    if not cache_dir:
+        return None
+    max_gb = config.get("conversion_cache_gb", DEFAULT_CONVERSION_CACHE_GB)
+    print(f"Conversion cache: {cache_dir} (up to {max_gb} GB)")
+    return ConversionCache(cache_dir, max_bytes=int(max_gb * 1e9))
+
+
+def run_session(config, megre_zips, t1w_zip, out_dir):
+    """
+    Process one session from its DICOM archives into `out_dir`.
+
+    Returns
+    -------
+    list of str
+        The Nipype crash files found; when there are any, they are also
+        packaged as ``crashes.zip`` in `out_dir`.
+    """
     ###########################################################################
-    # Step 4: Convert T1w DICOMs into BIDS-compatible naming
+    # Steps 1-4: Unzip and convert MEGRE and T1w DICOMs to BIDS
     ###########################################################################
-    anat_list = list(Path("/bids/").glob("sub*/ses*/anat/*.nii"))
-    t1_target_name = None
-
-    if anat_list:
-        # Derive subject/session from existing BIDS file
-        first_file = anat_list[0]
-        important_parts = [
-            s for s in first_file.name.split("_") if "sub" in s or "ses" in s
-        ]
-        t1_target_name = "_".join(important_parts + ["T1w"])
-
-        run_cmd(
-            [
-                "dcm2niix",
-                "-b",
-                "y",
-                "-f",
-                t1_target_name,
-                "-o",
-                str(first_file.parent)
-            ],
-            description="T1w DICOM to NIfTI conversion",
+    workers = max(1, int(config.get("workers", DEFAULT_WORKERS)))
+    cache = open_conversion_cache(config)
+    with stage_log.stage("Input extraction and conversion"):
+        convert_inputs(
+            [z for z in megre_zips if z is not None], t1w_zip, workers, cache
         )
-    else:
-        print("WARNING: No MEGRE anat/*.nii found. Skipping T1w renaming.")
+    if cache is not None:
+        cache.close()
 
     ###########################################################################
     # Step 5: Run QSMxT
     ###########################################################################
     qsmxt_cmd = [
         "qsmxt",
-        "/bids",
-        "/qsm",
+        BIDS_DIR,
+        QSM_DIR,
         "--premade",
         str(config.get("premade", "False")),
         "--auto_yes",
@@ -123,7 +795,7 @@ def flywheel_run():
 
     for arg in ["do_qsm", "do_swi", "do_segmentation"]:
         result = config.get(arg, "False")
-        if result :
+        if result:
             qsmxt_cmd.append(f"--{arg}")
 
     # Append optional custom arguments
@@ -131,38 +803,21 @@ def flywheel_run():
     if extra_args:
         qsmxt_cmd += extra_args.split()
 
-    print (f"QSMxT {qsmxt_cmd}")
+    print(f"QSMxT {qsmxt_cmd}")
 
     run_cmd(qsmxt_cmd, description="QSMxT processing")
 
     ###########################################################################
-    # Step 6: Package workflow outputs
+    # Steps 6-7: Package workflow and QSM outputs, publish NIfTI files
     ###########################################################################
-    workflow_path = "/qsm/workflow"
-    workflow_zip = os.path.join(out_dir, "workflow.zip")
-
-    print(f"Packaging workflow directory → {workflow_zip}")
-    shutil.make_archive(os.path.splitext(workflow_zip)[0], "zip", workflow_path)
-
-    # Delete expanded workflow to reduce artifact size
-    shutil.rmtree(workflow_path, ignore_errors=True)
-
-    ###########################################################################
-    # Step 7: Extract and copy resulting NIfTI files into the Flywheel view
-    ###########################################################################
-    nifti_files = glob.glob("/qsm/**/*.nii", recursive=True)
-    print("NIfTI files detected:", nifti_files)
-
-    for f in nifti_files:
-        shutil.copy2(f, os.path.join(out_dir, os.path.basename(f)))
-
-    # Create a zip of the entire qsm output tree
-    shutil.make_archive(os.path.join(out_dir, "qsm"), "zip", "/qsm/")
+    print(f"Packaging {QSM_DIR} → {out_dir}")
+    with stage_log.stage("Output packaging"):
+        package_outputs(QSM_DIR, out_dir, workers)
 
     ###########################################################################
     # Step 8: Capture crash files if any
     ###########################################################################
-    crash_files = glob.glob("/flywheel/v0/crash*.pklz")
+    crash_files = sorted(glob.glob(os.path.join(CRASH_DIR, "crash*.pklz")))
     if crash_files:
         crash_zip = os.path.join(out_dir, "crashes.zip")
         print("Packaging crash reports:", crash_zip)
@@ -171,6 +826,27 @@ def flywheel_run():
             for crash in crash_files:
                 zf.write(crash, os.path.basename(crash))
 
+    return crash_files
+
+
+def flywheel_run():
+    """Execute main Flywheel gear workflow."""
+    with flywheel.GearContext() as context:
+        config = context.config
+        dicom_megre_zip = []
+        dicom_megre_zip.append(context.get_input_path("input_file"))
+        dicom_megre_zip.append(context.get_input_path("input_file_opt"))
+        dicom_megre_zip.append(context.get_input_path("input_file_opt2"))
+        dicom_t1w_zip = context.get_input_path("anatomical")
+        out_dir = context.output_dir
+
+    # The timing report is written however the run ends.
+    try:
+        crash_files = run_session(config, dicom_megre_zip, dicom_t1w_zip, out_dir)
+    finally:
+        print("Timing report:", stage_log.write(out_dir))
+
+    if crash_files:
         print("ERROR: Crashes detected. Inspect workflow.zip and crashes.zip.")
         sys.exit(1)
 
@@ -178,5 +854,304 @@ def flywheel_run():
     sys.exit(0)
 
 
-if __name__ == "__main__":
+###############################################################################
+# Batch mode
+###############################################################################
+
+DEFAULT_SESSION_CORES = 4
+DEFAULT_SESSION_MEMORY_GB = 16
+BATCH_SUMMARY = "batch_summary.json"
+SESSION_SPEC = "session.json"
+SESSION_RESULT = "session_result.json"
+SESSION_LOG = "session.log"
+SESSION_ID = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+
+
+def load_batch_manifest(path):
+    """
+    Read the sessions of a batch manifest.
+
+    The manifest is a JSON object::
+
+        {
+          "config": {...},
+          "sessions": [
+            {"id": "sub-01_ses-01", "megre": ["a.zip", ...], "t1w": "t.zip",
+             "config": {...}},
+            ...
+          ]
+        }
+
+    Each session's "config" overrides the top-level one, which takes the
+    same keys as the gear config. "t1w" and both "config" objects are
+    optional. Relative paths are resolved against the manifest's directory.
+
+    Raises
+    ------
+    ValueError
+        If a session has no MEGRE archive, or an invalid or repeated id.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    defaults = manifest.get("config", {})
+
+    sessions = []
+    seen = set()
+    for entry in manifest["sessions"]:
+        session_id = str(entry.get("id", ""))
+        if not SESSION_ID.match(session_id):
+            raise ValueError(f"Invalid batch session id: {session_id!r}")
+        if session_id in seen:
+            raise ValueError(f"Repeated batch session id: {session_id}")
+        seen.add(session_id)
+        if not entry.get("megre"):
+            raise ValueError(f"Batch session {session_id} has no MEGRE archive")
+        t1w = entry.get("t1w")
+        sessions.append(
+            {
+                "id": session_id,
+                "megre": [os.path.join(base, z) for z in entry["megre"]],
+                "t1w": os.path.join(base, t1w) if t1w else None,
+                "config": {**defaults, **entry.get("config", {})},
+            }
+        )
+    return sessions
+
+
+def plan_jobs(session_cores, session_memory_bytes, cpus=None, memory_bytes=None):
+    """
+    Return how many sessions to run at once on this node.
+
+    As many as fit in both the available cores and the physical memory,
+    and at least one.
+    """
+    if cpus is None:
+        cpus = len(os.sched_getaffinity(0))
+    if memory_bytes is None:
+        memory_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return max(
+        1,
+        min(
+            cpus // max(1, session_cores), memory_bytes // max(1, session_memory_bytes)
+        ),
+    )
+
+
+def use_scratch(root):
+    """Point this process's working directories at the scratch tree `root`."""
+    global MEGRE_DICOM_DIR, T1W_DICOM_DIR, T1W_NIFTI_DIR, BIDS_DIR, QSM_DIR, CRASH_DIR
+    MEGRE_DICOM_DIR = os.path.join(root, "dicoms", "qsm")
+    T1W_DICOM_DIR = os.path.join(root, "dicoms", "T1w")
+    T1W_NIFTI_DIR = os.path.join(root, "dicoms", "T1w_nifti")
+    BIDS_DIR = os.path.join(root, "bids")
+    QSM_DIR = os.path.join(root, "qsm")
+    CRASH_DIR = root
+
+
+def session_command(spec_path):
+    """Return the command processing the batch session described in `spec_path`."""
+    return [sys.executable, os.path.abspath(__file__), "--session", spec_path]
+
+
+def session_main(spec_path):
+    """
+    Process one batch session, in a process of its own.
+
+    The session runs in its scratch directory, which is removed afterwards
+    unless the spec asks to keep it, and records its outcome in
+    ``session_result.json`` next to its outputs.
+    """
+    with open(spec_path) as f:
+        spec = json.load(f)
+    os.makedirs(spec["scratch"], exist_ok=True)
+    os.chdir(spec["scratch"])
+    use_scratch(spec["scratch"])
+
+    try:
+        crash_files = run_session(
+            spec["config"], spec["megre"], spec["t1w"], spec["output"]
+        )
+    finally:
+        print("Timing report:", stage_log.write(spec["output"]))
+        os.chdir(spec["output"])
+        if not spec["keep_scratch"]:
+            shutil.rmtree(spec["scratch"], ignore_errors=True)
+
+    report = stage_log.report()
+    with open(os.path.join(spec["output"], SESSION_RESULT), "w") as f:
+        json.dump(
+            {
+                "status": "crashed" if crash_files else "ok",
+                "crash_files": [os.path.basename(c) for c in crash_files],
+                "dominant_stage": report["dominant_stage"],
+            },
+            f,
+            indent=2,
+        )
+    return 1 if crash_files else 0
+
+
+def batch_session(session, scratch_root, out_root, keep_scratch):
+    """
+    Run one batch session in a child process and return its summary.
+
+    The child has its own scratch directories and writes its output and a
+    ``session.log`` into ``<out_root>/<id>``. Whatever happens to it, even
+    being killed, only fails this session.
+    """
+    out_dir = os.path.join(out_root, session["id"])
+    scratch = os.path.join(scratch_root, session["id"])
+    shutil.rmtree(scratch, ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+    for stale in (SESSION_RESULT, TIMING_REPORT):
+        if os.path.exists(os.path.join(out_dir, stale)):
+            os.remove(os.path.join(out_dir, stale))
+
+    spec_path = os.path.join(out_dir, SESSION_SPEC)
+    with open(spec_path, "w") as f:
+        json.dump(
+            {
+                **session,
+                "scratch": scratch,
+                "output": out_dir,
+                "keep_scratch": keep_scratch,
+            },
+            f,
+            indent=2,
+        )
+
+    log_path = os.path.join(out_dir, SESSION_LOG)
+    start = time.monotonic()
+    with open(log_path, "w") as log:
+        returncode = subprocess.run(
+            session_command(spec_path), stdout=log, stderr=subprocess.STDOUT
+        ).returncode
+
+    summary = {
+        "id": session["id"],
+        "status": "failed",
+        "returncode": returncode,
+        "wall_seconds": round(time.monotonic() - start, 3),
+        "output": out_dir,
+        "log": log_path,
+    }
+    result_path = os.path.join(out_dir, SESSION_RESULT)
+    if os.path.exists(result_path):
+        with open(result_path) as f:
+            summary.update(json.load(f))
+    else:
+        # Killed, or failed with a traceback: its last line tells which.
+        with open(log_path, errors="replace") as f:
+            lines = [line.strip() for line in f if line.strip()]
+        summary["error"] = lines[-1] if lines else f"exit status {returncode}"
+    return summary
+
+
+def run_batch(
+    manifest_path,
+    scratch_root,
+    out_root,
+    jobs=None,
+    session_cores=DEFAULT_SESSION_CORES,
+    session_memory_gb=DEFAULT_SESSION_MEMORY_GB,
+    keep_scratch=False,
+):
+    """
+    Process every session of a batch manifest on this node.
+
+    Sessions run `jobs` at a time (by default as many as fit the node's
+    cores and memory given `session_cores` and `session_memory_gb`), each
+    in its own process and scratch directory, so one failing session never
+    stops the others.
+
+    Returns
+    -------
+    dict
+        The batch summary, also written to ``<out_root>/batch_summary.json``:
+        the number of sessions per status and each session's summary.
+    """
+    sessions = load_batch_manifest(manifest_path)
+    if jobs is None:
+        jobs = plan_jobs(session_cores, int(session_memory_gb * 1e9))
+    os.makedirs(out_root, exist_ok=True)
+    print(f"Batch of {len(sessions)} sessions, {jobs} at a time")
+
+    start = time.monotonic()
+    results = {}
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            pool.submit(batch_session, s, scratch_root, out_root, keep_scratch): s
+            for s in sessions
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            results[result["id"]] = result
+            print(
+                f"[BATCH] {result['id']}: {result['status']} "
+                f"({result['wall_seconds']:.0f} s, log {result['log']})",
+                flush=True,
+            )
+
+    ordered = [results[s["id"]] for s in sessions]
+    summary = {
+        "total_wall_seconds": round(time.monotonic() - start, 3),
+        "jobs": jobs,
+        "counts": dict(Counter(r["status"] for r in ordered)),
+        "sessions": ordered,
+    }
+    with open(os.path.join(out_root, BATCH_SUMMARY), "w") as f:
+        json.dump(summary, f, indent=2)
+    print("Batch summary:", summary["counts"])
+    return summary
+
+
+def main(argv=None):
+    """Run the gear, a local batch, or (internally) one batch session."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--batch", metavar="MANIFEST", help="process the sessions of a JSON manifest"
+    )
+    parser.add_argument("--scratch", help="root of the per-session scratch trees")
+    parser.add_argument("--out", help="root of the per-session output folders")
+    parser.add_argument(
+        "--jobs", type=int, help="sessions at a time (default: fit cores and memory)"
+    )
+    parser.add_argument(
+        "--session-cores",
+        type=int,
+        default=DEFAULT_SESSION_CORES,
+        help="cores one session uses (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--session-memory-gb",
+        type=float,
+        default=DEFAULT_SESSION_MEMORY_GB,
+        help="memory one session needs (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--keep-scratch", action="store_true", help="keep scratch trees afterwards"
+    )
+    parser.add_argument("--session", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.session:
+        sys.exit(session_main(args.session))
+    if args.batch:
+        if not (args.scratch and args.out):
+            parser.error("--batch needs --scratch and --out")
+        summary = run_batch(
+            args.batch,
+            args.scratch,
+            args.out,
+            jobs=args.jobs,
+            session_cores=args.session_cores,
+            session_memory_gb=args.session_memory_gb,
+            keep_scratch=args.keep_scratch,
+        )
+        sys.exit(0 if set(summary["counts"]) <= {"ok"} else 1)
     flywheel_run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import conversion_cache
+import run
+from conversion_cache import ConversionCache
+
+REPO = Path(__file__).resolve().parents[2]
+
+# --------------------------------------------------
+# Helpers
+# --------------------------------------------------
+
+
+def write_tree(root, files):
+    for rel, data in files.items():
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel).write_bytes(data)
+    return root
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ConversionCache(str(tmp_path / "cache"), max_bytes=1000)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def gear_dirs(tmp_path, monkeypatch):
+    for name in ("MEGRE_DICOM_DIR", "T1W_DICOM_DIR", "T1W_NIFTI_DIR", "BIDS_DIR"):
+        monkeypatch.setattr(run, name, str(tmp_path / name.lower()))
+    return tmp_path
+
+
+# --------------------------------------------------
+# Tests
+# --------------------------------------------------
+
+
+def test_qsm_medi_copy_is_identical():
+    copy = REPO / "qsm-medi/src/scripts/preprocessing/conversion_cache.py"
+    assert copy.read_bytes() == Path(conversion_cache.__file__).read_bytes()
+
+
+def test_key_depends_on_content_converter_and_options(tmp_path):
+    a = write_tree(tmp_path / "a", {"s/1.dcm": b"one", "s/2.dcm": b"two"})
+    b = write_tree(tmp_path / "b", {"s/1.dcm": b"one", "s/2.dcm": b"two"})
+    os.utime(b / "s/1.dcm", (0, 0))
+    key = ConversionCache.key("dcm2niix", "v1", ["-z", "n"], str(a))
+
+    # Same bytes elsewhere, with other timestamps: same key.
+    assert ConversionCache.key("dcm2niix", "v1", ["-z", "n"], str(b)) == key
+    assert ConversionCache.key("dcm2niix", "v2", ["-z", "n"], str(a)) != key
+    assert ConversionCache.key("dcm2niix", "v1", ["-z", "y"], str(a)) != key
+    (b / "s/2.dcm").write_bytes(b"changed")
+    assert ConversionCache.key("dcm2niix", "v1", ["-z", "n"], str(b)) != key
+
+
+def test_convert_hit_hard_links_stored_output(cache, tmp_path):
+    calls = []
+
+    def convert(dest):
+        def run_converter():
+            calls.append(dest)
+            write_tree(dest, {"sub-1/anat/x.nii": b"nifti", "sub-1/anat/x.json": b"{}"})
+
+        return run_converter
+
+    first, second = tmp_path / "first", tmp_path / "second"
+    assert not cache.convert("k", str(first), convert(first))
+    assert cache.convert("k", str(second), convert(second))
+
+    assert calls == [first]
+    assert (second / "sub-1/anat/x.json").read_bytes() == b"{}"
+    nifti = second / "sub-1/anat/x.nii"
+    assert nifti.stat().st_ino == (first / "sub-1/anat/x.nii").stat().st_ino
+
+
+def test_fetch_miss_leaves_destination_alone(cache, tmp_path):
+    assert cache.fetch("missing", str(tmp_path / "dest")) is None
+    assert not (tmp_path / "dest").exists()
+
+
+def test_evicts_least_recently_used(cache, tmp_path):
+    for key in ("a", "b", "c"):
+        write_tree(tmp_path / key, {"out.nii": b"x" * 400})
+        cache.store(key, str(tmp_path / key))
+        if key == "b":
+            cache.fetch("a", str(tmp_path / "again"))
+
+    # "b" was used least recently once "a" was fetched again.
+    assert cache.total_bytes() == 800
+    assert cache.fetch("b", str(tmp_path / "b2")) is None
+    assert cache.fetch("a", str(tmp_path / "a2")) is not None
+    assert not os.path.exists(cache.entry_path("b"))
+
+
+def test_run_conversion_reuses_cached_output(cache, gear_dirs, monkeypatch):
+    write_tree(Path(run.MEGRE_DICOM_DIR), {"e1.dcm": b"dicom"})
+    calls = []
+
+    def run_cmd(cmd, description):
+        calls.append(cmd[0])
+        write_tree(Path(run.BIDS_DIR), {"sub-1/anat/megre.nii": b"nifti"})
+
+    monkeypatch.setattr(run, "run_cmd", run_cmd)
+    monkeypatch.setattr(run, "converter_version", lambda executable: "v1")
+    monkeypatch.setattr(run, "stage_log", run.StageLog())
+
+    run.convert_megre(cache)
+    for path in Path(run.BIDS_DIR).rglob("*.nii"):
+        path.unlink()
+    run.convert_megre(cache)
+
+    assert calls == ["dicom-convert"]
+    assert (Path(run.BIDS_DIR) / "sub-1/anat/megre.nii").read_bytes() == b"nifti"
+    assert [e["kind"] for e in run.stage_log.entries] == ["cache"]
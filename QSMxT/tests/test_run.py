@@ -0,0 +1,402 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from pathlib import Path
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import run
+
+# --------------------------------------------------
+# Helpers
+# --------------------------------------------------
+
+
+@pytest.fixture
+def gear_dirs(tmp_path, monkeypatch):
+    """Point the gear's fixed container paths into a temporary directory."""
+    for name in ("MEGRE_DICOM_DIR", "T1W_DICOM_DIR", "T1W_NIFTI_DIR", "BIDS_DIR"):
+        monkeypatch.setattr(run, name, str(tmp_path / name.lower()))
+    return tmp_path
+
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name in members:
+            zf.writestr(name, name.encode())
+    return str(path)
+
+
+def fake_converters(barrier=None):
+    """Stand-ins for dicom-convert and dcm2niix writing their usual outputs."""
+    calls = []
+
+    def run_cmd(cmd, description):
+        calls.append(cmd[0])
+        if barrier is not None:
+            barrier.wait()
+        if cmd[0] == "dicom-convert":
+            assert len(list(Path(cmd[1]).rglob("*.dcm"))) == 6
+            anat = Path(cmd[2]) / "sub-1" / "ses-1" / "anat"
+            anat.mkdir(parents=True)
+            (anat / "sub-1_ses-1_run-1_echo-1_part-mag_MEGRE.nii").touch()
+        else:
+            assert len(list(Path(cmd[-1]).rglob("*.dcm"))) == 3
+            for ext in (".nii", ".json"):
+                (Path(cmd[6]) / f"{run.T1W_STEM}{ext}").touch()
+
+    return run_cmd, calls
+
+
+@pytest.fixture
+def stage_log(monkeypatch):
+    log = run.StageLog()
+    monkeypatch.setattr(run, "stage_log", log)
+    return log
+
+
+# --------------------------------------------------
+# Tests
+# --------------------------------------------------
+
+
+def test_run_cmd_streams_output_and_records_usage(stage_log, capsys):
+    script = (
+        "import sys, time\n"
+        "print('first', flush=True)\n"
+        "print('warning', file=sys.stderr, flush=True)\n"
+        "data = bytearray(32 << 20)\n"
+        "end = time.process_time() + 0.2\n"
+        "while time.process_time() < end: pass\n"
+        "print('last')\n"
+    )
+
+    result = run.run_cmd([sys.executable, "-c", script], "busy child")
+
+    assert result.returncode == 0
+    assert capsys.readouterr().out.splitlines()[-3:] == ["first", "warning", "last"]
+    (entry,) = stage_log.entries
+    assert entry["name"] == "busy child"
+    assert entry["kind"] == "command"
+    assert entry["user_cpu_seconds"] + entry["system_cpu_seconds"] >= 0.2
+    assert entry["wall_seconds"] >= 0.2
+    assert entry["max_rss_kb"] >= 32 << 10
+
+
+def test_run_cmd_failure_reports_output_tail(stage_log):
+    script = "import sys; print('useful context'); sys.exit(3)"
+
+    with pytest.raises(RuntimeError, match=r"(?s)exit 3.*useful context"):
+        run.run_cmd([sys.executable, "-c", script], "failing step")
+
+    assert stage_log.entries[0]["returncode"] == 3
+
+
+def test_timing_report_names_dominant_stage(stage_log, tmp_path):
+    with stage_log.stage("quick"):
+        pass
+    run.run_cmd([sys.executable, "-c", "import time; time.sleep(0.3)"], "slow")
+
+    with open(stage_log.write(str(tmp_path))) as f:
+        report = json.load(f)
+
+    assert report["dominant_stage"] == "slow"
+    assert [e["name"] for e in report["stages"]] == ["quick", "slow"]
+    assert report["stages"][0]["kind"] == "stage"
+    assert report["total_wall_seconds"] >= 0.3
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs procfs")
+def test_tree_rss_includes_descendants():
+    grandchild = "import time; data = bytearray(64 << 20); time.sleep(30)"
+    spawn = (
+        "import subprocess, sys; "
+        f"subprocess.run([sys.executable, '-c', {grandchild!r}])"
+    )
+    child = subprocess.Popen([sys.executable, "-c", spawn])
+    try:
+        deadline = time.monotonic() + 10
+        while run.tree_rss_kb(child.pid) < 64 << 10 and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert run.tree_rss_kb(child.pid) >= 64 << 10
+    finally:
+        for pid in run.process_children().get(child.pid, ()):
+            os.kill(pid, signal.SIGKILL)
+        child.kill()
+        child.wait()
+
+
+def test_convert_inputs_runs_conversions_concurrently(gear_dirs, monkeypatch):
+    megre = [
+        write_zip(gear_dirs / f"megre{n}.zip", [f"s{n}/e{i}.dcm" for i in range(3)])
+        for n in (1, 2)
+    ]
+    t1w = write_zip(gear_dirs / "t1w.zip", [f"t1/{i}.dcm" for i in range(3)])
+    # Both converters must be running at once to get past the barrier.
+    run_cmd, calls = fake_converters(threading.Barrier(2, timeout=10))
+    monkeypatch.setattr(run, "run_cmd", run_cmd)
+
+    run.convert_inputs(megre, t1w, workers=3)
+
+    anat = Path(run.BIDS_DIR) / "sub-1" / "ses-1" / "anat"
+    assert sorted(calls) == ["dcm2niix", "dicom-convert"]
+    assert (anat / "sub-1_ses-1_T1w.nii").exists()
+    assert (anat / "sub-1_ses-1_T1w.json").exists()
+    assert not list(Path(run.T1W_NIFTI_DIR).iterdir())
+
+
+def test_convert_inputs_without_t1w(gear_dirs, monkeypatch):
+    megre = [
+        write_zip(
+            gear_dirs / "megre.zip",
+            [f"s/e{i}/{j}.dcm" for i in range(3) for j in (1, 2)],
+        )
+    ]
+    run_cmd, calls = fake_converters()
+    monkeypatch.setattr(run, "run_cmd", run_cmd)
+
+    run.convert_inputs(megre, None, workers=4)
+
+    assert calls == ["dicom-convert"]
+    assert not os.path.exists(run.T1W_DICOM_DIR)
+
+
+@pytest.fixture
+def qsm_tree(tmp_path):
+    """A small QSMxT result tree with a workflow directory."""
+    qsm = tmp_path / "qsm"
+    for rel, data in {
+        "qsm/sub-1_Chimap.nii": b"chi" * 1000,
+        "qsm/sub-1_Chimap.nii.gz": b"\x1f\x8b already compressed",
+        "segmentations/sub-1_dseg.nii": b"seg" * 1000,
+        "workflow/node/result_node.pklz": b"pickled",
+        "workflow/node/report.rst": b"report" * 100,
+        "workflow/node/ignored.nii": b"intermediate",
+    }.items():
+        (qsm / rel).parent.mkdir(parents=True, exist_ok=True)
+        (qsm / rel).write_bytes(data)
+    (qsm / "empty").mkdir()
+    out = tmp_path / "output"
+    out.mkdir()
+    return qsm, out
+
+
+def test_package_outputs_single_pass(qsm_tree):
+    qsm, out = qsm_tree
+
+    result = run.package_outputs(str(qsm), str(out), workers=3)
+
+    with zipfile.ZipFile(result["workflow"]) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == [
+            "node/ignored.nii",
+            "node/report.rst",
+            "node/result_node.pklz",
+        ]
+        assert zf.getinfo("node/result_node.pklz").compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo("node/report.rst").compress_type == zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(result["qsm"]) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == [
+            "empty/",
+            "qsm/sub-1_Chimap.nii",
+            "qsm/sub-1_Chimap.nii.gz",
+            "segmentations/sub-1_dseg.nii",
+        ]
+        assert zf.read("qsm/sub-1_Chimap.nii") == b"chi" * 1000
+        assert zf.getinfo("qsm/sub-1_Chimap.nii.gz").compress_type == zipfile.ZIP_STORED
+
+    # Only result NIfTI files are published, as links to the originals.
+    assert sorted(os.path.basename(p) for p in result["nifti"]) == [
+        "sub-1_Chimap.nii",
+        "sub-1_dseg.nii",
+    ]
+    published = out / "sub-1_Chimap.nii"
+    assert published.stat().st_ino == (qsm / "qsm" / "sub-1_Chimap.nii").stat().st_ino
+
+
+def test_package_outputs_zip64(qsm_tree, monkeypatch):
+    qsm, out = qsm_tree
+    # Force the ZIP64 records that real multi-gigabyte outputs would need.
+    monkeypatch.setattr(run, "ZIP64_LIMIT", 16)
+
+    result = run.package_outputs(str(qsm), str(out), workers=2)
+
+    with zipfile.ZipFile(result["qsm"]) as zf:
+        assert zf.testzip() is None
+        assert zf.read("segmentations/sub-1_dseg.nii") == b"seg" * 1000
+
+
+@pytest.mark.parametrize("failing", ["report.rst", "sub-1_dseg.nii"])
+def test_package_outputs_cleans_up_on_failure(qsm_tree, monkeypatch, failing):
+    qsm, out = qsm_tree
+    compressed = []
+
+    def compress_member(src, stored):
+        if os.path.basename(src) == failing:
+            raise OSError(f"cannot read {src}")
+        result = real_compress(src, stored)
+        if result[2] is not None:
+            compressed.append(result[2])
+        return result
+
+    real_compress = run.compress_member
+    monkeypatch.setattr(run, "compress_member", compress_member)
+
+    with pytest.raises(OSError, match="cannot read"):
+        run.package_outputs(str(qsm), str(out), workers=2)
+
+    # No partial archive is left, and every compressed member was closed.
+    assert not (out / "workflow.zip").exists()
+    assert not (out / "qsm.zip").exists()
+    assert compressed
+    assert all(data.closed for data in compressed)
+
+
+def test_zip_sink_removes_archive_when_block_raises(tmp_path):
+    path = tmp_path / "partial.zip"
+    with pytest.raises(RuntimeError), run.ZipSink(str(path)) as sink:
+        sink.add_directory("d", str(tmp_path))
+        raise RuntimeError("interrupted")
+
+    assert sink.fp.closed
+    assert not path.exists()
+
+
+def write_manifest(path, sessions, config=None):
+    path.write_text(json.dumps({"config": config or {}, "sessions": sessions}))
+    return str(path)
+
+
+def test_load_batch_manifest(tmp_path):
+    manifest = write_manifest(
+        tmp_path / "batch.json",
+        [
+            {"id": "s1", "megre": ["a.zip"], "t1w": "/data/t.zip"},
+            {"id": "s2", "megre": ["b.zip"], "config": {"premade": "fast"}},
+        ],
+        config={"premade": "gre", "workers": 2},
+    )
+
+    s1, s2 = run.load_batch_manifest(manifest)
+
+    assert s1["megre"] == [str(tmp_path / "a.zip")]
+    assert s1["t1w"] == "/data/t.zip"
+    assert s2["t1w"] is None
+    assert s1["config"] == {"premade": "gre", "workers": 2}
+    assert s2["config"] == {"premade": "fast", "workers": 2}
+
+
+@pytest.mark.parametrize(
+    ("sessions", "message"),
+    [
+        ([{"id": "../x", "megre": ["a.zip"]}], "Invalid"),
+        ([{"id": "s", "megre": ["a.zip"]}, {"id": "s", "megre": ["b"]}], "Repeated"),
+        ([{"id": "s", "megre": []}], "no MEGRE"),
+    ],
+)
+def test_load_batch_manifest_rejects(tmp_path, sessions, message):
+    with pytest.raises(ValueError, match=message):
+        run.load_batch_manifest(write_manifest(tmp_path / "batch.json", sessions))
+
+
+def test_plan_jobs_fits_cores_and_memory():
+    assert run.plan_jobs(4, 16e9, cpus=64, memory_bytes=128e9) == 8
+    assert run.plan_jobs(4, 16e9, cpus=16, memory_bytes=512e9) == 4
+    assert run.plan_jobs(4, 16e9, cpus=2, memory_bytes=8e9) == 1
+
+
+# Stand-in for a session process: the session id picks how it ends.
+FAKE_SESSION = """
+import json, os, signal, sys
+spec = json.load(open(sys.argv[1]))
+print("processing", spec["id"], flush=True)
+if spec["id"] == "killed":
+    os.kill(os.getpid(), signal.SIGKILL)
+if spec["id"] == "broken":
+    raise RuntimeError("Command failed during: QSMxT processing")
+with open(os.path.join(spec["output"], "session_result.json"), "w") as f:
+    json.dump({"status": "ok", "crash_files": [], "dominant_stage": "QSMxT"}, f)
+"""
+
+
+def test_run_batch_isolates_failing_sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        run,
+        "session_command",
+        lambda spec_path: [sys.executable, "-c", FAKE_SESSION, spec_path],
+    )
+    manifest = write_manifest(
+        tmp_path / "batch.json",
+        [{"id": i, "megre": ["a.zip"]} for i in ("s1", "killed", "broken", "s2")],
+    )
+    out = tmp_path / "out"
+
+    summary = run.run_batch(manifest, str(tmp_path / "scratch"), str(out), jobs=2)
+
+    assert summary["counts"] == {"ok": 2, "failed": 2}
+    by_id = {s["id"]: s for s in summary["sessions"]}
+    assert [s["id"] for s in summary["sessions"]] == ["s1", "killed", "broken", "s2"]
+    assert by_id["killed"]["returncode"] == -signal.SIGKILL
+    assert "QSMxT processing" in by_id["broken"]["error"]
+    assert by_id["s2"]["dominant_stage"] == "QSMxT"
+    assert (out / "s1" / "session.log").read_text() == "processing s1\n"
+    assert json.loads((out / "batch_summary.json").read_text()) == summary
+
+
+def test_session_main_uses_scratch_tree(tmp_path, monkeypatch):
+    for name in (
+        "MEGRE_DICOM_DIR",
+        "T1W_DICOM_DIR",
+        "T1W_NIFTI_DIR",
+        "BIDS_DIR",
+        "QSM_DIR",
+        "CRASH_DIR",
+    ):
+        monkeypatch.setattr(run, name, getattr(run, name))
+    monkeypatch.setattr(run, "stage_log", run.StageLog())
+    monkeypatch.chdir(tmp_path)
+    scratch, out = tmp_path / "scratch" / "s1", tmp_path / "out" / "s1"
+    out.mkdir(parents=True)
+    seen = {}
+
+    def run_session(config, megre_zips, t1w_zip, out_dir):
+        seen.update(bids=run.BIDS_DIR, qsm=run.QSM_DIR, cwd=os.getcwd())
+        crash = Path(run.CRASH_DIR) / "crash-1.pklz"
+        crash.touch()
+        return [str(crash)]
+
+    monkeypatch.setattr(run, "run_session", run_session)
+    spec = tmp_path / "session.json"
+    spec.write_text(
+        json.dumps(
+            {
+                "id": "s1",
+                "megre": ["a.zip"],
+                "t1w": None,
+                "config": {},
+                "scratch": str(scratch),
+                "output": str(out),
+                "keep_scratch": False,
+            }
+        )
+    )
+
+    assert run.session_main(str(spec)) == 1
+
+    assert seen == {
+        "bids": str(scratch / "bids"),
+        "qsm": str(scratch / "qsm"),
+        "cwd": str(scratch),
+    }
+    assert not scratch.exists()
+    result = json.loads((out / "session_result.json").read_text())
+    assert result["status"] == "crashed"
+    assert result["crash_files"] == ["crash-1.pklz"]
+    assert (out / "timing.json").exists()
@@ -6,35 +6,18 @@
 
 import json
 import os
-import subprocess
-import time
+import shutil
+import sys
 import zipfile
 
 import flywheel
 
-path_parameters_json = "/input/parameters/qsm_parameters.json"
-
-
-def run_command_with_subprocess(command):
-    terminal_env = os.environ.copy()
+# process_runner.py is installed next to this script's folder.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from orchestrator import STAGE_CACHE
+from process_runner import COMMAND_LOG, ProcessRunner
 
-    def stream_process(process):
-        go = process.poll() is None
-        for line in process.stdout:
-            print(line, end="")
-        return go
-
-    process = subprocess.Popen(
-        args=command,
-        env=terminal_env,
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-    )
-    while stream_process(process):
-        time.sleep(0.1)
-    return process.returncode
+path_parameters_json = "/input/parameters/qsm_parameters.json"
 
 
 def create_parameters_json_from_flywheel_context(input_context):
@@ -100,17 +83,44 @@ with flywheel.GearContext() as context:
     if num_threads_hdbet is None:
         num_threads_hdbet = 0
 
+    # Read by the preprocessing scripts, which see the gear's environment.
+    conversion_cache_dir = context.config.get("conversion_cache_dir")
+    if conversion_cache_dir:
+        os.environ["CONVERSION_CACHE_DIR"] = conversion_cache_dir
+        conversion_cache_gb = context.config.get("conversion_cache_gb")
+        if conversion_cache_gb is not None:
+            os.environ["CONVERSION_CACHE_GB"] = str(conversion_cache_gb)
+
     create_parameters_json_from_flywheel_context(context)
     pipeline_command = (
         f"/opt/process_QSM/run.sh -i {input_folder} -o {output_folder} "
         f"-p {path_parameters_json} -n {num_threads_hdbet}"
     ).split()
-    returncode = run_command_with_subprocess(pipeline_command)
+    # Flywheel stops a gear with SIGTERM: pass it on to the whole pipeline.
+    runner = ProcessRunner(log_path=os.path.join(output_folder, COMMAND_LOG))
+    runner.cancel_on_signals()
+    timeout_hours = context.config.get("pipeline_timeout_hours")
+    result = runner.run(
+        pipeline_command,
+        description="QSM-MEDI pipeline",
+        timeout=timeout_hours * 3600 if timeout_hours else None,
+    )
 
-    if returncode != 0:
-        raise Exception("ERROR: run.sh returned a non-zero exit code. See error above")
+    if result.timed_out:
+        raise Exception(f"ERROR: run.sh timed out after {timeout_hours} hours")
+    if result.cancelled:
+        raise Exception("ERROR: run.sh was cancelled")
+    if result.returncode != 0:
+        raise Exception(
+            f"ERROR: run.sh returned a non-zero exit code ({result.returncode}). "
+            "See error above"
+        )
 
     if not os.path.isfile(f"{output_folder}/QSM.nii.gz"):
         raise Exception(
             "ERROR: Final check failed - QSM image was not created. See error above"
         )
+
+    # Flywheel jobs start from an empty output folder and never resume, so
+    # the orchestrator's stage cache is not kept with the outputs.
+    shutil.rmtree(os.path.join(output_folder, STAGE_CACHE), ignore_errors=True)
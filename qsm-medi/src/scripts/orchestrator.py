@@ -0,0 +1,491 @@
+# SPDX-License-Identifier: BSD-3-Clause
+"""
+Dependency-graph runner for the stages of the QSM-MEDI pipeline.
+
+Each stage declares the files it reads, the stages it depends on, the
+pipeline parameters it uses and the files it writes. Its fingerprint is a
+digest of all of these (and of the pipeline version). Stages run in
+dependency order. A stage is skipped when its fingerprint matches the one
+recorded in ``.pipeline_state.json`` after its last successful run and its
+outputs are unchanged since.
+
+A failed run therefore resumes at the stage that failed, and a rerun that
+changes only MEDI parameters (e.g. ``medi_lambda``) goes straight to MEDI.
+
+Unless ``debug_mode`` is 1, pipeline_qsm.m deletes ``temp_*`` (the outputs
+of every stage before it but iMag and the mask) once MEDI is done. Those
+outputs are hard-linked into ``.pipeline_cache`` when their stage completes
+and restored from there when a later run checks or needs them.
+
+Usage: orchestrator.py dicom|nifti PARAMETERS_JSON [-n HDBET_THREADS] [--force]
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sys
+from typing import NamedTuple, Optional, Tuple
+
+from process_runner import ProcessRunner
+
+STATE_FILE = ".pipeline_state.json"
+STAGE_CACHE = ".pipeline_cache"
+# Outputs under this prefix are removed by the MEDI stage's cleanup.
+SCRATCH_PREFIX = "temp_"
+STATE_VERSION = 1
+HASH_CHUNK = 1 << 20
+
+SCRIPTS_FOLDER = os.path.dirname(os.path.abspath(__file__))
+MCR_ROOT = "/opt/MCR-2018b/v95"
+MCR_PIPELINE = f"{SCRIPTS_FOLDER}/for_redistribution_files_only/run_pipeline_qsm.sh"
+
+
+class Stage(NamedTuple):
+    name: str
+    command: Tuple[str, ...]
+    outputs: Tuple[str, ...]
+    deps: Tuple[str, ...] = ()
+    inputs: Tuple[str, ...] = ()
+    # Parameter names the stage uses; None for all of them.
+    parameters: Optional[Tuple[str, ...]] = ()
+    # Files other stages write inside this stage's output folders.
+    exclude: Tuple[str, ...] = ()
+    error: str = "ERROR: Stage failed"
+    exit_code: int = 1
+
+
+class StageFailed(Exception):
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+
+def pipeline_stages(
+    input_data_type, path_parameters_json, output_folder, threads, custom_mask
+):
+    """
+    Return the pipeline's stages.
+
+    Without a custom mask, the mask is computed by hd-bet from the combined
+    magnitude (iMag); with one, those stages are left out and MEDI reads
+    the custom mask instead.
+    """
+    input_folder = os.environ["INPUT_FOLDER"]
+    input_data = "dicom_data" if input_data_type == "dicom" else "nifti"
+    stages = [
+        Stage(
+            "reference",
+            (
+                "python3",
+                f"{SCRIPTS_FOLDER}/preprocessing/create_reference_3d_nifti.py",
+                input_data_type,
+                path_parameters_json,
+            ),
+            outputs=("temp_reference_3d.nii", "temp_dcm2niix"),
+            inputs=(os.path.join(input_folder, input_data),),
+            parameters=("load_nifti_common_prefix",),
+            exclude=("meta_data.json",),
+            error="ERROR: Could not create reference 3d nifti",
+        ),
+        Stage(
+            "metadata",
+            (
+                "python3",
+                f"{SCRIPTS_FOLDER}/preprocessing/determine_nifti_folder_type.py",
+                path_parameters_json,
+            ),
+            outputs=("temp_dcm2niix/meta_data.json",),
+            deps=("reference",),
+            parameters=("load_nifti_common_prefix",),
+            error="ERROR: Could not determine data in nifti folder, "
+            "missing temp_dcm2niix/meta_data.json",
+        ),
+    ]
+    if custom_mask:
+        mask_deps, mask_inputs = (), (custom_mask,)
+    else:
+        mask_deps, mask_inputs = ("hdbet_post",), ()
+        stages += [
+            Stage(
+                "pre_hdbet",
+                (
+                    "python3",
+                    f"{SCRIPTS_FOLDER}/preprocessing/compute_imag.py",
+                    path_parameters_json,
+                ),
+                outputs=("iMag.nii",),
+                deps=("reference", "metadata"),
+                # The echoes to combine come from meta_data.json; no
+                # parameter changes the magnitude.
+                error="ERROR: Could not create magnitude image for hd-bet",
+            ),
+            Stage(
+                "hdbet_prep",
+                ("python3", f"{SCRIPTS_FOLDER}/hd-bet/prep_image_for_hdbet.py"),
+                outputs=("temp_hd-bet_input.nii.gz",),
+                deps=("pre_hdbet",),
+            ),
+            Stage(
+                "hdbet",
+                (
+                    "hd-bet",
+                    "-i",
+                    "temp_hd-bet_input.nii.gz",
+                    "-o",
+                    "temp_hd-bet_output_pre.nii.gz",
+                    "-device",
+                    "cpu",
+                    "-threads",
+                    str(threads),
+                    "-mode",
+                    "fast",
+                    "-tta",
+                    "0",
+                ),
+                # hd-bet always writes <output>_mask.nii.gz next to <output>.
+                outputs=("temp_hd-bet_output_pre_mask.nii.gz",),
+                deps=("hdbet_prep",),
+            ),
+            Stage(
+                "hdbet_post",
+                ("python3", f"{SCRIPTS_FOLDER}/hd-bet/post_for_hdbet.py"),
+                outputs=("QSM_mask.nii",),
+                deps=("hdbet", "pre_hdbet"),
+            ),
+        ]
+    stages.append(
+        Stage(
+            "medi",
+            (MCR_PIPELINE, MCR_ROOT, "execute", path_parameters_json, output_folder),
+            outputs=("QSM.nii",),
+            deps=("reference", "metadata", *mask_deps),
+            inputs=mask_inputs,
+            parameters=None,
+            error="ERROR: QSM pipeline failed during MEDI processing",
+            exit_code=2,
+        )
+    )
+    return stages
+
+
+def dependency_order(stages):
+    """
+    Return `stages` sorted so that every stage follows its dependencies.
+
+    Raises
+    ------
+    ValueError
+        If a dependency is unknown or the dependencies form a cycle.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    ordered, done, visiting = [], set(), set()
+
+    def visit(stage):
+        if stage.name in done:
+            return
+        if stage.name in visiting:
+            raise ValueError(f"Dependency cycle through stage {stage.name}")
+        visiting.add(stage.name)
+        for dep in stage.deps:
+            if dep not in by_name:
+                raise ValueError(f"Stage {stage.name} depends on unknown {dep}")
+            visit(by_name[dep])
+        visiting.discard(stage.name)
+        done.add(stage.name)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def digest_stream(f, digest):
+    while True:
+        chunk = f.read(HASH_CHUNK)
+        if not chunk:
+            return digest
+        digest.update(chunk)
+
+
+def digest_path(path, exclude=()):
+    """
+    Return a content digest of a file or folder, or None if it is missing.
+
+    A file that the final compression step replaced by ``<path>.gz`` is
+    hashed through the decompressed stream, so it keeps its digest. Folder
+    digests cover relative paths and contents, leaving out `exclude` names.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name in exclude:
+                    continue
+                file_path = os.path.join(dirpath, name)
+                digest.update(os.path.relpath(file_path, path).encode() + b"\0")
+                digest.update(digest_path(file_path).encode())
+        return digest.hexdigest()
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            return digest_stream(f, digest).hexdigest()
+    if os.path.isfile(path + ".gz"):
+        with gzip.open(path + ".gz", "rb") as f:
+            return digest_stream(f, digest).hexdigest()
+    return None
+
+
+def cache_path(path):
+    return os.path.join(STAGE_CACHE, path)
+
+
+def is_scratch(path):
+    """Return whether the MEDI stage's cleanup removes output `path`."""
+    return path.split("/", 1)[0].startswith(SCRATCH_PREFIX)
+
+
+def link_or_copy(src, dest):
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def link_path(src, dest):
+    """Hard-link file or folder `src` to `dest`, copying across file systems."""
+    if os.path.isdir(src):
+        shutil.copytree(src, dest, copy_function=link_or_copy)
+    else:
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        link_or_copy(src, dest)
+
+
+def restore(path):
+    """Restore `path` from the stage cache if it was removed since cached."""
+    cached = cache_path(path)
+    if is_scratch(path) and not os.path.lexists(path) and os.path.exists(cached):
+        print(f"INFO: Restoring {path} from {STAGE_CACHE}", flush=True)
+        link_path(cached, path)
+
+
+def materialise(path):
+    """
+    Bring back `path` if a later step removed it.
+
+    Scratch outputs come back from the stage cache; a file the final
+    compression step replaced by ``<path>.gz`` is decompressed.
+    """
+    restore(path)
+    if not os.path.exists(path) and os.path.isfile(path + ".gz"):
+        print(f"INFO: Restoring {path} from {path}.gz", flush=True)
+        with gzip.open(path + ".gz", "rb") as src, open(path, "wb") as dest:
+            shutil.copyfileobj(src, dest, HASH_CHUNK)
+
+
+def overlaps(a, b):
+    """Return whether paths `a` and `b` are the same or one contains the other."""
+    return a == b or a.startswith(b + "/") or b.startswith(a + "/")
+
+
+def remove_path(path):
+    for candidate in (path, path + ".gz"):
+        if os.path.isdir(candidate):
+            shutil.rmtree(candidate)
+        elif os.path.lexists(candidate):
+            os.remove(candidate)
+
+
+class Orchestrator:
+    """
+    Runs pipeline stages in dependency order, skipping those still valid.
+
+    Stage outputs are relative to the current folder (the output folder).
+    The state of every stage that completed is saved in `state_path` as
+    soon as it completes, and its scratch outputs are linked into the stage
+    cache.
+    """
+
+    def __init__(self, stages, parameters, state_path=STATE_FILE, runner=None):
+        self.stages = dependency_order(stages)
+        self.by_name = {stage.name: stage for stage in self.stages}
+        self.parameters = parameters
+        self.state_path = state_path
+        self.runner = runner or ProcessRunner()
+        self.state = self.load_state()
+        self.digests = {}
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        if state.get("version") != STATE_VERSION:
+            return {}
+        return state.get("stages", {})
+
+    def save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": STATE_VERSION, "stages": self.state}, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def digest(self, path, exclude=()):
+        key = (path, exclude)
+        if key not in self.digests:
+            self.digests[key] = digest_path(path, exclude)
+        return self.digests[key]
+
+    def output_digests(self, stage):
+        return {output: self.digest(output, stage.exclude) for output in stage.outputs}
+
+    def fingerprint(self, stage):
+        """Digest of everything that determines the stage's outputs."""
+        if stage.parameters is None:
+            parameters = self.parameters
+        else:
+            parameters = {
+                k: self.parameters[k] for k in stage.parameters if k in self.parameters
+            }
+        inputs = {path: self.digest(path) for path in stage.inputs}
+        for dep in stage.deps:
+            inputs.update(self.output_digests(self.by_name[dep]))
+        # The command is left out: its paths and thread counts do not change
+        # the outputs, and script changes come with a new pipeline version.
+        document = {
+            "version": os.environ.get("PIPELINE_VERSION", ""),
+            "stage": stage.name,
+            "parameters": parameters,
+            "inputs": inputs,
+        }
+        encoded = json.dumps(document, sort_keys=True).encode()
+        return hashlib.blake2b(encoded, digest_size=32).hexdigest()
+
+    def is_valid(self, stage, fingerprint):
+        record = self.state.get(stage.name)
+        return (
+            record is not None
+            and record["fingerprint"] == fingerprint
+            and None not in record["outputs"].values()
+            and record["outputs"] == self.output_digests(stage)
+        )
+
+    def run(self, force=False):
+        """
+        Run every stage that is not still valid (all of them with `force`).
+
+        Returns
+        -------
+        list of str
+            The names of the stages that ran.
+
+        Raises
+        ------
+        StageFailed
+            If a stage's command fails or does not write all its outputs.
+        """
+        ran = []
+        for stage in self.stages:
+            for output in stage.outputs:
+                restore(output)
+            fingerprint = self.fingerprint(stage)
+            if not force and self.is_valid(stage, fingerprint):
+                print(f"INFO: Stage {stage.name} is up to date, skipping", flush=True)
+                self.cache_outputs(stage)
+                continue
+            self.run_stage(stage)
+            self.state[stage.name] = {
+                "fingerprint": fingerprint,
+                "outputs": self.output_digests(stage),
+            }
+            self.save_state()
+            self.cache_outputs(stage)
+            ran.append(stage.name)
+        return ran
+
+    def cache_outputs(self, stage):
+        """Link the stage's scratch outputs not cached yet into the cache."""
+        for output in stage.outputs:
+            if is_scratch(output) and not os.path.exists(cache_path(output)):
+                link_path(output, cache_path(output))
+
+    def run_stage(self, stage):
+        print(f"INFO: Running stage {stage.name}", flush=True)
+        self.state.pop(stage.name, None)
+        self.save_state()
+        for dep in stage.deps:
+            for output in self.by_name[dep].outputs:
+                materialise(output)
+        for path in stage.inputs:
+            materialise(path)
+        for output in stage.outputs:
+            remove_path(output)
+            remove_path(cache_path(output))
+        # Forget digests of anything this stage writes to.
+        self.digests = {
+            key: digest
+            for key, digest in self.digests.items()
+            if not any(overlaps(key[0], output) for output in stage.outputs)
+        }
+
+        result = self.runner.run(stage.command, description=stage.name)
+        missing = [path for path in stage.outputs if not os.path.exists(path)]
+        if result.returncode != 0 or missing:
+            raise StageFailed(
+                stage,
+                f"{stage.error} (stage {stage.name}, exit code {result.returncode}"
+                + (f", missing {', '.join(missing)})" if missing else ")"),
+            )
+
+
+def load_parameters(path_parameters_json):
+    if not os.path.isfile(path_parameters_json):
+        return {}
+    with open(path_parameters_json) as f:
+        return json.load(f)
+
+
+def find_custom_mask(input_folder):
+    """Return the custom mask MEDI will use, unpacking it if gzipped."""
+    custom_mask = os.path.join(input_folder, "custom", "QSM_mask.nii")
+    materialise(custom_mask)
+    return custom_mask if os.path.isfile(custom_mask) else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the QSM-MEDI stages.")
+    parser.add_argument("input_data_type", choices=("dicom", "nifti"))
+    parser.add_argument("path_parameters_json")
+    parser.add_argument("-n", "--threads-hdbet", type=int, default=0)
+    parser.add_argument(
+        "--force", action="store_true", help="rerun every stage, even if valid"
+    )
+    args = parser.parse_args(argv)
+
+    os.chdir(os.environ["OUTPUT_FOLDER"])
+    runner = ProcessRunner()
+    runner.cancel_on_signals()
+    stages = pipeline_stages(
+        args.input_data_type,
+        args.path_parameters_json,
+        os.environ["OUTPUT_FOLDER"],
+        args.threads_hdbet,
+        find_custom_mask(os.environ["INPUT_FOLDER"]),
+    )
+    orchestrator = Orchestrator(
+        stages, load_parameters(args.path_parameters_json), runner=runner
+    )
+    try:
+        ran = orchestrator.run(force=args.force)
+    except StageFailed as e:
+        print(e, flush=True)
+        return e.stage.exit_code
+    print(f"INFO: Stages run: {', '.join(ran) or 'none'}", flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
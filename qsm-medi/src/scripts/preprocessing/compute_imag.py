@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: BSD-3-Clause
+"""
+Compute the combined magnitude iMag.nii used as hd-bet input.
+
+Python port of the ``pre_hdbet`` mode of pipeline_qsm.m, which started the
+MATLAB Runtime only for ``iMag = sqrt(sum(abs(iField).^2, 4))``. The echoes
+listed in ``temp_dcm2niix/meta_data.json`` are read one at a time (as
+load_nifti_folder.m does), so memory stays at a few 3D volumes whatever the
+number of echoes. iMag is saved as float32 in the space of
+``temp_reference_3d.nii``.
+
+Usage: compute_imag.py PARAMETERS_JSON
+"""
+
+import json
+import os
+import sys
+
+import nibabel
+import numpy as np
+
+NEGATE_AXES = ("row", "col", "slice")
+
+
+def scaled_volume(dataobj):
+    """Return `dataobj` with its scaling applied, as float32."""
+    return np.asanyarray(dataobj).astype(np.float32, copy=False)
+
+
+def echo_magnitudes(folder, meta_data):
+    """
+    Yield the magnitude of each echo, as a 3D float32 array.
+
+    Real/imaginary pairs are combined when both exist, magnitude files are
+    read otherwise, following load_nifti_folder.m.
+    """
+    prefix = os.path.join(folder, meta_data["common_prefix"])
+    if meta_data["single_file"]:
+        # All echoes in one 4D file; slicing the proxy reads one echo.
+        img = nibabel.load(f"{prefix}.nii")
+        if len(img.shape) == 3:
+            yield scaled_volume(img.dataobj)
+            return
+        for echo in range(img.shape[3]):
+            yield scaled_volume(img.dataobj[..., echo])
+        return
+
+    combine_real_imag = meta_data["real_exists"] and meta_data["imaginary_exists"]
+    for echo in range(1, meta_data["num_echoes"] + 1):
+        if combine_real_imag:
+            real = scaled_volume(nibabel.load(f"{prefix}{echo}_real.nii").dataobj)
+            imag = scaled_volume(nibabel.load(f"{prefix}{echo}_imaginary.nii").dataobj)
+            yield np.hypot(real, imag, out=real)
+        else:
+            yield scaled_volume(nibabel.load(f"{prefix}{echo}.nii").dataobj)
+
+
+def combined_magnitude(magnitudes):
+    """Return the root sum of squares of `magnitudes`."""
+    total = None
+    for magnitude in magnitudes:
+        np.square(magnitude, out=magnitude)
+        if total is None:
+            total = magnitude
+        else:
+            total += magnitude
+    if total is None:
+        raise ValueError("ERROR: No echoes found to compute iMag from")
+    return np.sqrt(total, out=total)
+
+
+def check_inputs(meta_data, negate_axis):
+    """Apply the input checks load_nifti_folder.m makes before loading."""
+    combine_real_imag = meta_data["real_exists"] and meta_data["imaginary_exists"]
+    if not combine_real_imag and not meta_data["phase_exists"]:
+        raise ValueError(
+            "ERROR: Cannot process because phase is missing and cannot be "
+            "calculated from missing either real or imaginary or both"
+        )
+    if negate_axis and not combine_real_imag:
+        print(
+            "WARNING: load_negate_every_other_axis works only on real and "
+            "imaginary data. load_negate_every_other_axis disabled"
+        )
+    elif negate_axis and negate_axis.lower() not in NEGATE_AXES:
+        print(f"WARNING: Invalid load_negate_every_other_axis - {negate_axis}")
+    # Negating every other row/column/slice of both the real and imaginary
+    # parts flips signs only, so it leaves the magnitude, and iMag, unchanged.
+
+
+def load_parameters(path_parameters_json):
+    if not os.path.isfile(path_parameters_json):
+        return {}
+    with open(path_parameters_json) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    output_folder = os.environ["OUTPUT_FOLDER"]
+    folder = os.path.join(output_folder, "temp_dcm2niix")
+    with open(os.path.join(folder, "meta_data.json")) as f:
+        meta_data = json.load(f)
+    parameters = load_parameters(argv[0]) if argv else {}
+    check_inputs(meta_data, parameters.get("load_negate_every_other_axis"))
+
+    reference = nibabel.load(os.path.join(output_folder, "temp_reference_3d.nii"))
+    imag = combined_magnitude(echo_magnitudes(folder, meta_data))
+    if imag.shape != reference.shape[:3]:
+        raise ValueError(
+            f"ERROR: Echo shape {imag.shape} does not match the reference "
+            f"image shape {reference.shape[:3]}"
+        )
+
+    img = nibabel.nifti1.Nifti1Image(imag, reference.affine, header=reference.header)
+    img.set_data_dtype(np.float32)
+    img.header.set_slope_inter(1, 0)
+    nibabel.save(img, os.path.join(output_folder, "iMag.nii"))
+    print(f"INFO: Saved iMag.nii from {meta_data['common_prefix']} echoes")
+
+
+if __name__ == "__main__":
+    main()
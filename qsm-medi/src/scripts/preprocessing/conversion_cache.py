@@ -0,0 +1,245 @@
+"""
+Content-addressed cache of DICOM conversion outputs.
+
+Converting the same series again (for instance on a rerun that only changes
+QSM parameters) is replaced by hard-linking the files saved from the first
+conversion. Entries are keyed by a digest of the input files, the converter,
+its version and its options, and are evicted least-recently-used once the
+cache exceeds its size cap.
+
+Materialised files share their inode with the cache entry: consumers must
+replace them (write a new file, rename, delete) rather than rewrite them in
+place.
+
+This module is kept identical in ``QSMxT/`` and
+``qsm-medi/src/scripts/preprocessing/``; change both copies together.
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import subprocess
+import time
+import uuid
+
+# Default size cap of a cache, in bytes.
+DEFAULT_MAX_BYTES = 50 << 30
+
+HASH_CHUNK = 1 << 20
+
+
+def converter_version(executable):
+    """Return the version banner printed by `executable` --version."""
+    result = subprocess.run(
+        [executable, "--version"], capture_output=True, text=True, check=False
+    )
+    return (result.stdout + result.stderr).strip()
+
+
+def digest_tree(root):
+    """
+    Return a digest of the files under `root`: their relative paths and bytes.
+
+    Timestamps and permissions are left out, so freshly extracted copies of
+    the same archive produce the same digest.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            digest.update(rel.encode() + b"\0")
+            file_digest = hashlib.blake2b(digest_size=32)
+            with open(path, "rb") as f:
+                while chunk := f.read(HASH_CHUNK):
+                    file_digest.update(chunk)
+            digest.update(file_digest.digest())
+    return digest.hexdigest()
+
+
+def tree_size(root):
+    """Return the total size in bytes of the files under `root`."""
+    return sum(
+        os.path.getsize(os.path.join(dirpath, name))
+        for dirpath, _, filenames in os.walk(root)
+        for name in filenames
+    )
+
+
+def link_tree(src, dest):
+    """
+    Hard-link every file under `src` to the same place under `dest`.
+
+    Files are copied instead where links are not possible (another
+    filesystem). Existing files in `dest` are replaced.
+
+    Returns
+    -------
+    list of str
+        The files created in `dest`.
+    """
+    created = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        target_dir = os.path.join(dest, os.path.relpath(dirpath, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in sorted(filenames):
+            source = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copy2(source, target)
+            created.append(target)
+    return created
+
+
+class ConversionCache:
+    """
+    Converted NIfTI/JSON sets stored under `root`, capped at `max_bytes`.
+
+    Each entry is a directory ``objects/<key>`` holding the converter's
+    output tree. An SQLite index records every entry's size and last use,
+    which drives LRU eviction; it is safe to share a cache between
+    concurrent jobs.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(root, "objects")
+        self.staging = os.path.join(root, "staging")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.staging, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=60)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, bytes INTEGER NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+
+    def close(self):
+        """Close the index."""
+        self.db.close()
+
+    @staticmethod
+    def key(converter, version, options, input_dir):
+        """
+        Return the cache key of converting `input_dir`.
+
+        `options` are the converter's arguments other than its input and
+        output paths, which do not affect the result.
+        """
+        digest = hashlib.blake2b(digest_size=32)
+        for part in (converter, version, *options, digest_tree(input_dir)):
+            digest.update(str(part).encode() + b"\0")
+        return digest.hexdigest()
+
+    def entry_path(self, key):
+        """Return the directory holding entry `key`."""
+        return os.path.join(self.objects, key)
+
+    def fetch(self, key, dest):
+        """
+        Materialise entry `key` into `dest` by hard links.
+
+        Returns
+        -------
+        list of str or None
+            The files created, or None if the entry is not cached (in which
+            case `dest` is left as it was).
+        """
+        with self.db:
+            found = self.db.execute(
+                "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+            ).rowcount
+        if not found or not os.path.isdir(self.entry_path(key)):
+            return None
+        try:
+            return link_tree(self.entry_path(key), dest)
+        except FileNotFoundError:
+            # Evicted by another job while being linked.
+            return None
+
+    def store(self, key, src):
+        """
+        Save the converter output tree `src` as entry `key`, then evict.
+
+        The files are hard-linked into the cache where possible, so storing
+        costs no copy. Returns the entry's size in bytes.
+        """
+        staged = os.path.join(self.staging, uuid.uuid4().hex)
+        link_tree(src, staged)
+        size = tree_size(staged)
+        try:
+            os.rename(staged, self.entry_path(key))
+        except OSError:
+            # Another job stored the same entry first; keep theirs.
+            shutil.rmtree(staged, ignore_errors=True)
+        # No upsert: older SQLite builds (before 3.24) lack it.
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO entries (key, bytes, last_used) "
+                "VALUES (?, ?, 0)",
+                (key, size),
+            )
+            self.db.execute(
+                "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        self.evict()
+        return size
+
+    def total_bytes(self):
+        """Return the size of all entries."""
+        return self.db.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM entries"
+        ).fetchone()[0]
+
+    def evict(self):
+        """
+        Remove least-recently-used entries until the cache fits its cap.
+
+        Returns
+        -------
+        list of str
+            The keys removed.
+        """
+        removed = []
+        with self.db:
+            total = self.total_bytes()
+            rows = self.db.execute(
+                "SELECT key, bytes FROM entries ORDER BY last_used"
+            ).fetchall()
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                removed.append(key)
+        for key in removed:
+            # Renamed first so a concurrent fetch never sees half an entry.
+            doomed = os.path.join(self.staging, f"evicted-{uuid.uuid4().hex}")
+            try:
+                os.rename(self.entry_path(key), doomed)
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+        return removed
+
+    def convert(self, key, dest, run):
+        """
+        Materialise entry `key` into `dest`, or call `run` and store its output.
+
+        `run` must write the conversion output into `dest`, which should hold
+        nothing else. Returns True on a cache hit.
+        """
+        if self.fetch(key, dest) is not None:
+            return True
+        run()
+        self.store(key, dest)
+        return False
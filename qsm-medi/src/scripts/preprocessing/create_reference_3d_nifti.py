@@ -6,39 +6,37 @@ import glob
 import json
 import os
 import shutil
-import subprocess
 import sys
-import time
 
 import nibabel
+from conversion_cache import DEFAULT_MAX_BYTES, ConversionCache, converter_version
+
+# process_runner.py is installed in this script's parent folder.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from process_runner import ProcessRunner
 
 input_folder = os.environ["INPUT_FOLDER"]
 output_folder = os.environ["OUTPUT_FOLDER"]
+conversion_cache_dir = os.environ.get("CONVERSION_CACHE_DIR")
+conversion_cache_gb = os.environ.get("CONVERSION_CACHE_GB")
 
 input_data_type = sys.argv[1]
 path_config_json = sys.argv[2]
 path_dcm2niix_folder = f"{output_folder}/temp_dcm2niix"
 
 
-def run_command_with_subprocess(command):
-    terminal_env = os.environ.copy()
+runner = ProcessRunner()
+runner.cancel_on_signals()
 
-    def stream_process(process):
-        go = process.poll() is None
-        for line in process.stdout:
-            print(line, end="")
-        return go
 
-    process = subprocess.Popen(
-        args=command,
-        env=terminal_env,
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-    )
-    while stream_process(process):
-        time.sleep(0.1)
+def open_conversion_cache():
+    if not conversion_cache_dir:
+        return None
+    max_bytes = DEFAULT_MAX_BYTES
+    if conversion_cache_gb:
+        max_bytes = int(float(conversion_cache_gb) * 1e9)
+    print(f"INFO: Conversion cache {conversion_cache_dir} (up to {max_bytes} bytes)")
+    return ConversionCache(conversion_cache_dir, max_bytes=max_bytes)
 
 
 try:
@@ -52,9 +50,29 @@ os.makedirs(path_dcm2niix_folder, exist_ok=True)
 
 if input_data_type == "dicom":
     dcm2niix_options = f"-z n -i y -f %p -o {output_folder}/temp_dcm2niix"
-    run_command_with_subprocess(
-        f"dcm2niix {dcm2niix_options} {input_folder}/dicom_data".split()
-    )
+    dcm2niix_command = f"dcm2niix {dcm2niix_options} {input_folder}/dicom_data".split()
+    # Reruns on the same DICOMs (e.g. with new QSM parameters) reuse the
+    # conversion; the key leaves out the output and input paths.
+    cache = open_conversion_cache()
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(
+            "dcm2niix",
+            converter_version("dcm2niix"),
+            dcm2niix_command[1:-3],
+            f"{input_folder}/dicom_data",
+        )
+    if cache is not None and cache.fetch(cache_key, path_dcm2niix_folder) is not None:
+        print(f"INFO: Reusing cached dcm2niix conversion {cache_key[:12]}")
+    else:
+        result = runner.run(dcm2niix_command, description="dcm2niix")
+        if result.returncode != 0:
+            print(f"ERROR: dcm2niix failed with exit code {result.returncode}")
+            sys.exit(result.returncode if result.returncode > 0 else 1)
+        if cache is not None:
+            cache.store(cache_key, path_dcm2niix_folder)
+    if cache is not None:
+        cache.close()
     # find first nifti file
     list_niftis = glob.glob(f"{output_folder}/temp_dcm2niix/*.nii")
     list_niftis.sort()
@@ -70,7 +88,7 @@ elif input_data_type == "nifti":
             shutil.copy(file, path_dcm2niix_folder)
 
     for zipped_file in glob.glob(f"{output_folder}/temp_dcm2niix/*.ni*"):
-        run_command_with_subprocess(f"gunzip -f {zipped_file}".split())
+        runner.run(f"gunzip -f {zipped_file}".split(), "gunzip", check=True)
 
     search_pattern = f"{output_folder}/temp_dcm2niix/*.nii"
     if os.path.isfile(path_config_json):
@@ -0,0 +1,293 @@
+# SPDX-License-Identifier: BSD-3-Clause
+"""
+Shared runner for the external commands of the QSM-MEDI pipeline.
+
+Output is streamed line by line as the command produces it, exit codes are
+returned (or raised with ``check=True``), commands can be given a timeout or
+cancelled from another thread or a signal handler, and every command's wall
+time, CPU time and peak memory are appended as one JSON line to
+``processing_commands.jsonl`` next to ``processing.log``.
+"""
+
+import codecs
+import contextlib
+import datetime
+import io
+import json
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import List, NamedTuple
+
+COMMAND_LOG = "processing_commands.jsonl"
+
+# Seconds a stopped command gets between SIGTERM and SIGKILL.
+DEFAULT_GRACE_SECONDS = 10.0
+
+# Seconds output is still read after the command exits, for background
+# processes it started that keep the output pipe open.
+DEFAULT_DRAIN_SECONDS = 5.0
+
+# Seconds between checks for the command's exit while it prints nothing.
+EXIT_CHECK_SECONDS = 0.5
+
+READ_CHUNK = 1 << 16
+
+
+class CommandResult(NamedTuple):
+    command: List[str]
+    returncode: int
+    wall_seconds: float
+    user_cpu_seconds: float
+    system_cpu_seconds: float
+    max_rss_kb: int
+    timed_out: bool
+    cancelled: bool
+
+
+def default_log_path():
+    """Return the command log next to processing.log, if OUTPUT_FOLDER is set."""
+    output_folder = os.environ.get("OUTPUT_FOLDER")
+    return os.path.join(output_folder, COMMAND_LOG) if output_folder else None
+
+
+def exit_code(status):
+    """Return the exit code of a wait status, negative for a signal."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class LineWriter:
+    """Writes raw command output to a text stream as whole lines."""
+
+    def __init__(self, output):
+        self.output = output
+        self.decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder("utf-8")(errors="replace"), translate=True
+        )
+        self.partial = ""
+
+    def write(self, chunk):
+        """Write the complete lines of `chunk`, keeping the rest for later."""
+        *lines, self.partial = (self.partial + self.decoder.decode(chunk)).split("\n")
+        for line in lines:
+            self.output.write(line + "\n")
+        self.output.flush()
+
+    def close(self):
+        """Write the last, unterminated line, if any."""
+        self.partial += self.decoder.decode(b"", final=True)
+        if self.partial:
+            self.output.write(self.partial + "\n")
+            self.output.flush()
+        self.partial = ""
+
+
+class ProcessRunner:
+    """
+    Runs commands one at a time, streaming their output to `output`
+    (standard output by default).
+
+    Each command runs in its own process group so that stopping it (on
+    timeout or `cancel`) also stops the processes it started: they get
+    SIGTERM, then SIGKILL after `grace_seconds`. Once cancelled, a runner
+    refuses to start further commands.
+
+    A process left running in the background by the command may hold the
+    output pipe open after the command exits. Output is then read for
+    `drain_seconds` more, after which the command's process group is killed
+    and the rest of its output is dropped, so the run always returns.
+    """
+
+    def __init__(
+        self,
+        log_path=None,
+        grace_seconds=DEFAULT_GRACE_SECONDS,
+        output=None,
+        drain_seconds=DEFAULT_DRAIN_SECONDS,
+    ):
+        # None logs next to processing.log; False disables the command log.
+        self.log_path = default_log_path() if log_path is None else log_path
+        self.grace_seconds = grace_seconds
+        self.drain_seconds = drain_seconds
+        self.output = output
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.wake = None
+
+    def cancel(self):
+        """Stop the running command, if any, and refuse later ones."""
+        self.cancelled = True
+        wake = self.wake
+        if wake is not None:
+            wake.set()
+
+    def cancel_on_signals(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        """Cancel when the process receives one of `signals`."""
+
+        def handler(signum, frame):
+            print(f"INFO: Received signal {signum}, stopping", flush=True)
+            self.cancel()
+
+        for signum in signals:
+            signal.signal(signum, handler)
+
+    def run(self, command, description=None, timeout=None, check=False, env=None):
+        """
+        Run `command`, streaming its merged stdout and stderr.
+
+        Returns
+        -------
+        CommandResult
+            The exit code (negative for a signal) and resource usage.
+
+        Raises
+        ------
+        subprocess.TimeoutExpired
+            With ``check=True``, if the command ran longer than `timeout`.
+        subprocess.CalledProcessError
+            With ``check=True``, if the command failed or was cancelled.
+        """
+        with self.lock:
+            result = self.execute(list(command), timeout, env)
+        self.record(result, description)
+        if check and result.timed_out:
+            raise subprocess.TimeoutExpired(result.command, timeout)
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, result.command)
+        return result
+
+    def execute(self, command, timeout, env):
+        output = self.output or sys.stdout
+        if self.cancelled:
+            print(f"INFO: Cancelled before start: {' '.join(command)}", file=output)
+            return CommandResult(
+                command, -signal.SIGTERM, 0.0, 0.0, 0.0, 0, False, True
+            )
+
+        start = time.monotonic()
+        process = subprocess.Popen(
+            command,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        self.wake = wake = threading.Event()
+        if self.cancelled:
+            wake.set()  # cancelled while starting
+        exited = threading.Event()
+        stopped = {}
+        watchdog = threading.Thread(
+            target=self.watch,
+            args=(process.pid, timeout, wake, exited, stopped),
+            daemon=True,
+        )
+        watchdog.start()
+
+        status = usage = None
+        try:
+            with process.stdout:
+                status, usage = self.stream(process, output)
+        finally:
+            if status is None:
+                # Interrupted while streaming: leave no orphaned processes.
+                self.kill_group(process.pid, signal.SIGKILL)
+                process.wait()
+            exited.set()
+            wake.set()
+            watchdog.join()
+            self.wake = None
+        process.returncode = exit_code(status)
+
+        return CommandResult(
+            command,
+            process.returncode,
+            round(time.monotonic() - start, 3),
+            round(usage.ru_utime, 3),
+            round(usage.ru_stime, 3),
+            usage.ru_maxrss,
+            stopped.get("reason") == "timeout",
+            stopped.get("reason") == "cancelled",
+        )
+
+    def stream(self, process, output):
+        """
+        Copy the command's output to `output` line by line until it ends.
+
+        Returns the wait status and resource usage of the command (wait4
+        rather than Popen.wait, for the resource usage). Output still open
+        `drain_seconds` after the command exits is abandoned.
+        """
+        fd = process.stdout.fileno()
+        lines = LineWriter(output)
+        status = usage = deadline = None
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                if deadline is None:
+                    pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+                    if pid:
+                        deadline = time.monotonic() + self.drain_seconds
+                        timeout = self.drain_seconds
+                    else:
+                        status = usage = None
+                        timeout = EXIT_CHECK_SECONDS
+                else:
+                    timeout = max(0.0, deadline - time.monotonic())
+
+                if selector.select(timeout):
+                    chunk = os.read(fd, READ_CHUNK)
+                    if not chunk:
+                        break
+                    lines.write(chunk)
+                elif deadline is not None:
+                    print(
+                        "INFO: Output still open after the command exited, "
+                        "stopping its background processes",
+                        file=output,
+                    )
+                    self.kill_group(process.pid, signal.SIGKILL)
+                    break
+
+        lines.close()
+        if status is None:
+            # Output closed while the command runs on.
+            _, status, usage = os.wait4(process.pid, 0)
+        return status, usage
+
+    def watch(self, pid, timeout, wake, exited, stopped):
+        """Stop process group `pid` on timeout or cancellation."""
+        woken = wake.wait(timeout)
+        if exited.is_set():
+            return
+        if woken and not self.cancelled:
+            return
+        stopped["reason"] = "cancelled" if woken else "timeout"
+        print(f"INFO: Stopping command ({stopped['reason']})", flush=True)
+        self.kill_group(pid, signal.SIGTERM)
+        if not exited.wait(self.grace_seconds):
+            self.kill_group(pid, signal.SIGKILL)
+
+    @staticmethod
+    def kill_group(pid, signum):
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(pid, signum)
+
+    def record(self, result, description):
+        """Append `result` to the command log as one JSON line."""
+        if not self.log_path:
+            return
+        entry = {
+            "description": description or os.path.basename(result.command[0]),
+            "finished": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            **result._asdict(),
+        }
+        # One write per line keeps lines whole when processes share the log.
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
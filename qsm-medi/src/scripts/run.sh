@@ -15,8 +15,9 @@ input_dicom_exists=0
 input_nifti_exists=0
 input_data_type=""
 config_name=""
+force_rerun=""
 
-while getopts "n:c:i:o:p:" opt; do
+while getopts "n:c:i:o:p:f" opt; do
   case $opt in
     n)
       num_threads_hdbet=${OPTARG}
@@ -34,6 +35,10 @@ while getopts "n:c:i:o:p:" opt; do
       export OUTPUT_FOLDER=${OPTARG}
       echo "INFO: OUTPUT_FOLDER set to ${OUTPUT_FOLDER}"
       ;;
+    f)
+      force_rerun="--force"
+      echo "INFO: Rerunning every stage"
+      ;;
     p)
       export PATH_PARAMETERS_JSON=${OPTARG}
       echo "INFO: PATH_PARAMETERS_JSON set to ${PATH_PARAMETERS_JSON}"
@@ -75,9 +80,6 @@ rm -rf ${OUTPUT_FOLDER}/pipeline_meta.txt
 /opt/process_QSM/preprocessing/create_pipeline_meta.sh $@
 cp -f ${OUTPUT_FOLDER}/pipeline_meta.txt ${OUTPUT_FOLDER}/processing.log
 rm -rf ${OUTPUT_FOLDER}/reference_3d.ni*
-rm -rf ${OUTPUT_FOLDER}/temp_*
-rm -rf ${OUTPUT_FOLDER}/QSM_mask.ni*
-rm -rf ${OUTPUT_FOLDER}/QSM.ni*
 
 if [ -d "${INPUT_FOLDER}/dicom_data" ]; then
   input_dicom_exists=1
@@ -98,46 +100,14 @@ elif [[ "$input_dicom_exists" -eq 0 && "$input_nifti_exists" -eq 0 ]]; then
   exit 1
 fi
 
-python3 /opt/process_QSM/preprocessing/create_reference_3d_nifti.py ${input_data_type} ${PATH_PARAMETERS_JSON} 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
-if [ ! -f "${OUTPUT_FOLDER}/temp_reference_3d.nii" ]; then
-  echo "ERROR: Could not create reference 3d nifti" | tee -a ${OUTPUT_FOLDER}/processing.log
-  exit 1
-fi
-
-python3 /opt/process_QSM/preprocessing/determine_nifti_folder_type.py ${PATH_PARAMETERS_JSON} 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
-if [ ! -f "${OUTPUT_FOLDER}/temp_dcm2niix/meta_data.json" ]; then
-  echo "ERROR: Could not determine data in nifti folder, missing temp_dcm2niix/meta_data.json" | tee -a ${OUTPUT_FOLDER}/processing.log
-  exit 1
-fi
-
-cd ${OUTPUT_FOLDER}
-if [ -f "${INPUT_FOLDER}/custom/QSM_mask.nii.gz" ]; then
-  gunzip ${INPUT_FOLDER}/custom/QSM_mask.nii.gz
-fi
-if [ ! -f "${INPUT_FOLDER}/custom/QSM_mask.nii" ]; then
-  /opt/process_QSM/for_redistribution_files_only/run_pipeline_qsm.sh /opt/MCR-2018b/v95 pre_hdbet ${PATH_PARAMETERS_JSON} ${OUTPUT_FOLDER} 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
-  if [ ! -f "${OUTPUT_FOLDER}/iMag.nii" ]; then
-    echo "ERROR: Could not create magnitude image for hd-bet" | tee -a ${OUTPUT_FOLDER}/processing.log
-    exit 1
-  fi
-  python3 /opt/process_QSM/hd-bet/prep_image_for_hdbet.py 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
-  start=`date +%s`
-  hd-bet -i ${OUTPUT_FOLDER}/temp_hd-bet_input.nii.gz -o ${OUTPUT_FOLDER}/temp_hd-bet_output_pre.nii.gz -device cpu -threads ${num_threads_hdbet} -mode fast -tta 0 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
-  end=`date +%s`
-  runtime=$((end-start))
-  echo "hd-bet runtime: ${runtime} seconds" 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
-  python3 /opt/process_QSM/hd-bet/post_for_hdbet.py 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
+# Stages whose inputs and parameters are unchanged since their last
+# successful run in this output folder are skipped (see orchestrator.py).
+python3 -u /opt/process_QSM/orchestrator.py ${input_data_type} ${PATH_PARAMETERS_JSON} -n ${num_threads_hdbet} ${force_rerun} 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
+orchestrator_status=${PIPESTATUS[0]}
+if [ "${orchestrator_status}" -ne 0 ]; then
+  exit ${orchestrator_status}
 fi
 
-echo "" | tee -a ${OUTPUT_FOLDER}/processing.log
-echo "" | tee -a ${OUTPUT_FOLDER}/processing.log
-echo "------------------------------------------" | tee -a ${OUTPUT_FOLDER}/processing.log
-echo "INFO: Starting MEDI processing" | tee -a ${OUTPUT_FOLDER}/processing.log
-
-/opt/process_QSM/for_redistribution_files_only/run_pipeline_qsm.sh /opt/MCR-2018b/v95 execute ${PATH_PARAMETERS_JSON} ${OUTPUT_FOLDER} 2>&1 | tee -a ${OUTPUT_FOLDER}/processing.log
-if [ ! -f "${OUTPUT_FOLDER}/QSM.nii" ]; then
-  echo "ERROR: QSM pipeline failed during MEDI processing" | tee -a ${OUTPUT_FOLDER}/processing.log
-  exit 2
+if ls ${OUTPUT_FOLDER}/*.nii > /dev/null 2>&1; then
+  gzip -f ${OUTPUT_FOLDER}/*.nii
 fi
-
-gzip -f ${OUTPUT_FOLDER}/*.nii
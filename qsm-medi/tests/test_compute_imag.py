@@ -0,0 +1,174 @@
+import json
+import os
+import sys
+
+import nibabel
+import numpy as np
+import pytest
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "../src/scripts/preprocessing"
+    ),
+)
+from compute_imag import check_inputs, combined_magnitude, echo_magnitudes, main
+
+SHAPE = (4, 5, 3)
+NUM_ECHOES = 3
+AFFINE = np.diag([0.5, 0.6, 2.0, 1.0])
+AFFINE[:3, 3] = (-10, 20, 5)
+
+# --------------------------------------------------
+# Helpers
+# --------------------------------------------------
+
+
+def save(path, data, slope=1.0, inter=0.0):
+    """Save `data` as int16 with `slope`/`inter` in the header."""
+    img = nibabel.Nifti1Image(data.astype(np.int16), AFFINE)
+    img.header.set_slope_inter(slope, inter)
+    nibabel.save(img, str(path))
+
+
+def meta_data(prefix="gre", num_echoes=NUM_ECHOES, single_file=0, **exists):
+    meta = {
+        "common_prefix": prefix,
+        "num_echoes": num_echoes,
+        "single_file": single_file,
+        "phase_exists": 1,
+        "real_exists": 0,
+        "imaginary_exists": 0,
+    }
+    meta.update(exists)
+    return meta
+
+
+def expected_imag(i_field):
+    """iMag = sqrt(sum(abs(iField).^2, 4)) as pipeline_qsm.m computed it."""
+    return np.sqrt(np.sum(np.abs(i_field) ** 2, axis=3))
+
+
+@pytest.fixture
+def echoes():
+    """Raw int16 real and imaginary parts of every echo, echo last."""
+    rng = np.random.default_rng(0)
+    shape = (*SHAPE, NUM_ECHOES)
+    return rng.integers(-500, 500, shape), rng.integers(-500, 500, shape)
+
+
+# --------------------------------------------------
+# Tests
+# --------------------------------------------------
+
+
+def test_combines_real_and_imaginary_pairs(tmp_path, echoes):
+    real, imag = echoes
+    for echo in range(NUM_ECHOES):
+        save(tmp_path / f"gre{echo + 1}_real.nii", real[..., echo])
+        save(tmp_path / f"gre{echo + 1}_imaginary.nii", imag[..., echo])
+    meta = meta_data(phase_exists=0, real_exists=1, imaginary_exists=1)
+
+    result = combined_magnitude(echo_magnitudes(str(tmp_path), meta))
+
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected_imag(real + 1j * imag), rtol=1e-5)
+
+
+def test_reads_magnitude_files(tmp_path, echoes):
+    magnitude = np.abs(echoes[0])
+    for echo in range(NUM_ECHOES):
+        save(tmp_path / f"gre{echo + 1}.nii", magnitude[..., echo])
+        save(tmp_path / f"gre{echo + 1}_ph.nii", echoes[1][..., echo])
+    # Real parts alone are not combined.
+    save(tmp_path / "gre1_real.nii", echoes[1][..., 0])
+
+    result = combined_magnitude(
+        echo_magnitudes(str(tmp_path), meta_data(real_exists=1))
+    )
+
+    np.testing.assert_allclose(result, expected_imag(magnitude), rtol=1e-5)
+
+
+@pytest.mark.parametrize("num_echoes", [1, NUM_ECHOES])
+def test_reads_single_file(tmp_path, echoes, num_echoes):
+    magnitude = np.abs(echoes[0][..., :num_echoes])
+    save(tmp_path / "gre.nii", magnitude[..., 0] if num_echoes == 1 else magnitude)
+    meta = meta_data(num_echoes=-1, single_file=1)
+
+    result = combined_magnitude(echo_magnitudes(str(tmp_path), meta))
+
+    np.testing.assert_allclose(result, expected_imag(magnitude), rtol=1e-5)
+
+
+def test_applies_scaling_as_load_nifti_folder(tmp_path, echoes):
+    real, imag = echoes
+    save(tmp_path / "gre1_real.nii", real[..., 0], slope=0.5, inter=3.0)
+    save(tmp_path / "gre1_imaginary.nii", imag[..., 0], slope=2.0, inter=-1.0)
+    meta = meta_data(num_echoes=1, real_exists=1, imaginary_exists=1)
+
+    result = combined_magnitude(echo_magnitudes(str(tmp_path), meta))
+
+    # single(img) * scl_slope + scl_inter, before combining.
+    i_field = (real[..., :1] * 0.5 + 3.0) + 1j * (imag[..., :1] * 2.0 - 1.0)
+    np.testing.assert_allclose(result, expected_imag(i_field), rtol=1e-5)
+
+
+def test_no_echoes_raise():
+    with pytest.raises(ValueError, match="No echoes"):
+        combined_magnitude(iter(()))
+
+
+def test_check_inputs_requires_phase():
+    with pytest.raises(ValueError, match="phase is missing"):
+        check_inputs(meta_data(phase_exists=0, real_exists=1), None)
+    check_inputs(meta_data(phase_exists=0, real_exists=1, imaginary_exists=1), None)
+    check_inputs(meta_data(), None)
+
+
+def test_check_inputs_warns_on_negate_axis(capsys):
+    check_inputs(meta_data(), "row")
+    assert "works only on real and imaginary" in capsys.readouterr().out
+
+    check_inputs(meta_data(real_exists=1, imaginary_exists=1), "diagonal")
+    assert "Invalid load_negate_every_other_axis" in capsys.readouterr().out
+
+
+@pytest.fixture
+def output_folder(tmp_path, monkeypatch, echoes):
+    folder = tmp_path / "temp_dcm2niix"
+    folder.mkdir()
+    for echo in range(NUM_ECHOES):
+        save(folder / f"gre{echo + 1}.nii", np.abs(echoes[0][..., echo]))
+    (folder / "meta_data.json").write_text(json.dumps(meta_data()))
+    monkeypatch.setenv("OUTPUT_FOLDER", str(tmp_path))
+    return tmp_path
+
+
+def test_main_writes_float32_imag_in_reference_space(output_folder, echoes):
+    reference = nibabel.Nifti1Image(np.zeros(SHAPE, np.int16), AFFINE)
+    reference.header.set_xyzt_units("mm", "sec")
+    reference.header["descrip"] = b"reference"
+    nibabel.save(reference, str(output_folder / "temp_reference_3d.nii"))
+
+    main([])
+
+    reference = nibabel.load(str(output_folder / "temp_reference_3d.nii"))
+    imag = nibabel.load(str(output_folder / "iMag.nii"))
+    assert imag.get_data_dtype() == np.float32
+    assert (imag.dataobj.slope, imag.dataobj.inter) == (1.0, 0.0)
+    np.testing.assert_array_equal(imag.affine, reference.affine)
+    assert imag.header["descrip"] == b"reference"
+    assert imag.header.get_xyzt_units() == ("mm", "sec")
+    np.testing.assert_allclose(
+        imag.get_fdata(), expected_imag(np.abs(echoes[0])), rtol=1e-5
+    )
+
+
+def test_main_rejects_shape_mismatch(output_folder):
+    reference = nibabel.Nifti1Image(np.zeros((4, 5, 4), np.int16), AFFINE)
+    nibabel.save(reference, str(output_folder / "temp_reference_3d.nii"))
+
+    with pytest.raises(ValueError, match="does not match the reference"):
+        main([])
+    assert not (output_folder / "iMag.nii").exists()
@@ -0,0 +1,216 @@
+import glob
+import gzip
+import os
+import shutil
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src/scripts")
+)
+from orchestrator import (
+    STAGE_CACHE,
+    Orchestrator,
+    Stage,
+    StageFailed,
+    dependency_order,
+    digest_path,
+)
+
+# --------------------------------------------------
+# Helpers
+# --------------------------------------------------
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+class FakeRunner:
+    """Runs a stage's command as the Python function registered for it."""
+
+    def __init__(self, actions):
+        self.actions = actions
+        self.ran = []
+
+    def run(self, command, description=None):
+        self.ran.append(description)
+        return SimpleNamespace(returncode=self.actions[command[0]]() or 0)
+
+
+def medi_cleanup():
+    # What pipeline_qsm.m does after MEDI unless debug_mode is 1.
+    write("QSM.nii", read("temp_reference_3d.nii") + read("temp_dcm2niix/echo1.nii"))
+    shutil.rmtree("temp_dcm2niix")
+    for path in glob.glob("temp_*"):
+        os.remove(path)
+
+
+def reference():
+    write("temp_reference_3d.nii", "reference")
+    write("temp_dcm2niix/echo1.nii", "echo1")
+
+
+# Listed out of order on purpose.
+STAGES = [
+    Stage(
+        "medi",
+        ("medi",),
+        outputs=("QSM.nii",),
+        deps=("reference", "metadata"),
+        parameters=None,
+    ),
+    Stage(
+        "metadata",
+        ("metadata",),
+        outputs=("temp_dcm2niix/meta_data.json",),
+        deps=("reference",),
+        parameters=("prefix",),
+    ),
+    Stage(
+        "reference",
+        ("reference",),
+        outputs=("temp_reference_3d.nii", "temp_dcm2niix"),
+        parameters=("prefix",),
+        exclude=("meta_data.json",),
+    ),
+]
+
+
+@pytest.fixture
+def runner(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return FakeRunner(
+        {
+            "reference": reference,
+            "metadata": lambda: write("temp_dcm2niix/meta_data.json", "{}"),
+            "medi": medi_cleanup,
+        }
+    )
+
+
+def orchestrator(runner, parameters=None):
+    return Orchestrator(STAGES, parameters or {"prefix": "mag"}, runner=runner)
+
+
+# --------------------------------------------------
+# Tests
+# --------------------------------------------------
+
+
+def test_dependency_order():
+    ordered = [stage.name for stage in dependency_order(STAGES)]
+    assert ordered == ["reference", "metadata", "medi"]
+
+
+def test_dependency_order_rejects_cycles_and_unknown_stages():
+    with pytest.raises(ValueError, match="cycle"):
+        dependency_order(
+            [Stage("a", (), (), deps=("b",)), Stage("b", (), (), deps=("a",))]
+        )
+    with pytest.raises(ValueError, match="unknown missing"):
+        dependency_order([Stage("a", (), (), deps=("missing",))])
+
+
+def test_digest_path_follows_gzipped_files(tmp_path):
+    path = str(tmp_path / "iMag.nii")
+    write(path, "magnitude")
+    digest = digest_path(path)
+
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dest:
+        shutil.copyfileobj(src, dest)
+    os.remove(path)
+
+    assert digest_path(path) == digest
+    assert digest_path(str(tmp_path / "missing.nii")) is None
+
+
+def test_fingerprint_covers_used_parameters_and_dependencies(runner, monkeypatch):
+    runner.actions["medi"] = lambda: write("QSM.nii", "qsm")
+    orchestrator(runner).run()
+    by_name = {stage.name: stage for stage in STAGES}
+    base = orchestrator(runner)
+    fingerprint = base.fingerprint(by_name["metadata"])
+
+    unused = orchestrator(runner, {"prefix": "mag", "medi_lambda": 2000})
+    assert unused.fingerprint(by_name["metadata"]) == fingerprint
+    assert unused.fingerprint(by_name["medi"]) != base.fingerprint(by_name["medi"])
+    assert unused.is_valid(by_name["metadata"], fingerprint)
+    assert not unused.is_valid(by_name["medi"], unused.fingerprint(by_name["medi"]))
+
+    changed = orchestrator(runner, {"prefix": "echo"})
+    assert changed.fingerprint(by_name["metadata"]) != fingerprint
+
+    write("temp_reference_3d.nii", "edited")
+    edited = orchestrator(runner)
+    assert edited.fingerprint(by_name["metadata"]) != fingerprint
+    assert not edited.is_valid(
+        by_name["reference"], edited.fingerprint(by_name["reference"])
+    )
+
+    monkeypatch.setenv("PIPELINE_VERSION", "9.9.9")
+    assert orchestrator(runner).fingerprint(by_name["metadata"]) != fingerprint
+
+
+def test_skips_stages_still_valid(runner):
+    assert orchestrator(runner).run() == ["reference", "metadata", "medi"]
+    assert not os.path.exists("temp_dcm2niix")
+
+    # The scratch outputs MEDI deleted come back from the stage cache.
+    assert orchestrator(runner).run() == []
+    assert read("temp_dcm2niix/meta_data.json") == "{}"
+    assert read("temp_reference_3d.nii") == "reference"
+
+
+def test_medi_parameter_change_reruns_medi_alone(runner):
+    orchestrator(runner).run()
+    runner.ran.clear()
+
+    ran = orchestrator(runner, {"prefix": "mag", "medi_lambda": 2000}).run()
+
+    assert ran == runner.ran == ["medi"]
+    assert read("QSM.nii") == "referenceecho1"
+
+
+def test_resumes_after_failed_stage(runner):
+    runner.actions["metadata"] = lambda: 1
+    with pytest.raises(StageFailed) as raised:
+        orchestrator(runner).run()
+    assert raised.value.stage.name == "metadata"
+
+    runner.actions["metadata"] = lambda: write("temp_dcm2niix/meta_data.json", "{}")
+    assert orchestrator(runner).run() == ["metadata", "medi"]
+
+
+def test_missing_output_fails_stage(runner):
+    runner.actions["metadata"] = lambda: None
+    with pytest.raises(StageFailed, match=r"missing temp_dcm2niix/meta_data\.json"):
+        orchestrator(runner).run()
+
+
+def test_force_reruns_every_stage(runner):
+    orchestrator(runner).run()
+    assert orchestrator(runner).run(force=True) == ["reference", "metadata", "medi"]
+
+
+def test_rerun_replaces_cached_outputs(runner):
+    orchestrator(runner).run()
+
+    def new_reference():
+        write("temp_reference_3d.nii", "new")
+        write("temp_dcm2niix/echo1.nii", "echo1")
+
+    runner.actions["reference"] = new_reference
+
+    assert orchestrator(runner).run(force=True) == ["reference", "metadata", "medi"]
+    assert read(os.path.join(STAGE_CACHE, "temp_reference_3d.nii")) == "new"
+    assert read("QSM.nii") == "newecho1"
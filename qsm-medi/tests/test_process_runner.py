@@ -0,0 +1,190 @@
+import io
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src/scripts")
+)
+from process_runner import ProcessRunner
+
+# --------------------------------------------------
+# Helpers
+# --------------------------------------------------
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+def alive(pid):
+    """Whether `pid` runs (zombies left for a non-reaping init count as dead)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    return state not in ("Z", "X")
+
+
+def wait_dead(pid, seconds=5.0):
+    deadline = time.monotonic() + seconds
+    while alive(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return not alive(pid)
+
+
+# Starts a grandchild that inherits the output pipe, prints its PID, then
+# waits for it.
+SPAWN_GRANDCHILD = (
+    "import subprocess, sys\n"
+    "p = subprocess.Popen(['sleep', '60'])\n"
+    "print(p.pid, flush=True)\n"
+    "p.wait()\n"
+)
+
+
+def grandchild_pid(output):
+    return int(output.getvalue().split()[0])
+
+
+@pytest.fixture
+def output():
+    return io.StringIO()
+
+
+@pytest.fixture
+def runner(output):
+    return ProcessRunner(log_path=False, grace_seconds=1.0, output=output)
+
+
+# --------------------------------------------------
+# Tests
+# --------------------------------------------------
+
+
+def test_streams_output_line_by_line(tmp_path):
+    marker = tmp_path / "seen"
+
+    class Output(io.StringIO):
+        def write(self, text):
+            if text == "first\n":
+                marker.touch()
+            return super().write(text)
+
+    # The second line is only printed once the first has reached the output.
+    code = (
+        "import os, time\n"
+        "print('first', flush=True)\n"
+        "deadline = time.monotonic() + 10\n"
+        f"while not os.path.exists({str(marker)!r}):\n"
+        "    assert time.monotonic() < deadline, 'first line not streamed'\n"
+        "    time.sleep(0.01)\n"
+        "print('second\\r\\nthird', end='')\n"
+    )
+    output = Output()
+    result = ProcessRunner(log_path=False, output=output).run(python(code))
+
+    assert result.returncode == 0
+    assert output.getvalue() == "first\nsecond\nthird\n"
+
+
+def test_returns_exit_codes(runner):
+    assert runner.run(python("import sys; sys.exit(3)")).returncode == 3
+    killed = runner.run(python("import os, signal; os.kill(os.getpid(), 9)"))
+    assert killed.returncode == -signal.SIGKILL
+    assert not killed.timed_out
+    assert not killed.cancelled
+
+
+def test_check_raises(runner):
+    with pytest.raises(subprocess.CalledProcessError) as raised:
+        runner.run(python("import sys; sys.exit(4)"), check=True)
+    assert raised.value.returncode == 4
+
+    with pytest.raises(subprocess.TimeoutExpired):
+        runner.run(python("import time; time.sleep(60)"), timeout=0.2, check=True)
+
+
+def test_timeout_stops_process_group(runner, output):
+    start = time.monotonic()
+    result = runner.run(python(SPAWN_GRANDCHILD), timeout=0.5)
+
+    assert time.monotonic() - start < 10
+    assert result.timed_out
+    assert result.returncode == -signal.SIGTERM
+    assert wait_dead(grandchild_pid(output))
+
+
+def test_cancel_stops_running_command(runner, output):
+    threading.Timer(0.5, runner.cancel).start()
+
+    result = runner.run(python(SPAWN_GRANDCHILD))
+
+    assert result.cancelled
+    assert result.returncode == -signal.SIGTERM
+    assert wait_dead(grandchild_pid(output))
+
+
+def test_refuses_to_start_after_cancel(runner, tmp_path):
+    marker = tmp_path / "ran"
+    runner.cancel()
+
+    result = runner.run(python(f"open({str(marker)!r}, 'w').close()"))
+
+    assert result.cancelled
+    assert result.returncode == -signal.SIGTERM
+    assert not marker.exists()
+
+
+def test_background_process_holding_output_does_not_block(output):
+    # The grandchild leaves the process group and keeps the pipe open.
+    code = (
+        "import subprocess\n"
+        "p = subprocess.Popen(['sleep', '60'], start_new_session=True)\n"
+        "print(p.pid, flush=True)\n"
+    )
+    runner = ProcessRunner(log_path=False, output=output, drain_seconds=0.2)
+    start = time.monotonic()
+    try:
+        result = runner.run(python(code), timeout=30)
+    finally:
+        os.kill(grandchild_pid(output), signal.SIGKILL)
+
+    assert time.monotonic() - start < 10
+    assert result.returncode == 0
+    assert not result.timed_out
+    assert "Output still open" in output.getvalue()
+
+
+def test_records_command_log(tmp_path, output):
+    log_path = tmp_path / "processing_commands.jsonl"
+    runner = ProcessRunner(log_path=str(log_path), output=output)
+
+    runner.run(python("print('hi')"), description="greeting")
+    runner.run(python("import sys; sys.exit(2)"))
+
+    first, second = (json.loads(line) for line in log_path.read_text().splitlines())
+    assert first["description"] == "greeting"
+    assert first["command"] == python("print('hi')")
+    assert first["returncode"] == 0
+    assert first["wall_seconds"] >= 0
+    assert first["max_rss_kb"] > 0
+    assert first["timed_out"] is False
+    assert first["cancelled"] is False
+    assert "finished" in first
+    assert second["description"] == os.path.basename(sys.executable)
+    assert second["returncode"] == 2
+
+
+def test_default_log_path_follows_output_folder(tmp_path, monkeypatch):
+    monkeypatch.setenv("OUTPUT_FOLDER", str(tmp_path))
+    assert ProcessRunner().log_path == str(tmp_path / "processing_commands.jsonl")
+    monkeypatch.delenv("OUTPUT_FOLDER")
+    assert ProcessRunner().log_path is None